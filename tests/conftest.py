@@ -0,0 +1,53 @@
+"""
+The tests run two accounts against the fake Telegram of `tg_companion.benchmark`, with the database and the logs
+in a temporary directory, so no network, account or config is needed.
+"""
+import asyncio
+import os
+import tempfile
+
+WORKDIR = tempfile.mkdtemp(prefix="tg_companion_tests_")
+os.environ.update(
+    APP_ID="1",
+    APP_HASH="0" * 32,
+    SESSION_NAME="tests",
+    EXTRA_SESSIONS="tests_second",
+    DB_URI="sqlite:///" + os.path.join(WORKDIR, "tests.db"),
+    LOG_DIR=os.path.join(WORKDIR, "logs"))
+
+import pytest  # noqa: E402
+from telethon import utils  # noqa: E402
+from telethon.tl import types  # noqa: E402
+
+from tg_companion.benchmark import FakeSender, Workload  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def workload():
+    return Workload()
+
+
+@pytest.fixture(scope="session")
+def second_me():
+    return types.User(1001, is_self=True, access_hash=1001, first_name="Second", username="second")
+
+
+@pytest.fixture(scope="session")
+def client(workload, second_me):
+    """ The `ClientProxy` of the two accounts, each answered by its own `FakeSender` """
+    from tg_companion.tgclient import client
+
+    async def acquire(request):
+        pass
+
+    for account, me in zip(client.accounts, (workload.me, second_me)):
+        account._sender = FakeSender(me)
+        account._self_input_peer = utils.get_input_peer(me, allow_self=False)
+        account._scheduler.acquire = acquire
+    return client
+
+
+@pytest.fixture
+def run():
+    """ Runs a coroutine on the loop of the companion """
+    return asyncio.get_event_loop().run_until_complete
@@ -0,0 +1,28 @@
+import datetime
+
+from telethon import events
+from telethon.tl import types
+
+
+def test_short_messages_use_the_id_of_their_account(client, run, workload, second_me):
+    seen = []
+
+    async def record(event):
+        seen.append((client.account_name, event.sender_id, event.chat_id))
+
+    client.add_event_handler(record, events.NewMessage())
+    try:
+        friend = workload.users[0]
+        for account in client.accounts:
+            update = types.UpdateShortMessage(
+                id=1, user_id=friend.id, message="hello", pts=1, pts_count=1,
+                date=datetime.datetime.now(tz=datetime.timezone.utc), out=True)
+            update._entities = {}
+            run(account._dispatch_update(update))
+    finally:
+        client.remove_event_handler(record, events.NewMessage())
+
+    assert seen == [
+        ("tests", workload.me.id, friend.id),
+        ("tests_second", second_me.id, friend.id),
+    ]
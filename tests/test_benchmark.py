@@ -0,0 +1,62 @@
+import pytest
+from telethon.errors import FloodWaitError
+from telethon.tl import functions, types
+
+from tg_companion import CMD_HANDLER
+from tg_companion.benchmark import (FakeSender, Workload, _parse_mix, report,
+                                    report_stats)
+
+
+def test_the_workload_is_reproducible_and_follows_the_mix():
+    first = [type(update).__name__ for update in Workload(seed=1).updates(50, {"chatter": 1, "private": 1})]
+    second = [type(update).__name__ for update in Workload(seed=1).updates(50, {"chatter": 1, "private": 1})]
+
+    assert first == second
+    assert set(first) == {"UpdateNewChannelMessage", "UpdateNewMessage"}
+
+    workload = Workload(commands=("version",))
+    command = next(workload.updates(1, {"commands": 1}))
+    assert command.message.out and command.message.message == CMD_HANDLER + "version"
+    assert command._entities
+
+
+def test_the_fake_sender_answers_and_counts_locally(run):
+    me = Workload().me
+    sender = FakeSender(me, flood_every=2)
+    history = functions.messages.GetHistoryRequest(types.InputPeerChannel(5000, 1), 0, None, 0, 0, 0, 0, 0)
+
+    assert run(sender.send(functions.users.GetUsersRequest([types.InputUserSelf()]))) == [me]
+    assert run(sender.send(history)).count == 5000 % 10000
+    with pytest.raises(FloodWaitError):
+        run(sender.send(history))
+    assert sender.requests == {"GetUsersRequest": 1, "GetHistoryRequest": 2}
+
+
+def test_the_mix_is_parsed():
+    assert _parse_mix("chatter=60,joins=5") == {"chatter": 60.0, "joins": 5.0}
+    with pytest.raises(ValueError):
+        _parse_mix("spam=1")
+
+
+def test_the_report_compares_with_the_previous_result():
+    result = {
+        "messages": 100, "elapsed": 1.0, "concurrency": 1, "latency": 0.0, "messages_per_second": 110.0,
+        "rpcs_per_message": 0.5, "loop_lag": {"p95": 1.0, "max": 2.0}, "requests": {"SendMessageRequest": 50},
+        "handlers": [{"name": "misc.version", "calls": 10, "errors": 0, "rpcs": 10, "cpu_per_call_ms": 2.0}],
+    }
+    previous = dict(result, messages_per_second=100.0,
+                    handlers=[{"name": "misc.version", "cpu_per_call_ms": 4.0}])
+
+    text = report(result, previous)
+    assert "Messages/s: 110.0 (+10.0%)" in text
+    assert "2.0 (-50.0%)" in text
+
+
+def test_the_stats_report_lists_every_mode():
+    run_result = {"elapsed": 1.0, "requests": 10, "failed": 0, "flood_waits": 0, "final_limit": 8,
+                  "command_p95_ms": 5.0}
+    text = report_stats({"dialogs": 10, "latency": 0.05, "concurrency": 8, "speedup": 4.0, "chunk_size": 50,
+                         "latency_target_ms": 100, "sequential": run_result, "concurrent": run_result,
+                         "chunked": run_result})
+    assert all(mode in text for mode in ("sequential", "concurrent", "chunked"))
+    assert "Speedup: 4.0x" in text
@@ -0,0 +1,60 @@
+from tg_companion import cache
+from tg_companion.cache import TTLCache
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire_after_their_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock)
+    entries = TTLCache(10, 60)
+    entries.set("a", 1)
+    entries.set("b", 2, ttl=120)
+
+    clock.now = 90
+    assert entries.get("a") is None
+    assert entries.get("b") == 2
+    assert "a" not in entries
+    assert entries.stats()["expired"] == 1
+
+
+def test_the_least_recently_used_entry_is_evicted():
+    entries = TTLCache(2, 60)
+    entries.set("a", 1)
+    entries.set("b", 2)
+    entries.get("a")
+    entries.set("c", 3)
+
+    assert entries.keys() == ["a", "c"]
+    assert entries.stats()["evictions"] == 1
+
+
+def test_peek_isnt_counted():
+    entries = TTLCache(2, 60)
+    entries.set("a", 1)
+    assert entries.peek("a") == 1 and entries.peek("b") is None
+    entries.get("a")
+    entries.get("b")
+
+    stats = entries.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_ratio"]) == (1, 1, 0.5)
+
+
+def test_username_lookups_are_counted_once(client, run, workload):
+    account = client.primary
+    user = workload.users[5]
+    account._cache_entity(user)
+    before = account.cache_stats()
+
+    assert run(account.get_entity("@User5")) is user
+
+    after = account.cache_stats()
+    assert after["usernames"]["hits"] - before["usernames"]["hits"] == 1
+    assert (after["entities"]["hits"], after["entities"]["misses"]) == \
+        (before["entities"]["hits"], before["entities"]["misses"])
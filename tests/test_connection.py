@@ -0,0 +1,110 @@
+import datetime
+
+from telethon.tl import functions, types
+
+from tg_companion.connection import ConnectionSupervisor, channel_of
+
+NOW = datetime.datetime.now(datetime.timezone.utc)
+
+
+def message(id, to_id):
+    return types.Message(id, to_id=to_id, date=NOW, message="missed")
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.states = {}
+
+    def process_entities(self, tlo):
+        pass
+
+    def set_update_state(self, entity_id, state):
+        self.states[entity_id] = state
+
+    def get_update_state(self, entity_id):
+        return self.states.get(entity_id)
+
+
+class FakeClient(object):
+    """ Answers the difference requests with the given ones and records the dispatched updates """
+
+    account_name = "fake"
+
+    def __init__(self, differences, channel_differences=None):
+        self.differences = differences
+        self.channel_differences = channel_differences or {}
+        self.session = FakeSession()
+        self._state = types.updates.State(100, 0, NOW, 1, 0)
+        self.dispatched = []
+        self.requested = []
+
+    async def __call__(self, request):
+        if isinstance(request, functions.updates.GetChannelDifferenceRequest):
+            return self.channel_differences[request.channel.channel_id].pop(0)
+        self.requested.append(request.pts)
+        return self.differences.pop(0)
+
+    async def get_input_entity(self, peer):
+        return types.InputPeerChannel(peer.channel_id, 0)
+
+    async def _dispatch_update(self, update):
+        self.dispatched.append(update)
+
+    def request_stats(self):
+        return {"flood_waits": 0}
+
+
+def test_channel_updates_are_told_apart():
+    assert channel_of(types.UpdateNewChannelMessage(message(1, types.PeerChannel(5)), 1, 1)) == 5
+    assert channel_of(types.UpdateChannelTooLong(7)) == 7
+    assert channel_of(types.UpdateNewMessage(message(1, types.PeerUser(5)), 1, 1)) is None
+
+
+def test_the_highest_pts_of_every_channel_is_kept():
+    connection = ConnectionSupervisor(FakeClient([]))
+    for pts in (3, 5, 4):
+        connection.seen(types.UpdateChannelTooLong(7, pts))
+    assert connection.channel_states[7].pts == 5
+    assert connection.client.session.states[7].pts == 5
+
+
+def test_missed_updates_are_replayed_in_batches(run):
+    state = types.updates.State(150, 0, NOW, 2, 0)
+    fake = FakeClient([
+        types.updates.DifferenceSlice([message(1, types.PeerUser(1))], [], [], [], [],
+                                      types.updates.State(120, 0, NOW, 1, 0)),
+        types.updates.Difference([message(2, types.PeerUser(1)), message(3, types.PeerUser(1))], [], [], [], [],
+                                 state),
+    ])
+    connection = ConnectionSupervisor(fake, batch_size=2)
+    run(connection.catch_up())
+
+    assert fake.requested == [100, 120]
+    assert [update.message.id for update in fake.dispatched] == [1, 2, 3]
+    assert fake._state is state and fake.session.states[0] is state
+    assert (connection.catch_ups, connection.replayed, connection.gaps) == (1, 3, 0)
+
+
+def test_too_long_differences_are_counted_as_gaps(run):
+    fake = FakeClient([types.updates.DifferenceTooLong(500)])
+    connection = ConnectionSupervisor(fake)
+    run(connection.catch_up())
+    assert fake._state.pts == 500 and connection.gaps == 1 and not fake.dispatched
+
+
+def test_channels_are_caught_up_on_with_their_own_pts(run):
+    fake = FakeClient(
+        [types.updates.Difference([], [], [types.UpdateChannelTooLong(8), types.UpdateChannelTooLong(9)], [], [],
+                                  types.updates.State(101, 0, NOW, 1, 0))],
+        {7: [types.updates.ChannelDifference(31, [message(4, types.PeerChannel(7))], [], [], [], final=True)],
+         8: [types.updates.ChannelDifferenceEmpty(40, final=True)]})
+    fake.session.states[8] = types.updates.State(40, 0, NOW, 0, 0)
+    connection = ConnectionSupervisor(fake)
+    connection.seen(types.UpdateChannelTooLong(7, 30))
+    run(connection.catch_up())
+
+    channel_messages = [update for update in fake.dispatched if isinstance(update, types.UpdateNewChannelMessage)]
+    assert [update.message.id for update in channel_messages] == [4]
+    assert connection.channel_states[7].pts == 31
+    # Nothing tells where the channel 9 was left
+    assert (connection.channel_catch_ups, connection.channel_gaps) == (2, 1)
@@ -0,0 +1,108 @@
+import sqlalchemy as db
+
+from tg_companion import database
+
+
+def test_drop_if_outdated_only_drops_tables_with_other_columns():
+    old = db.Table("outdated", db.MetaData(), db.Column("updatetime", db.String(), primary_key=True))
+    new = db.Table("outdated", db.MetaData(), db.Column("account", db.String(), primary_key=True),
+                   db.Column("updatetime", db.String()))
+    old.create(bind=database.engine)
+    database.execute(old.insert().values(updatetime="then"))
+
+    database.drop_if_outdated(old)
+    assert database.fetch_all(db.select([old])) == [("then",)]
+
+    database.drop_if_outdated(new)
+    assert not database.engine.has_table("outdated")
+    database.drop_if_outdated(new)
+
+
+notes = db.Table("test_notes", db.MetaData(),
+                 db.Column("name", db.String(), primary_key=True),
+                 db.Column("note", db.String()))
+notes.create(bind=database.engine)
+
+
+def test_upsert_updates_or_inserts():
+    database.upsert(notes, {"name": "upsert"}, note="first")
+    database.upsert(notes, {"name": "upsert"}, note="second")
+
+    assert database.fetch_all(db.select([notes]).where(notes.columns.name == "upsert")) == [("upsert", "second")]
+
+
+def test_upsert_updates_the_row_inserted_by_a_concurrent_call():
+    other = db.create_engine(str(database.engine.url))
+    raced = []
+
+    def race(connection, cursor, statement, parameters, context, executemany):
+        # Another process inserts the row after the update found nothing
+        if statement.startswith("UPDATE test_notes") and not raced:
+            raced.append(statement)
+            with other.begin() as other_connection:
+                other_connection.execute(notes.insert().values(name="raced", note="first"))
+            statement = statement.replace("WHERE", "WHERE 0 AND")
+        return statement, parameters
+
+    db.event.listen(database.engine, "before_cursor_execute", race, retval=True)
+    try:
+        database.upsert(notes, {"name": "raced"}, note="second")
+    finally:
+        db.event.remove(database.engine, "before_cursor_execute", race)
+        other.dispose()
+
+    assert raced
+    assert database.fetch_all(db.select([notes]).where(notes.columns.name == "raced")) == [("raced", "second")]
+
+
+def test_insert_many_and_execute_return_the_rows_affected():
+    assert database.insert_many(notes, []) == 0
+    assert database.insert_many(notes, [{"name": "many 1", "note": "a"}, {"name": "many 2", "note": "b"}]) == 2
+    assert database.execute(notes.delete().where(notes.columns.name.like("many %"))) == 2
+    assert database.fetch_one(db.select([notes]).where(notes.columns.name.like("many %"))) is None
+
+
+def test_transactions_are_rolled_back_on_errors():
+    try:
+        with database.transaction() as connection:
+            connection.execute(notes.insert().values(name="rolled back", note="a"))
+            raise RuntimeError("boom")
+    except RuntimeError:
+        pass
+
+    assert database.fetch_one(db.select([notes]).where(notes.columns.name == "rolled back")) is None
+
+
+def test_reloader_loads_the_changes_of_other_processes(run):
+    database.upsert(notes, {"name": "shared"}, note="first")
+    shared = {}
+    reloader = database.Reloader(lambda: dict(database.fetch_all(db.select([notes]))), shared, ttl=60)
+    assert shared["shared"] == "first"
+
+    async def reload():
+        reloader.refresh()
+        assert reloader._task is None
+        reloader.loaded -= 60
+        reloader.refresh()
+        await reloader._task
+
+    database.upsert(notes, {"name": "shared"}, note="second")
+    run(reload())
+    assert shared["shared"] == "second"
+    assert reloader.reloads == 1
+
+
+def test_reloader_keeps_the_local_changes_made_during_a_reload(run):
+    shared = set()
+    reloader = database.Reloader(set, shared, ttl=60)
+
+    async def reload():
+        reloader.loaded -= 60
+        reloader.refresh()
+        shared.add("local")
+        reloader.changed()
+        await reloader._task
+
+    run(reload())
+    assert shared == {"local"}
+    assert reloader.reloads == 0
@@ -0,0 +1,162 @@
+import datetime
+
+import pytest
+
+from telethon import utils
+from telethon.tl import functions, types
+
+from tg_companion.dialogs import SUPERGROUP, UNCHANGED_STREAK, DialogIndex
+
+NOW = datetime.datetime.now(datetime.timezone.utc)
+
+
+class Dialog(object):
+    """ The fields of a Telethon `Dialog` the index reads """
+
+    def __init__(self, entity, top_message, unread_count=0, unread_mentions_count=0, pinned=False):
+        self.entity = entity
+        self.id = utils.get_peer_id(entity)
+        self.input_entity = utils.get_input_peer(entity)
+        self.dialog = types.Dialog(utils.get_peer(entity), top_message, 0, 0, unread_count, unread_mentions_count,
+                                   types.PeerNotifySettings())
+        self.date = datetime.datetime.fromtimestamp(top_message, tz=datetime.timezone.utc)
+        self.unread_count = unread_count
+        self.unread_mentions_count = unread_mentions_count
+        self.pinned = pinned
+
+
+class Client(object):
+    _self_input_peer = types.InputPeerUser(1000, 1000)
+
+    def __init__(self, dialogs, account_name="dialogs"):
+        self.dialogs = dialogs
+        self.account_name = account_name
+        self.iterated = 0
+        # dialog id -> (unread, mentions) answered by `GetPeerDialogsRequest`
+        self.counters = {}
+        self.requested = []
+
+    async def iter_dialogs(self, limit=None):
+        for dialog in self.dialogs:
+            self.iterated += 1
+            yield dialog
+
+    async def __call__(self, request):
+        assert isinstance(request, functions.messages.GetPeerDialogsRequest)
+        ids = [utils.get_peer_id(peer.peer) for peer in request.peers]
+        self.requested.append(ids)
+        dialogs = [types.Dialog(utils.get_peer(types.PeerUser(dialog_id)), 20, 0, 0, *self.counters[dialog_id],
+                                types.PeerNotifySettings()) for dialog_id in ids]
+        return types.messages.PeerDialogs(dialogs, [], [], [], None)
+
+
+def _user(user_id):
+    return types.User(user_id, access_hash=user_id, first_name=f"User {user_id}")
+
+
+def test_mentions_are_counted_until_they_are_read(index, run):
+    run(index.on_update(types.UpdateShortMessage(20, 2, "@me", 1, 1, NOW, mentioned=True)))
+    assert (index.get(2).unread, index.get(2).mentions) == (1, 1)
+
+    # Reading the history doesn't read the mentions
+    run(index.on_update(types.UpdateReadHistoryInbox(types.PeerUser(2), 20, 1, 1)))
+    assert (index.get(2).unread, index.get(2).mentions) == (0, 1)
+    index.read(2)
+    assert index.get(2).mentions == 0
+
+
+def test_only_the_dialogs_marked_unread_are_fetched_again(index, run):
+    run(index.on_update(types.UpdateShortMessage(20, 2, "hi", 1, 1, NOW)))
+    iterated = index.client.iterated
+    # Telegram knows of a mention the updates didn't tell about
+    index.client.counters[2] = (3, 1)
+
+    assert [(dialog.id, dialog.unread, dialog.mentions) for dialog in run(index.unread())] == [(2, 3, 1)]
+    assert index.client.iterated == iterated
+    assert index.client.requested == [[2]]
+
+
+def test_a_stale_index_is_synced_to_find_the_unread_dialogs(index, run):
+    index.synced = 0.0
+    index.client.dialogs.append(Dialog(_user(5), 1, unread_count=2))
+
+    assert [dialog.id for dialog in run(index.unread())] == [5]
+    assert index.crawls == 2 and index.client.requested == []
+
+
+def _channel(channel_id, **kwargs):
+    return types.Channel(channel_id, f"Channel {channel_id}", types.ChatPhotoEmpty(), NOW, 1, megagroup=True,
+                         access_hash=channel_id, **kwargs)
+
+
+@pytest.fixture
+def index(run, request):
+    index = DialogIndex(Client([Dialog(_user(1), 10), Dialog(_user(2), 5)], account_name=request.node.name))
+    run(index.load())
+    yield index
+    index.close()
+
+
+def test_new_messages_move_their_dialog_to_the_top(index, run):
+    run(index.on_update(types.UpdateShortMessage(20, 2, "hi", 1, 1, NOW)))
+    dialogs = run(index.dialogs())
+    assert [dialog.id for dialog in dialogs] == [2, 1]
+    assert (dialogs[0].top_message, dialogs[0].unread) == (20, 1)
+
+    run(index.on_update(types.UpdateReadHistoryInbox(types.PeerUser(2), 20, 1, 1)))
+    assert index.get(2).unread == 0
+    run(index.on_update(types.UpdateShortMessage(21, 1, "hi", 1, 1, NOW, out=True)))
+    assert index.get(1).unread == 0 and index.get(1).top_message == 21
+
+
+def test_messages_from_unknown_dialogs_refresh_the_index(index, run):
+    iterated = index.client.iterated
+    run(index.on_update(types.UpdateShortMessage(30, 3, "hi", 1, 1, NOW)))
+    assert index.get(3) is None and index.client.iterated == iterated
+
+    index.client.dialogs.insert(0, Dialog(_user(3), 30))
+    assert run(index.dialogs())[0].id == 3
+
+
+def test_joined_and_left_channels(index, run):
+    channel = _channel(4000)
+    dialog_id = utils.get_peer_id(channel)
+    message = types.Message(31, to_id=types.PeerChannel(4000), date=NOW, message="welcome")
+    update = types.UpdateNewChannelMessage(message, 1, 1)
+    update._entities = {dialog_id: channel}
+    run(index.on_update(update))
+    assert (index.get(dialog_id).kind, index.get(dialog_id).top_message) == (SUPERGROUP, 31)
+
+    update = types.UpdateChannel(4000)
+    update._entities = {dialog_id: _channel(4000, left=True)}
+    run(index.on_update(update))
+    assert index.get(dialog_id) is None
+
+
+def test_refreshes_stop_at_the_dialogs_which_didnt_change(run):
+    client = Client([Dialog(_user(user_id), 100 - user_id) for user_id in range(1, 30)],
+                    account_name="dialogs_refresh")
+    index = DialogIndex(client)
+    run(index.load())
+    client.iterated = 0
+    client.dialogs[0] = Dialog(_user(1), 200)
+
+    run(index.refresh())
+    assert client.iterated == 1 + UNCHANGED_STREAK
+    assert index.get(1).top_message == 200
+    index.close()
+
+
+def test_the_index_is_saved_and_loaded_again(run):
+    index = DialogIndex(Client([Dialog(_user(1), 10, unread_count=3), Dialog(_user(2), 5)],
+                               account_name="dialogs_saved"))
+    run(index.load())
+    index.close()
+    assert index.pending == 0
+
+    loaded = DialogIndex(Client([], account_name="dialogs_saved"))
+    run(loaded.load())
+    assert [(dialog.id, dialog.unread) for dialog in run(loaded.dialogs())] == [(1, 3), (2, 0)]
+    # A saved index is only refreshed
+    assert (loaded.crawls, loaded.refreshes) == (0, 1)
+    loaded.close()
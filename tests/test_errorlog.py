@@ -0,0 +1,67 @@
+import atexit
+import logging
+import os
+import queue
+
+import pytest
+
+from tg_companion.errorlog import ErrorLog, _BoundedQueueHandler
+
+
+@pytest.fixture
+def error_log(tmp_path):
+    error_log = ErrorLog(str(tmp_path), repr_limit=20)
+    yield error_log
+    if error_log._listener is not None:
+        atexit.unregister(error_log._listener.stop)
+        if error_log._listener._thread is not None:
+            error_log._listener.stop()
+        for handler in error_log._logger.handlers[:]:
+            error_log._logger.removeHandler(handler)
+
+
+def _fail(value):
+    # A large local, cut in the report
+    big = "x" * 1000
+    raise ValueError(value + big[:0])
+
+
+def _log(error_log, value="boom"):
+    try:
+        _fail(value)
+    except ValueError as exc:
+        error_log.log(exc, "handler")
+
+
+def _written(error_log):
+    error_log._listener.stop()
+    with open(os.path.join(error_log.directory, "errors.log"), encoding="utf-8") as log_file:
+        return log_file.read()
+
+
+def test_repeated_exceptions_are_written_once_per_window(error_log):
+    for _ in range(3):
+        _log(error_log)
+    assert error_log.stats() == {"written": 1, "deduplicated": 2, "dropped": 0}
+
+    error_log.dedup_window = 0
+    _log(error_log)
+    text = _written(error_log)
+    assert text.count("handler: Exception thrown") == 2
+    assert "Repeated 2 times since it was last written" in text
+
+
+def test_locals_are_cut_to_the_repr_limit(error_log):
+    _log(error_log)
+    text = _written(error_log)
+    assert "in _fail" in text
+    assert "x" * 1000 not in text and "big = 'xxxxxxx...xxxxxxxx'" in text
+
+
+def test_records_are_dropped_when_the_queue_is_full(error_log):
+    handler = _BoundedQueueHandler(queue.Queue(1), error_log)
+    record = logging.LogRecord("tg_companion.errors", logging.ERROR, __file__, 1, "error", None, None)
+    # Nothing reads the queue, only the first record fits
+    handler.enqueue(record)
+    handler.enqueue(record)
+    assert error_log.stats()["dropped"] == 1
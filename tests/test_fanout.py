@@ -0,0 +1,73 @@
+import asyncio
+
+from telethon.errors import FloodWaitError
+
+from tg_companion.fanout import AdaptiveLimit, Cooperator, fan_out
+
+
+def test_results_are_returned_in_order_under_the_limit(run):
+    limit = AdaptiveLimit(2)
+    running = []
+    most = []
+
+    async def double(item):
+        running.append(item)
+        most.append(len(running))
+        await asyncio.sleep(0.01 * (5 - item))
+        running.remove(item)
+        if item == 3:
+            raise ValueError(item)
+        return item * 2
+
+    results = run(fan_out(double, range(5), limit))
+    assert results[:3] == [0, 2, 4] and isinstance(results[3], ValueError) and results[4] == 8
+    assert max(most) == 2 and limit.active == 0
+
+
+def test_flood_waits_shrink_the_limit_until_calls_succeed_again(run):
+    limit = AdaptiveLimit(4, increase_after=2)
+
+    async def flood(item):
+        if item == 0:
+            raise FloodWaitError(None, capture=1)
+        return item
+
+    results = run(fan_out(flood, [0], limit))
+    assert isinstance(results[0], FloodWaitError)
+    assert (limit.limit, limit.flood_waits) == (2, 1)
+
+    run(fan_out(flood, [1, 2, 3], limit))
+    assert limit.limit == 3
+
+
+def test_flood_waits_retried_by_the_client_are_counted_too(run):
+    flood_waits = [0]
+    limit = AdaptiveLimit(4, flood_waits=lambda: flood_waits[0])
+
+    async def retried(item):
+        flood_waits[0] += 1
+        return item
+
+    run(fan_out(retried, [1], limit))
+    assert (limit.limit, limit.flood_waits) == (2, 1)
+
+
+def test_the_cooperator_waits_while_commands_run(run):
+    busy = [3]
+
+    def commands_running():
+        busy[0] -= 1
+        return busy[0] >= 0
+
+    cooperator = Cooperator(1.0, busy=commands_running, poll=0.001)
+    run(cooperator.pause())
+    assert (cooperator.chunks, cooperator.yields) == (1, 3)
+
+    run(cooperator.pause())
+    assert cooperator.stats()["chunks"] == 2 and cooperator.yields == 3
+
+
+def test_the_cooperator_doesnt_wait_forever(run):
+    cooperator = Cooperator(1.0, busy=lambda: True, max_wait=0.02, poll=0.005)
+    run(cooperator.pause())
+    assert cooperator.yields > 0 and cooperator.waited < 1
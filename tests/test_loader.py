@@ -0,0 +1,109 @@
+import datetime
+import json
+import os
+import sys
+import textwrap
+
+from telethon.tl import types
+
+from tg_companion import CMD_HANDLER
+from tg_companion.loader import MANIFEST_VERSION, ModuleLoader
+
+COMMAND_MODULE = """
+    from tg_companion.tgclient import client
+
+    CALLS = []
+
+
+    @client.CommandHandler(outgoing=True, command="{command}", help="{command} help")
+    async def {command}(event):
+        CALLS.append(event.raw_text)
+"""
+
+PASSIVE_MODULE = """
+    from telethon import events
+
+    from tg_companion.tgclient import client
+
+
+    @client.on(events.Raw())
+    async def passive(update):
+        pass
+"""
+
+
+def _package(tmp_path, monkeypatch, name, modules):
+    package = tmp_path / name
+    package.mkdir()
+    (package / "__init__.py").write_text("")
+    for module, source in modules.items():
+        (package / f"{module}.py").write_text(textwrap.dedent(source))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    return [f"{name}.{module}" for module in modules]
+
+
+def _command(account, text, out=True):
+    update = types.UpdateShortMessage(
+        id=1, user_id=2000, message=text, pts=1, pts_count=1,
+        date=datetime.datetime.now(tz=datetime.timezone.utc), out=out)
+    update._entities = {}
+    return account._dispatch_update(update)
+
+
+def test_the_manifest_tells_command_only_modules_apart(client, tmp_path, monkeypatch):
+    names = _package(tmp_path, monkeypatch, "built_modules", {
+        "commands": COMMAND_MODULE.format(command="builtping"), "passive": PASSIVE_MODULE})
+    monkeypatch.setattr(client.modules, "path", str(tmp_path / "manifest.json"))
+
+    client.modules.load(names)
+
+    assert all(name in sys.modules for name in names)
+    with open(tmp_path / "manifest.json") as manifest_file:
+        manifest = json.load(manifest_file)
+    commands, passive = (manifest["modules"][name] for name in names)
+    assert (commands["eager"], commands["commands"], commands["help"]) == (False, ["builtping"],
+                                                                          {"builtping": "builtping help"})
+    assert commands["filters"] == {"builtping": [{"outgoing": True}]}
+    assert passive["eager"] is True
+    # No temporary file is left behind
+    assert sorted(os.listdir(str(tmp_path))) == ["built_modules", "manifest.json"]
+
+
+def test_command_only_modules_are_imported_by_their_first_command(client, run, tmp_path, monkeypatch):
+    name, = _package(tmp_path, monkeypatch, "lazy_modules", {"commands": COMMAND_MODULE.format(command="lazyping")})
+    path = str(tmp_path / "manifest.json")
+    with open(path, "w") as manifest_file:
+        json.dump({"version": MANIFEST_VERSION, "modules": {name: {
+            "eager": False, "commands": ["lazyping"], "edited_commands": [],
+            "filters": {"lazyping": [{"outgoing": True}]}, "help": {"lazyping": "lazy help"},
+            "mtime": os.path.getmtime(str(tmp_path / "lazy_modules" / "commands.py"))}}}, manifest_file)
+    cmd_help = {}
+    loader = ModuleLoader(client, cmd_help, path)
+
+    loader.load([name])
+    assert name not in sys.modules
+    assert loader.lazy == {name} and cmd_help == {"lazyping": "lazy help"}
+
+    account = client.primary
+    # Someone else using the command doesn't import the module
+    run(_command(account, CMD_HANDLER + "lazyping", out=False))
+    assert name not in sys.modules
+
+    run(_command(account, CMD_HANDLER + "lazyping"))
+    run(_command(account, CMD_HANDLER + "lazyping again"))
+
+    assert sys.modules[name].CALLS == [CMD_HANDLER + "lazyping", CMD_HANDLER + "lazyping again"]
+    assert loader.lazy == set()
+    # Only the handler of the module is left
+    assert len(account._commands.lookup(CMD_HANDLER + "lazyping")) == 1
+
+
+def test_a_changed_module_rebuilds_the_manifest(client, tmp_path, monkeypatch):
+    name, = _package(tmp_path, monkeypatch, "changed_modules", {"passive": PASSIVE_MODULE})
+    path = str(tmp_path / "manifest.json")
+    with open(path, "w") as manifest_file:
+        json.dump({"version": MANIFEST_VERSION, "modules": {name: {
+            "eager": False, "commands": [], "edited_commands": [], "filters": {}, "help": {}, "mtime": 0}}},
+            manifest_file)
+
+    assert ModuleLoader(client, {}, path)._read_manifest([name]) is None
@@ -0,0 +1,53 @@
+import pytest
+
+from tg_companion.metrics import Histogram, Metrics
+
+
+def test_quantiles_are_interpolated_in_their_bucket():
+    histogram = Histogram()
+    for value in (0.001, 0.002, 0.003, 0.004, 0.2):
+        histogram.observe(value)
+
+    assert histogram.count == 5 and histogram.sum == pytest.approx(0.21)
+    assert histogram.quantile(0.5) == pytest.approx(0.005 * 2.5 / 4)
+    assert 0.1 < histogram.quantile(0.99) <= 0.25
+    assert Histogram().quantile(0.5) == 0.0
+
+
+def test_handlers_are_timed_and_their_requests_counted(run):
+    metrics = Metrics()
+
+    async def handler(fail):
+        Metrics.count_requests(2)
+        if fail:
+            raise RuntimeError("boom")
+
+    timed = metrics.wrap(handler)
+    assert metrics.wrap(timed) is timed
+    run(timed(False))
+    with pytest.raises(RuntimeError):
+        run(timed(True))
+    # Requests sent outside of a handler aren't counted
+    Metrics.count_requests()
+
+    handler_metrics, = metrics.handlers()
+    assert handler_metrics.name == "test_metrics.handler"
+    assert (handler_metrics.calls, handler_metrics.errors, handler_metrics.rpcs) == (2, 1, 4)
+    assert handler_metrics.latency.count == 2
+
+
+def test_the_metrics_are_rendered_for_prometheus(run):
+    metrics = Metrics()
+
+    async def handler():
+        pass
+
+    run(metrics.wrap(handler)())
+    metrics.gauge("answer", lambda: 42, "The answer")
+    metrics.gauge("broken", lambda: 1 / 0, "Never shown")
+    text = metrics.render()
+
+    assert 'tg_companion_handler_duration_seconds_bucket{handler="test_metrics.handler",le="+Inf"} 1' in text
+    assert 'tg_companion_handler_calls_total{handler="test_metrics.handler"} 1' in text
+    assert "# TYPE tg_companion_answer gauge\ntg_companion_answer 42" in text
+    assert "broken" not in text
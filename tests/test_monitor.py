@@ -0,0 +1,46 @@
+import asyncio
+import threading
+import time
+
+from tg_companion.database import AsyncDatabase
+from tg_companion.monitor import LoopLagMonitor
+
+
+def test_queries_run_off_the_event_loop(run):
+    aio = AsyncDatabase(2)
+    ticks = []
+
+    def query():
+        time.sleep(0.1)
+        return threading.current_thread().name
+
+    async def tick():
+        for _ in range(5):
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+
+    async def both():
+        return await asyncio.gather(aio.run(query), tick())
+
+    thread, _ = run(both())
+    assert thread.startswith("database")
+    # The loop kept running while the query slept
+    assert len(ticks) == 5 and ticks[-1] - ticks[0] < 0.1
+    stats = aio.stats()
+    assert (stats["calls"], stats["pending"]) == (1, 0) and stats["max_time"] >= 0.1
+
+
+def test_the_lag_of_a_blocked_loop_is_measured(run):
+    monitor = LoopLagMonitor(interval=0.01)
+
+    async def block():
+        monitor.start()
+        await asyncio.sleep(0.02)
+        time.sleep(0.1)
+        await asyncio.sleep(0.03)
+        monitor.stop()
+
+    run(block())
+    stats = monitor.stats()
+    assert stats["samples"] >= 2
+    assert stats["max"] >= 80
@@ -0,0 +1,67 @@
+from telethon.tl import types
+
+from tg_companion.permissions import ChatAdmins
+
+
+def _channel(admin_rights=None):
+    return types.Channel(3000, "Group", types.ChatPhotoEmpty(), None, 1, megagroup=True, access_hash=3000,
+                         admin_rights=admin_rights)
+
+
+def _members(*participants):
+    members = []
+    for participant in participants:
+        user = types.User(participant.user_id, first_name=str(participant.user_id))
+        user.participant = participant
+        members.append(user)
+    return members
+
+
+def test_permissions_are_cached_until_the_chat_changes(client, run):
+    account = client.accounts[0]
+    promoted = _channel(types.ChatAdminRights(ban_users=True))
+
+    assert run(account.get_permissions(promoted)).can("ban_users")
+    hits = account._permissions_cache.hits
+    assert run(account.get_permissions(-1003000)) is not None
+    assert run(account.get_permissions(promoted)).can("ban_users")
+    assert account._permissions_cache.hits == hits + 2
+
+    # The chat given is newer than the cached rights
+    demoted = run(account.get_permissions(_channel()))
+    assert not demoted.is_admin and not demoted.can("ban_users")
+    assert "permissions" in account.cache_stats()
+
+
+def test_permissions_are_dropped_by_the_updates(client, run):
+    account = client.accounts[0]
+    run(account.get_permissions(_channel(types.ChatAdminRights(ban_users=True))))
+
+    update = types.UpdateNewChannelMessage(types.MessageEmpty(1), 1, 1)
+    update._entities = {-1003000: _channel()}
+    run(account._refresh_entity_cache(update))
+    assert account._permissions_cache.peek(-1003000) is None
+
+    run(account.get_permissions(_channel()))
+    run(account._refresh_entity_cache(types.UpdateChannel(3000)))
+    assert account._permissions_cache.peek(-1003000) is None
+
+
+def test_chat_admins_of_basic_groups_skip_the_members():
+    # Basic groups ignore the admins filter, every member is listed
+    members = _members(types.ChatParticipant(1, 2, None), types.ChatParticipantCreator(2),
+                       types.ChatParticipantAdmin(3, 2, None))
+
+    admins = ChatAdmins.from_participants(members)
+    assert (admins.creator_id, admins.admin_ids) == (2, {2, 3})
+    assert ChatAdmins.from_participants(members[:1]).creator_id is None
+
+
+def test_chat_admins_follow_the_admin_changes(client, run):
+    account = client.accounts[0]
+    account._admins_cache.set(-40, ChatAdmins.from_participants(_members(
+        types.ChatParticipantCreator(2), types.ChatParticipantAdmin(3, 2, None))))
+
+    run(account._refresh_entity_cache(types.UpdateChatParticipantAdmin(40, 4, True, 1)))
+    run(account._refresh_entity_cache(types.UpdateChatParticipantAdmin(40, 3, False, 2)))
+    assert account._admins_cache.peek(-40).admin_ids == {2, 4}
@@ -0,0 +1,58 @@
+from tg_companion.pipeline import PassivePipeline
+
+
+class Message(object):
+    def __init__(self, out):
+        self.out = out
+
+
+class Event(object):
+    def __init__(self, chat_id, out=False):
+        self.chat_id = chat_id
+        self.message = Message(out)
+
+
+def test_the_first_rejecting_stage_skips_the_handler(run):
+    calls = []
+    checked = []
+
+    def in_group(event):
+        checked.append(event.chat_id)
+        return event.chat_id < 0
+
+    async def handler(event):
+        calls.append(event.chat_id)
+
+    pipeline = PassivePipeline()
+    pipeline.add(handler, pipeline.build_stages(incoming=True, checks=(in_group,)))
+    for event in (Event(-1), Event(-2, out=True), Event(3)):
+        run(pipeline.dispatch(event))
+
+    assert calls == [-1]
+    # The outgoing message never reached the check
+    assert checked == [-1, 3]
+    assert pipeline.stats() == [("handler", 1, [("incoming", 2, 1), ("in_group", 1, 1)])]
+
+
+def test_incoming_and_outgoing_together_dont_filter():
+    assert PassivePipeline.build_stages(incoming=True, outgoing=True) == []
+    assert [stage.name for stage in PassivePipeline.build_stages(outgoing=True, func=bool)] == ["outgoing", "func"]
+
+
+def test_a_failing_handler_doesnt_stop_the_others(run):
+    calls = []
+
+    async def fail(event):
+        raise RuntimeError("boom")
+
+    async def record(event):
+        calls.append(event.chat_id)
+
+    pipeline = PassivePipeline()
+    pipeline.add(fail, [])
+    pipeline.add(record, [])
+    run(pipeline.dispatch(Event(1)))
+
+    assert calls == [1]
+    assert pipeline.remove(fail) == 1
+    assert [name for name, _, _ in pipeline.stats()] == ["record"]
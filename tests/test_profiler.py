@@ -0,0 +1,33 @@
+import json
+
+from tg_companion.profiler import StartupProfiler
+
+
+def test_phases_are_nested_and_timed(tmp_path):
+    profiler = StartupProfiler()
+    with profiler.phase("connect"):
+        with profiler.phase("authorize"):
+            pass
+    try:
+        with profiler.phase("failed"):
+            raise RuntimeError("boom")
+    except RuntimeError:
+        pass
+    profiler.ready()
+
+    phases = [(phase["name"], phase["depth"]) for phase in profiler.phases]
+    assert phases == [("connect", 0), ("authorize", 1), ("failed", 0)]
+    assert all(phase["duration"] is not None for phase in profiler.phases)
+    assert profiler.slowest(1)[0]["name"] in ("connect", "failed")
+    assert profiler.report()["ready_after"] >= profiler.phases[0]["start"]
+
+    path = tmp_path / "logs" / "startup.json"
+    profiler.write(str(path))
+    assert json.loads(path.read_text())["phases"][1]["name"] == "authorize"
+
+
+def test_the_package_reexports_the_startup_profiler():
+    import tg_companion
+    from tg_companion import profiler
+
+    assert tg_companion.startup is profiler.startup
@@ -0,0 +1,140 @@
+import asyncio
+
+import pytest
+from telethon.errors import FloodWaitError
+from telethon.tl import functions, types
+
+from tg_companion import FLOOD_WAIT_THRESHOLD, ratelimit
+from tg_companion.ratelimit import (BACKGROUND, PRIORITY, RequestScheduler,
+                                    TokenBucket, background, parse_limits)
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock)
+    return clock
+
+
+def _send(chat_id):
+    return functions.messages.SendMessageRequest(types.InputPeerChat(chat_id), "hello")
+
+
+def test_a_bucket_allows_its_burst_then_its_rate(clock):
+    bucket = TokenBucket(2, 3)
+    for _ in range(3):
+        assert bucket.delay() == 0
+        bucket.take()
+    assert bucket.delay() == pytest.approx(0.5)
+
+    clock.now += 0.5
+    assert bucket.delay() == 0
+
+
+def test_flood_waits_block_the_bucket(clock):
+    bucket = TokenBucket(10, 10)
+    bucket.block(30)
+    assert bucket.delay() == pytest.approx(30)
+
+
+def test_the_background_lane_leaves_a_share_to_the_commands(clock):
+    bucket = TokenBucket(1, 10)
+    bucket.tokens = 3
+    assert bucket.delay() == 0
+    assert bucket.delay(reserve=3) == pytest.approx(1)
+
+
+def test_sends_are_limited_per_chat(clock, run):
+    scheduler = RequestScheduler(limits={"chat": (1, 1)})
+    run(scheduler.acquire(_send(1)))
+    assert max(bucket.delay() for bucket in scheduler._buckets(_send(1))) == pytest.approx(1)
+    assert max(bucket.delay() for bucket in scheduler._buckets(_send(2))) == 0
+
+
+def test_background_requests_are_counted_in_their_lane(run):
+    scheduler = RequestScheduler()
+
+    async def acquire():
+        with background():
+            assert PRIORITY.get() == BACKGROUND
+            await scheduler.acquire(_send(1))
+
+    run(acquire())
+    run(scheduler.acquire(_send(2)))
+    assert scheduler.stats()["requests"] == {"interactive": 1, "background": 1}
+
+
+def test_rate_limits_override_the_defaults():
+    assert parse_limits("send=5/10, chat=0.5/2,") == {"send": (5.0, 10), "chat": (0.5, 2)}
+    assert parse_limits("") == {}
+    scheduler = RequestScheduler(limits=parse_limits("resolve=0.1/1,chat=2/4"))
+    assert scheduler._methods["resolve"].capacity == 1
+    assert scheduler._chat_limit == (2.0, 4)
+
+    for invalid in ("unknown=1/1", "send=fast/10", "send=0/10"):
+        with pytest.raises(ValueError):
+            parse_limits(invalid)
+
+
+class FloodingSender(object):
+    """ Answers the history requests with the queued flood waits, then with an empty history """
+
+    def __init__(self, *seconds):
+        self.seconds = list(seconds)
+        self.sent = 0
+
+    def is_connected(self):
+        return True
+
+    def send(self, request, ordered=False):
+        self.sent += 1
+        future = asyncio.get_event_loop().create_future()
+        if self.seconds:
+            future.set_exception(FloodWaitError(request, capture=self.seconds.pop(0)))
+        else:
+            future.set_result(types.messages.Messages([], [], []))
+        return future
+
+
+def _history():
+    return functions.messages.GetHistoryRequest(types.InputPeerSelf(), 0, None, 0, 1, 0, 0, 0)
+
+
+@pytest.fixture
+def flooding(client):
+    account = client.primary
+    sender = account._sender
+    yield account
+    account._sender = sender
+    # Telethon raises the flood waits it saw again until they end
+    account._flood_waited_requests.clear()
+    for bucket in account._scheduler._methods.values():
+        bucket.blocked_until = 0.0
+
+
+def test_short_flood_waits_are_retried(flooding, run):
+    flooding._sender = FloodingSender(1, 2)
+    flood_waits = flooding._scheduler.flood_waits
+
+    result = run(flooding(_history()))
+    assert isinstance(result, types.messages.Messages)
+    assert flooding._sender.sent == 3
+    assert flooding._scheduler.flood_waits == flood_waits + 2
+
+
+def test_long_flood_waits_are_raised(flooding, run):
+    flooding._sender = FloodingSender(FLOOD_WAIT_THRESHOLD + 1)
+
+    with pytest.raises(FloodWaitError):
+        run(flooding(_history()))
+    assert flooding._sender.sent == 1
+    # The other requests of the same kind wait for the flood wait too
+    assert flooding._scheduler._methods["history"].delay() > FLOOD_WAIT_THRESHOLD
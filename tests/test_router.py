@@ -0,0 +1,121 @@
+import datetime
+
+import pytest
+from telethon import events
+from telethon.tl import types
+
+from tg_companion import CMD_HANDLER
+from tg_companion.router import CommandRouter
+
+
+class Builder(object):
+    """ Stands in for a `NewMessage` builder, letting through the texts matching `accept` """
+
+    def __init__(self, accept=lambda text: True):
+        self.resolved = False
+        self.accept = accept
+
+    async def resolve(self, client):
+        self.resolved = True
+
+    def filter(self, event):
+        return self.accept(event.message.message)
+
+
+class Message(object):
+    def __init__(self, message):
+        self.message = message
+
+
+class Event(object):
+    def __init__(self, text):
+        self.message = Message(text)
+
+
+def _recorder(calls, name):
+    async def callback(event):
+        calls.append((name, event.message.message))
+    return callback
+
+
+def test_commands_are_looked_up_by_their_first_word():
+    assert CommandRouter.command_name("cuname (.+)") == "cuname"
+    with pytest.raises(ValueError):
+        CommandRouter.command_name("(.+)")
+
+    router = CommandRouter()
+    router.add("ban", Builder(), None)
+    router.add("banall", Builder(), None)
+    assert router.commands() == ["ban", "banall"]
+    assert len(router.lookup(CMD_HANDLER + "ban @user")) == 1
+    assert router.lookup("ban @user") == ()
+    assert router.lookup(CMD_HANDLER + "unknown") == ()
+    assert router.lookup(None) == ()
+
+
+def test_only_the_routes_whose_builder_matches_run(run):
+    calls = []
+    router = CommandRouter()
+    plain = Builder(lambda text: text == CMD_HANDLER + "note")
+    with_args = Builder(lambda text: text.startswith(CMD_HANDLER + "note "))
+    router.add("note", plain, _recorder(calls, "list"))
+    router.add("note (.+)", with_args, _recorder(calls, "get"))
+
+    run(router.dispatch(None, Event(CMD_HANDLER + "note todo")))
+    run(router.dispatch(None, Event(CMD_HANDLER + "note")))
+    run(router.dispatch(None, Event("note")))
+
+    assert plain.resolved and with_args.resolved
+    assert calls == [("get", CMD_HANDLER + "note todo"), ("list", CMD_HANDLER + "note")]
+
+
+def test_a_failing_route_doesnt_stop_the_others_but_stop_propagation_does(run):
+    calls = []
+    router = CommandRouter()
+
+    async def fail(event):
+        raise RuntimeError("boom")
+
+    async def stop(event):
+        raise events.StopPropagation
+
+    router.add("cmd", Builder(), fail)
+    router.add("cmd", Builder(), _recorder(calls, "after"))
+    run(router.dispatch(None, Event(CMD_HANDLER + "cmd")))
+    assert calls == [("after", CMD_HANDLER + "cmd")]
+
+    router.add("stop", Builder(), stop)
+    router.add("stop", Builder(), _recorder(calls, "never"))
+    with pytest.raises(events.StopPropagation):
+        run(router.dispatch(None, Event(CMD_HANDLER + "stop")))
+    assert len(calls) == 1
+
+
+def test_removed_callbacks_drop_their_route():
+    router = CommandRouter()
+    callback = _recorder([], "removed")
+    router.add("a", Builder(), callback)
+    router.add("a (.+)", Builder(), callback)
+    router.add("b", Builder(), _recorder([], "kept"))
+
+    assert router.remove(callback) == 2
+    assert router.commands() == ["b"]
+
+
+def test_command_handlers_run_when_their_checks_pass(client, run, workload):
+    account = client.primary
+    friend, stranger = workload.users[:2]
+    calls = []
+
+    @account.CommandHandler(command="routed (.+)", checks=(lambda event: event.chat_id == friend.id,))
+    async def routed(event):
+        calls.append(event.pattern_match.group(1))
+
+    for user in (friend, stranger):
+        update = types.UpdateShortMessage(
+            id=1, user_id=user.id, message=CMD_HANDLER + f"routed {user.first_name}", pts=1, pts_count=1,
+            date=datetime.datetime.now(tz=datetime.timezone.utc), out=True)
+        update._entities = {}
+        run(account._dispatch_update(update))
+
+    assert calls == [friend.first_name]
@@ -0,0 +1,156 @@
+import asyncio
+import time
+
+from tg_companion.scheduler import RUN_ONCE, SKIP, Job, JobScheduler
+
+
+def test_each_account_keeps_its_own_last_runs(client, run):
+    for last_run, account in enumerate(client.accounts, 1):
+        job = Job("shared", None, 60)
+        job.last_run = float(last_run)
+        run(account.jobs._save_last_run(job, started=None))
+
+    assert [account.jobs._load_last_runs()["shared"][0] for account in client.accounts] == [1.0, 2.0]
+
+
+def test_a_run_interrupted_by_a_restart_runs_again_right_away(client, run):
+    account = client.primary
+    started = []
+
+    async def job():
+        started.append(time.time())
+        await asyncio.sleep(3600)
+
+    async def interrupt():
+        jobs = JobScheduler(account)
+        jobs.add("interrupted", job, 3600)
+        jobs.start()
+        while not started:
+            await asyncio.sleep(0)
+        # The companion stops during the run
+        jobs.stop()
+        await asyncio.sleep(0)
+
+    async def restart():
+        jobs = JobScheduler(account)
+        restored = jobs.add("interrupted", job, 3600)
+        jobs.start()
+        try:
+            assert restored.interrupted and restored.next_run <= time.time()
+            while len(started) < 2:
+                await asyncio.sleep(0.01)
+        finally:
+            jobs.stop()
+            await asyncio.sleep(0)
+
+    run(interrupt())
+    run(asyncio.wait_for(restart(), 5))
+    assert len(started) == 2
+
+
+def test_a_finished_run_waits_for_the_interval_after_a_restart(client, run):
+    account = client.primary
+    runs = []
+
+    async def job():
+        runs.append(time.time())
+
+    async def first():
+        jobs = JobScheduler(account)
+        jobs.add("finished", job, 3600)
+        jobs.start()
+        while not runs or jobs.get("finished").running:
+            await asyncio.sleep(0.01)
+        jobs.stop()
+
+    run(asyncio.wait_for(first(), 5))
+
+    jobs = JobScheduler(account)
+    restored = jobs.add("finished", job, 3600)
+    jobs.start()
+    jobs.stop()
+    assert not restored.interrupted
+    assert restored.next_run > time.time() + 3500
+
+
+def test_missed_runs_are_skipped_or_run_once():
+    skipped = Job("skip", None, 60, missed=SKIP)
+    skipped.last_run = 1000.0
+    skipped.schedule(1000.0 + 150)
+    assert skipped.next_run == 1000.0 + 180
+    assert skipped.skipped == 1
+
+    once = Job("once", None, 60, missed=RUN_ONCE)
+    once.last_run = 1000.0
+    once.schedule(1000.0 + 150)
+    assert once.next_run == 1000.0 + 150
+
+    on_time = Job("on time", None, 60, jitter=5)
+    on_time.last_run = 1000.0
+    on_time.schedule(1000.0 + 10)
+    assert 1060.0 <= on_time.next_run <= 1065.0
+
+
+def test_a_job_never_runs_twice_at_the_same_time(client, run):
+    jobs = JobScheduler(client.primary)
+    release = asyncio.Event()
+    runs = []
+
+    async def job():
+        runs.append(time.time())
+        await release.wait()
+
+    async def overlap():
+        jobs.add("overlap", job, 3600)
+        assert jobs.run("overlap")
+        await asyncio.sleep(0)
+        assert not jobs.run("overlap")
+        release.set()
+        while jobs.get("overlap").running:
+            await asyncio.sleep(0.01)
+
+    run(asyncio.wait_for(overlap(), 5))
+    assert len(runs) == 1
+    assert jobs.get("overlap").runs == 1
+
+
+def test_timeouts_and_errors_count_as_failures(client, run):
+    jobs = JobScheduler(client.primary)
+
+    async def slow():
+        await asyncio.sleep(3600)
+
+    async def broken():
+        raise RuntimeError("boom")
+
+    async def fail():
+        for name, func in (("slow", slow), ("broken", broken)):
+            jobs.add(name, func, 3600, timeout=0.01)
+            jobs.run(name)
+            while jobs.get(name).running or not jobs.get(name).runs:
+                await asyncio.sleep(0.01)
+
+    run(asyncio.wait_for(fail(), 5))
+    assert [(job.name, job.runs, job.failures) for job in jobs.jobs()] == [("broken", 1, 1), ("slow", 1, 1)]
+
+
+def test_paused_jobs_dont_run(client, run):
+    jobs = JobScheduler(client.primary)
+    runs = []
+
+    async def job():
+        runs.append(time.time())
+
+    async def paused():
+        jobs.add("paused", job, 3600)
+        jobs.pause("paused")
+        jobs.start()
+        await asyncio.sleep(0.05)
+        assert runs == []
+        jobs.resume("paused")
+        while not runs:
+            await asyncio.sleep(0.01)
+        jobs.stop()
+
+    run(asyncio.wait_for(paused(), 5))
+    assert len(runs) == 1
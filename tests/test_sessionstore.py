@@ -0,0 +1,87 @@
+import datetime
+
+from telethon.tl import types
+from telethon.tl.types import updates
+
+from tg_companion import sessionstore
+
+
+def new_session(name, **kwargs):
+    from tg_companion.tgclient import container
+
+    session = sessionstore.new_session(container, name)
+    session.flush_interval = 60
+    for key, value in kwargs.items():
+        setattr(session, key, value)
+    return session
+
+
+def stored(session, entity_id):
+    """ The row actually written, skipping the buffer """
+    return super(sessionstore.BufferedSession, session).get_entity_rows_by_id(entity_id)
+
+
+def resolved(*users):
+    return types.contacts.ResolvedPeer(peer=types.PeerUser(users[0].id), chats=[], users=list(users))
+
+
+def test_entities_are_buffered_and_deduplicated(client, run):
+    session = new_session("sessionstore_buffered")
+    user = types.User(5001, access_hash=51, first_name="Buffered", username="buffered")
+
+    session.process_entities(resolved(user, user))
+    assert session.pending == 1
+    assert session.get_entity_rows_by_username("buffered") == (5001, 51)
+    assert stored(session, 5001) is None
+
+    session.save()
+    run(session._flush_task)
+    assert tuple(stored(session, 5001)) == (5001, 51)
+
+    session.process_entities(resolved(user))
+    assert (session.pending, session.skipped) == (0, 1)
+    assert session.stats()["flushes"] == 1
+    session.close()
+
+
+def test_a_full_buffer_is_flushed_right_away(client, run):
+    session = new_session("sessionstore_full", flush_size=2)
+    session.process_entities(resolved(types.User(5002, access_hash=52)))
+    assert session._flush_task is None
+
+    session.process_entities(resolved(types.User(5003, access_hash=53)))
+    run(session._flush_task)
+    assert stored(session, 5002) is not None and stored(session, 5003) is not None
+    session.close()
+
+
+def test_failed_flushes_keep_the_changes(client, run, monkeypatch):
+    session = new_session("sessionstore_failed")
+
+    def fail(entities, states):
+        raise RuntimeError("database is down")
+
+    monkeypatch.setattr(session, "_write", fail)
+    session.process_entities(resolved(types.User(5004, access_hash=54)))
+    session.save()
+    run(session._flush_task)
+    assert session.pending == 1 and session.flushes == 0
+    assert session.get_entity_rows_by_id(5004) == (5004, 54)
+
+    monkeypatch.undo()
+    session.close()
+    assert stored(session, 5004) is not None
+
+
+def test_closing_writes_everything_still_buffered(client):
+    session = new_session("sessionstore_closed")
+    state = updates.State(10, 0, datetime.datetime(2018, 1, 1), 1, 0)
+
+    session.process_entities(resolved(types.User(5005, access_hash=55)))
+    session.set_update_state(0, state)
+    assert session._flush_handle is not None
+
+    session.close()
+    assert session._flush_handle is None and session.pending == 0
+    assert stored(session, 5005) is not None
+    assert super(sessionstore.BufferedSession, session).get_update_state(0).pts == 10
@@ -0,0 +1,255 @@
+import pytest
+import sqlalchemy as db
+
+from tg_companion import database
+from tg_companion.dialogs import SUPERGROUP, IndexedDialog
+
+
+def _index(account, dialogs):
+    async def indexed(*kinds):
+        return dialogs
+
+    account.dialog_index.dialogs = indexed
+
+
+def test_each_account_keeps_its_own_stats(client, run):
+    from tg_companion.modules import stats
+
+    for offset, account in enumerate(client.accounts):
+        _index(account, [IndexedDialog(-1000000003000 - offset, SUPERGROUP, f"Group {offset}", 1, 10, 0, 0)])
+        with client.use(account):
+            run(stats.GetStats())
+
+    rows = dict(database.fetch_all(db.select([stats.stats_tbl.columns.account, stats.stats_tbl.columns.supcount])))
+    # The fake Telegram answers every count with the chat id modulo 10000
+    assert rows == {"tests": -1000000003000 % 10000, "tests_second": -1000000003001 % 10000}
+
+
+def test_a_resumed_run_doesnt_count_the_converted_groups_again(client, run, monkeypatch):
+    from tg_companion.modules import stats
+
+    account = client.accounts[1]
+    supergroup = IndexedDialog(-1003100, SUPERGROUP, "Converted", 1, 10, 0, 0)
+    _index(account, [supergroup])
+    database.insert_many(stats.GroupsInfo_tbl, [{"supergroupid": 3100, "oldgroupid": 77}])
+    # The interrupted run had counted both, the next one is a full recount
+    stats.save_checkpoint(account.account_name, [
+        {"dialog_id": supergroup.id, "category": stats.SUPERGROUPS, "top_message": 10, "count": 40},
+        {"dialog_id": -77, "category": stats.USERS, "top_message": 0, "count": 5}])
+    monkeypatch.setattr(stats, "FULL_RECOUNT_EVERY", 0)
+    stats._engines.pop(account.account_name, None)
+    requests = account._sender.requests["GetHistoryRequest"]
+
+    with client.use(account):
+        run(stats.GetStats())
+
+    assert account._sender.requests["GetHistoryRequest"] == requests
+    engine = stats._engines[account.account_name]
+    assert (engine.dialogs[supergroup.id].count, engine.dialogs[-77].count) == (40, 5)
+    assert database.fetch_all(db.select([stats.checkpoint_tbl]).where(
+        stats.checkpoint_tbl.columns.account == account.account_name)) == []
+
+
+def test_the_counts_follow_the_live_updates():
+    from tg_companion.modules.stats import FULL_RECOUNT_EVERY, SUPERGROUPS, USERS, StatsEngine
+
+    engine = StatsEngine()
+    engine.load([(10, USERS, 5, 3, "Chat", 100), (-1005, SUPERGROUPS, 7, 4, "Group", 120)])
+    assert (engine.last_snapshot, engine.runs_until_recount) == (120, FULL_RECOUNT_EVERY)
+    assert not engine.needs_count(10, 5) and engine.needs_count(10, 6) and engine.needs_count(11, 1)
+
+    engine.new_message(10, 6, is_channel=False)
+    engine.new_message(12, 1, is_channel=False)
+    # Deletions in private chats and normal groups are matched with the messages seen
+    engine.deleted(None, [6, 999])
+    engine.deleted(-1005, [1, 2])
+    assert (engine.dialogs[10].count, engine.dialogs[10].top_message, engine.dialogs[-1005].count) == (3, 6, 2)
+    assert engine.unmatched_deletions == 1 and engine.needs_count(12, 1)
+
+    changed = engine.changed()
+    assert changed == {10: (USERS, 6, 3), -1005: (SUPERGROUPS, 7, 2)} and engine.changed() == changed
+    engine.mark_saved(changed)
+    assert engine.changed() == {}
+    engine.keep({10})
+    assert engine.totals() == {USERS: 3, "channelcount": 0, SUPERGROUPS: 0}
+
+
+def test_every_dialog_is_counted_again_by_the_full_recount():
+    from tg_companion.modules.stats import USERS, StatsEngine
+
+    engine = StatsEngine()
+    engine.load([(10, USERS, 5, 3, "Chat", 100)])
+    engine.runs_until_recount = 0
+    assert engine.full_recount and engine.needs_count(10, 5)
+
+    engine.counted[10] = 5
+    assert not engine.needs_count(10, 5)
+    engine.finish_run()
+    assert not engine.full_recount and engine.counted == {}
+
+
+def test_unchanged_dialogs_are_not_counted_again(client, run):
+    from tg_companion.modules import stats
+
+    account = client.accounts[0]
+    dialogs = [IndexedDialog(-1003200, SUPERGROUP, "Quiet", 1, 10, 0, 0),
+               IndexedDialog(-1003201, SUPERGROUP, "Busy", 1, 10, 0, 0)]
+    _index(account, dialogs)
+    with client.use(account):
+        run(stats.GetStats())
+        requests = account._sender.requests["GetHistoryRequest"]
+        dialogs[1].top_message = 11
+        run(stats.GetStats())
+
+    assert account._sender.requests["GetHistoryRequest"] == requests + 1
+
+
+def test_the_info_of_every_supergroup_is_fetched_once(client, run):
+    from tg_companion.modules import stats
+
+    account = client.accounts[0]
+    _index(account, [IndexedDialog(-1003300, SUPERGROUP, "Fetched once", 1, 10, 0, 0)])
+    requests = account._sender.requests["GetFullChannelRequest"]
+    with client.use(account):
+        run(stats.GetStats())
+        run(stats.GetStats())
+
+    assert account._sender.requests["GetFullChannelRequest"] == requests + 1
+    assert database.fetch_all(db.select([stats.GroupsInfo_tbl]).where(
+        stats.GroupsInfo_tbl.columns.supergroupid == 3300)) == [(3300, None)]
+
+
+def test_converted_groups_are_counted_with_their_supergroup(client, run):
+    from tg_companion.dialogs import GROUP
+    from tg_companion.modules import stats
+
+    account = client.accounts[0]
+    database.insert_many(stats.GroupsInfo_tbl, [{"supergroupid": 3301, "oldgroupid": 88}])
+    _index(account, [IndexedDialog(-1003301, SUPERGROUP, "Upgraded", 1, 10, 0, 0),
+                     IndexedDialog(-88, GROUP, "Upgraded", None, 5, 0, 0)])
+    with client.use(account):
+        run(stats.GetStats())
+
+    assert set(stats._engines[account.account_name].dialogs) == {-1003301, -88}
+    row = database.fetch_one(db.select([stats.stats_tbl.columns.convertedgroups, stats.stats_tbl.columns.numchat,
+                                        stats.stats_tbl.columns.usercount]).where(
+        stats.stats_tbl.columns.account == account.account_name))
+    # The fake Telegram answers every count with the chat id modulo 10000
+    assert tuple(row) == (1, 1, -88 % 10000)
+
+
+def _counts(total):
+    return {"totaldialogs": total, "usercount": total, "channelcount": 0, "supcount": 0}
+
+
+def test_ranges_and_bucket_widths():
+    from tg_companion.modules.stats import parse_range, bucket_width
+
+    assert (parse_range("24h"), parse_range("7D"), parse_range("1y")) == (86400, 7 * 86400, 365 * 86400)
+    assert parse_range("0d") is None and parse_range("7") is None and parse_range("d7") is None
+
+    now = 1000 * 86400
+    assert bucket_width(86400, now - 86400, now) == 3600
+    assert bucket_width(7 * 86400, now - 7 * 86400, now) == 6 * 3600
+    # Downsampled days can't be split in hours
+    assert bucket_width(40 * 86400, now - 40 * 86400, now) == 7 * 86400
+    assert bucket_width(10 * 365 * 86400, 0, now) == 30 * 86400
+
+
+def test_the_history_has_the_messages_of_every_bucket():
+    from tg_companion.modules.stats import history, record_history
+
+    now = 1000 * 86400
+    for hours, total in ((4, 10), (2, 15), (1, 15), (0, 30)):
+        record_history("history", now - hours * 3600, _counts(total))
+
+    width, deltas = history("history", 3 * 3600, now)
+    assert width == 3600
+    assert [(start, delta[0]) for start, delta in deltas] == [(now - 2 * 3600, 5), (now - 3600, 0), (now, 15)]
+
+
+def test_old_runs_are_downsampled_and_expired(monkeypatch):
+    from tg_companion.modules import stats
+
+    day = 86400
+    for time, total in ((day + 3600, 1), (day + 7200, 2), (5 * day + 3600, 3), (5 * day + 7200, 5)):
+        stats.record_history("downsampled", time, _counts(total))
+    monkeypatch.setattr(stats, "STATS_HISTORY_DAYS", 35)
+    stats.record_history("downsampled", 38 * day, _counts(4))
+
+    columns = stats.history_tbl.columns
+    rows = database.fetch_all(db.select([columns.time, columns.totaldialogs]).where(
+        columns.account == "downsampled").order_by(columns.time))
+    # The first day is expired and only the last run of the fifth one is kept
+    assert rows == [(5 * day + 7200, 5), (38 * day, 4)]
+
+
+def _dialog(dialog_id, count, name):
+    return {"dialog_id": dialog_id, "category": "usercount", "top_message": count, "count": count, "name": name}
+
+
+def test_the_most_active_dialogs_of_a_range(monkeypatch):
+    from tg_companion.modules import stats
+
+    stats.record_dialogs("top", 1000, [_dialog(1, 10, "A"), _dialog(2, 5, "B")])
+    stats.record_dialogs("top", 2000, [_dialog(1, 30, "A")])
+    stats.record_dialogs("top", 3000, [_dialog(2, 6, "B"), _dialog(3, 7, "C")])
+
+    assert sorted((row[0], row[3], row[5]) for row in stats.dialog_counts("top")) == [
+        (1, 30, 2000), (2, 6, 3000), (3, 7, 3000)]
+    assert sorted((row[0], row[3]) for row in stats.dialog_counts("top", at=1500)) == [(1, 10), (2, 5)]
+    # C appeared during the range, it's counted from its first snapshot
+    assert stats.top_dialogs("top", 1500, 3000, 10) == [("A", 20), ("B", 1)]
+    assert stats.top_dialogs("top", 1500, 3000, 1) == [("A", 20)]
+
+    monkeypatch.setattr(stats, "STATS_HISTORY_DAYS", 0)
+    stats.record_dialogs("top", 4000, [])
+    columns = stats.dialogs_tbl.columns
+    # The last expired row of each dialog is still its count
+    assert sorted(database.fetch_all(db.select([columns.dialog_id, columns.time]).where(
+        columns.account == "top"))) == [(1, 2000), (2, 3000), (3, 3000)]
+
+
+def test_every_chunk_is_checkpointed(client, run, monkeypatch):
+    from tg_companion.modules import stats
+
+    account = client.accounts[0]
+    _index(account, [IndexedDialog(-1003400 - offset, SUPERGROUP, "Chunked", 1, 10, 0, 0) for offset in range(3)])
+    checkpoints = []
+    save_checkpoint = stats.save_checkpoint
+
+    def saved(account_name, rows):
+        checkpoints.append([row["dialog_id"] for row in rows])
+        save_checkpoint(account_name, rows)
+
+    monkeypatch.setattr(stats, "STATS_CHUNK_SIZE", 2)
+    monkeypatch.setattr(stats, "save_checkpoint", saved)
+    with client.use(account):
+        run(stats.GetStats())
+
+    assert checkpoints == [[-1003400, -1003401], [-1003402]]
+    assert stats._engines[account.account_name].cooperation["chunks"] == 4
+    assert database.fetch_all(db.select([stats.checkpoint_tbl]).where(
+        stats.checkpoint_tbl.columns.account == account.account_name)) == []
+
+
+def test_dialogs_whose_snapshot_failed_are_written_by_the_next_run(client, run, monkeypatch):
+    from tg_companion.modules import stats
+
+    account = client.accounts[0]
+    _index(account, [IndexedDialog(-1003500, SUPERGROUP, "Unsaved", 1, 10, 0, 0)])
+
+    def fail(account_name, now, rows):
+        raise RuntimeError("database is down")
+
+    monkeypatch.setattr(stats, "record_dialogs", fail)
+    with client.use(account):
+        with pytest.raises(RuntimeError):
+            run(stats.GetStats())
+    assert -1003500 in stats._engines[account.account_name].changed()
+
+    monkeypatch.undo()
+    with client.use(account):
+        run(stats.GetStats())
+    assert [row[0] for row in stats.dialog_counts(account.account_name) if row[0] == -1003500] == [-1003500]
+    assert stats._engines[account.account_name].changed() == {}
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import sys
+
+from tg_companion import supervisor
+from tg_companion.accounts import NOT_SIGNED_IN
+from tg_companion.supervisor import Supervisor, Worker, _add_label, shard
+
+
+def test_sessions_are_spread_between_the_workers():
+    assert shard(["a", "b", "c", "d", "e"], 2) == [["a", "c", "e"], ["b", "d"]]
+    assert shard(["a"], 4) == [["a"]]
+    assert shard(["a", "b"], 0) == [["a", "b"]]
+
+
+def test_workers_get_their_sessions_and_their_own_logs_and_port():
+    env = Worker(1, ["a", "b", "c"], metrics_port=9101).env()
+    assert (env["SESSION_NAME"], env["EXTRA_SESSIONS"], env["METRICS_PORT"]) == ("a", "b,c", "9101")
+    assert env["LOG_DIR"].endswith("worker-1")
+
+    workers = Supervisor(["a", "b"], 2, metrics_port=9100).workers
+    assert [worker.metrics_port for worker in workers] == [9101, 9102]
+
+
+def test_the_metrics_of_every_worker_are_labelled(run, monkeypatch):
+    assert _add_label("up 1", "worker", "w") == 'up{worker="w"} 1'
+    assert _add_label('calls{handler="h"} 2', "worker", "w") == 'calls{handler="h",worker="w"} 2'
+
+    sup = Supervisor(["a", "b"], 2)
+    texts = {"worker-0": "# HELP calls Calls\n# TYPE calls counter\ncalls 1\n",
+             "worker-1": "# HELP calls Calls\n# TYPE calls counter\ncalls 2\n"}
+
+    async def scrape(worker):
+        return texts[worker.name]
+
+    monkeypatch.setattr(sup, "_scrape", scrape)
+    lines = run(sup.render_metrics()).splitlines()
+    assert lines[:4] == ["# HELP calls Calls", "# TYPE calls counter", 'calls{worker="worker-0"} 1',
+                         'calls{worker="worker-1"} 2']
+    assert 'tg_companion_worker_up{worker="worker-0"} 0' in lines
+
+
+def test_crashed_workers_are_restarted_until_they_need_to_sign_in(run, monkeypatch):
+    codes = [1, NOT_SIGNED_IN]
+    create_subprocess_exec = asyncio.create_subprocess_exec
+
+    async def fake_worker(*args, **kwargs):
+        code = codes.pop(0)
+        kwargs.pop("env")
+        return await create_subprocess_exec(
+            sys.executable, "-c", f"import sys; print('exiting with {code}'); sys.exit({code})", **kwargs)
+
+    monkeypatch.setattr(supervisor.asyncio, "create_subprocess_exec", fake_worker)
+    sup = Supervisor(["a"], 1)
+    output = []
+    handler = logging.Handler()
+    handler.emit = lambda record: output.append(record.getMessage())
+    sup._output.addHandler(handler)
+    try:
+        worker, = sup.workers
+        run(asyncio.wait_for(sup._supervise(worker), 10))
+    finally:
+        sup._output.removeHandler(handler)
+
+    assert worker.restarts == 1
+    assert output == ["[worker-0] exiting with 1", f"[worker-0] exiting with {NOT_SIGNED_IN}"]
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from tg_companion.tasks import DROP, QUEUE, TaskRegistry
+
+
+class Event(object):
+    chat_id = 42
+
+
+def _blocking(release, started):
+    async def handler(event):
+        started.append(event)
+        await release.wait()
+    return handler
+
+
+def test_drop_ignores_the_events_while_every_slot_is_busy(run):
+    registry = TaskRegistry()
+    release = asyncio.Event()
+    started = []
+    handler = registry.wrap(_blocking(release, started), max_concurrent=1, policy=DROP)
+
+    async def flood():
+        first = asyncio.ensure_future(handler(Event()))
+        await asyncio.sleep(0)
+        await handler(Event())
+        release.set()
+        await first
+
+    run(flood())
+    assert len(started) == 1
+    assert registry.stats()["dropped"] == 1
+
+
+def test_queue_waits_for_a_free_slot(run):
+    registry = TaskRegistry()
+    release = asyncio.Event()
+    started = []
+    handler = registry.wrap(_blocking(release, started), max_concurrent=1, policy=QUEUE)
+
+    async def queue():
+        runs = [asyncio.ensure_future(handler(Event())) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        assert len(started) == 1 and len(registry.tasks()) == 1
+        release.set()
+        await asyncio.gather(*runs)
+
+    run(queue())
+    assert len(started) == 2
+    assert registry.stats() == {"running": 0, "dropped": 0, "timed_out": 0, "cancelled": 0}
+
+
+def test_runs_over_the_timeout_are_cancelled(run):
+    registry = TaskRegistry()
+    handler = registry.wrap(_blocking(asyncio.Event(), []), timeout=0.01)
+
+    run(handler(Event()))
+    assert registry.stats()["timed_out"] == 1
+    assert registry.tasks() == []
+
+
+def test_runs_can_be_listed_and_cancelled(run):
+    registry = TaskRegistry()
+    started = []
+    handler = registry.wrap(_blocking(asyncio.Event(), started))
+
+    async def cancel():
+        running = asyncio.ensure_future(handler(Event()))
+        await asyncio.sleep(0)
+        task, = registry.tasks()
+        assert (task.name, task.chat_id) == ("handler", 42)
+        assert registry.cancel(task.id)
+        assert not registry.cancel(task.id + 1)
+        await running
+
+    run(cancel())
+    assert registry.stats()["cancelled"] == 1
+    assert registry.tasks() == []
+
+
+def test_unknown_policies_are_refused():
+    with pytest.raises(ValueError):
+        TaskRegistry().wrap(_blocking(None, []), max_concurrent=1, policy="wait")
@@ -0,0 +1,74 @@
+from telethon.errors import FloodWaitError, MessageIdInvalidError
+
+from tg_companion.writer import MessageWriter
+
+
+class Message(object):
+    def __init__(self, id):
+        self.id = id
+        self.chat_id = 42
+
+    async def get_input_chat(self):
+        return self.chat_id
+
+
+class Client(object):
+    """ Records the edits and the replies, failing the edits with the queued errors """
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.edits = []
+        self.replies = []
+
+    async def edit_message(self, chat, message, text):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.edits.append((message.id, text))
+
+    async def send_message(self, chat, text, reply_to=None):
+        self.replies.append((reply_to.id, text))
+        return Message(100 + len(self.replies))
+
+
+def test_flood_waits_retry_the_edit_without_replying(run):
+    client = Client(FloodWaitError(None, capture=0))
+    writer = MessageWriter(client, 0)
+
+    async def edit():
+        async with writer.stream(Message(1)) as progress:
+            progress.update("1/1")
+
+    run(edit())
+    assert client.replies == []
+    assert client.edits == [(1, "1/1")]
+
+
+def test_messages_which_cant_be_edited_get_one_reply_edited_after(run):
+    client = Client(MessageIdInvalidError(None))
+    writer = MessageWriter(client, 0)
+
+    async def edit():
+        async with writer.stream(Message(1)) as progress:
+            progress.update("1/3")
+            await progress.flush()
+            progress.update("2/3")
+            await progress.flush()
+            progress.update("3/3")
+
+    run(edit())
+    assert client.replies == [(1, "1/3")]
+    assert client.edits == [(101, "2/3"), (101, "3/3")]
+
+
+def test_only_the_last_pending_text_is_sent(run):
+    client = Client()
+    writer = MessageWriter(client, 0)
+
+    async def edit():
+        async with writer.stream(Message(1)) as progress:
+            for done in range(1, 11):
+                progress.update(f"{done}/10")
+
+    run(edit())
+    assert client.edits == [(1, "10/10")]
+    assert writer.coalesced == 9
@@ -5,6 +5,10 @@ import os
 import logging
 import dotenv
 
+from tg_companion import profiler
+
+# Re-exported for the modules timing their startup, its clock started with the import above
+startup = profiler.startup
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -13,9 +17,9 @@ logging.basicConfig(
 LOGGER = logging.getLogger(__name__)
 
 
-if sys.version_info[0] < 3 or sys.version_info[1] < 6:
+if sys.version_info[0] < 3 or sys.version_info[1] < 7:
     LOGGER.error(
-        "You MUST have a python version of at least 3.6! Multiple features depend on this."
+        "You MUST have a python version of at least 3.7! Multiple features depend on this."
     )
     quit(1)
 
@@ -24,7 +28,11 @@ dotenv.load_dotenv("config.env")
 APP_ID = os.environ.get("APP_ID", None)
 APP_HASH = os.environ.get("APP_HASH", None)
 SESSION_NAME = os.environ.get("SESSION_NAME", "tg_companion")
+EXTRA_SESSIONS = [name.strip() for name in os.environ.get("EXTRA_SESSIONS", "").split(",") if name.strip()]
 DB_URI = os.environ.get("DB_URI", None)
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 5))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
 DEBUG = sb(os.environ.get("DEBUG", "False"))
 CMD_HANDLER = os.environ.get("CMD_HANDLER", ".")
 
@@ -44,7 +52,25 @@ PASSWORD = os.environ.get("PASSWORD", None)
 BLOCK_PM = sb(os.environ.get("BLOCK_PM", "False"))
 NOPM_SPAM = sb(os.environ.get("NOPM_SPAM", "False"))
 STATS_TIMER = int(os.environ.get("STATS_TIMER", 3600))
+STATS_CONCURRENCY = int(os.environ.get("STATS_CONCURRENCY", 8))
+STATS_HISTORY_DAYS = int(os.environ.get("STATS_HISTORY_DAYS", 730))
+STATS_CHUNK_SIZE = int(os.environ.get("STATS_CHUNK_SIZE", 50))
+STATS_LATENCY_TARGET = float(os.environ.get("STATS_LATENCY_TARGET", 100))
 SUBPROCESS_ANIM = sb(os.environ.get("SUBPROCESS_ANIM", "False"))
+EDIT_INTERVAL = float(os.environ.get("EDIT_INTERVAL", 1.5))
+FLOOD_WAIT_THRESHOLD = int(os.environ.get("FLOOD_WAIT_THRESHOLD", 60))
+RATE_LIMITS = os.environ.get("RATE_LIMITS", "")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+LOG_DIR = os.environ.get("LOG_DIR", "logs")
+SESSION_FLUSH_INTERVAL = float(os.environ.get("SESSION_FLUSH_INTERVAL", 10))
+SESSION_FLUSH_SIZE = int(os.environ.get("SESSION_FLUSH_SIZE", 500))
+HEALTH_CHECK_INTERVAL = int(os.environ.get("HEALTH_CHECK_INTERVAL", 30))
+RECONNECT_MAX_BACKOFF = int(os.environ.get("RECONNECT_MAX_BACKOFF", 300))
+CATCH_UP_BATCH = int(os.environ.get("CATCH_UP_BATCH", 50))
+SHARED_STATE_TTL = float(os.environ.get("SHARED_STATE_TTL", 30))
+
+ENTITY_CACHE_SIZE = int(os.environ.get("ENTITY_CACHE_SIZE", 2048))
+ENTITY_CACHE_TTL = int(os.environ.get("ENTITY_CACHE_TTL", 600))
 
 ENABLE_SSH = sb(os.environ.get('ENABLE_SSH', "False"))
 SSH_HOSTNAME = os.environ.get('SSH_HOSTNAME', '::1')
@@ -1,20 +1,31 @@
 import asyncio
-import importlib
+import os
+from argparse import ArgumentParser
 
 
-from tg_companion import CMD_HANDLER, LOGGER, proxy
+from tg_companion import CMD_HANDLER, LOG_DIR, LOGGER, METRICS_PORT, proxy, startup
 from tg_companion.modules import MODULES
 from tg_companion.plugins import PLUGINS
-from tg_companion.tgclient import CMD_HELP, client
 
+with startup.phase("tgclient"):
+    from tg_companion.tgclient import CMD_HELP, client
 
-for module_name in MODULES:
-    imported_module = importlib.import_module(
-        "tg_companion.modules." + module_name)
+parser = ArgumentParser(prog="tg_companion")
+parser.add_argument(
+    "--profile-startup",
+    help="Print where the startup time goes and exit once the companion is ready", action="store_true")
+parser.add_argument(
+    "--worker",
+    help="Exit instead of asking to sign in. Used by the supervisor", action="store_true")
+args, _ = parser.parse_known_args()
 
-for plugin_name in PLUGINS:
-    imported_plugin = importlib.import_module(
-        "tg_companion.plugins." + plugin_name)
+with startup.phase("login"):
+    client.login(interactive=not args.worker)
+
+with startup.phase("modules"):
+    client.modules.load(
+        ["tg_companion.modules." + module_name for module_name in MODULES] +
+        ["tg_companion.plugins." + plugin_name for plugin_name in PLUGINS])
 
 if proxy:
     LOGGER.info(f"Connecting to Telegram over proxy: {proxy[1]}:{proxy[2]}")
@@ -77,4 +88,19 @@ loop = asyncio.get_event_loop()
 
 if __name__ == "__main__":
 
+    startup.ready()
+    startup.write(os.path.join(LOG_DIR, "startup.json"))
+    LOGGER.info(f"Ready after {startup.ready_at}s. The report is saved in {LOG_DIR}/startup.json")
+
+    if args.profile_startup:
+        for phase in startup.phases:
+            print(f"{'  ' * phase['depth']}{phase['name']}: {phase['duration']}s")
+        client.disconnect()
+        quit(0)
+
+    client.start_jobs()
+    client.watch_connections()
+    client.loop_lag.start()
+    if METRICS_PORT:
+        loop.run_until_complete(client.metrics.serve(METRICS_PORT))
     client.loop_until_disconnected()
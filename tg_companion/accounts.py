@@ -0,0 +1,192 @@
+import asyncio
+import contextlib
+import contextvars
+import sys
+
+from tg_companion import LOG_DIR, LOGGER, startup
+from tg_companion.errorlog import ErrorLog
+from tg_companion.loader import ModuleLoader
+from tg_companion.metrics import Metrics
+from tg_companion.monitor import LoopLagMonitor
+from tg_companion.tasks import QUEUE
+
+# The account whose update or job is handled by the current task
+current_client = contextvars.ContextVar("current_client", default=None)
+
+# The exit code of a worker with an account that has to be signed in first
+NOT_SIGNED_IN = 3
+
+
+class ClientProxy(object):
+    """
+    The `client` used by every module when the companion runs several accounts in one process.
+
+    Handlers, commands and jobs registered on it are registered on every account. Anything else is forwarded to
+    the account handling the current update or job, so `client.update_message(event, ...)` answers from the
+    account which received `event`. Outside of a handler it's forwarded to the first account.
+
+    The accounts share the event loop, the database pool, the module loader, the metrics, the error log and the
+    module level state. Each account has its own connection, request rate limits, jobs and entity caches since
+    access hashes and admin rights differ between accounts.
+    """
+
+    def __init__(self, cmd_help):
+        self._accounts = {}
+        self._limits = {}
+        self._handlers = {}
+        self.modules = ModuleLoader(self, cmd_help)
+        self.metrics = Metrics()
+        self.loop_lag = LoopLagMonitor()
+        self._error_log = ErrorLog(LOG_DIR)
+
+        self.metrics.gauge("loop_lag_max_ms", lambda: self.loop_lag.stats()["max"],
+                           "The longest time the event loop was blocked")
+        self.metrics.gauge("flood_waits", lambda: sum(account._scheduler.flood_waits for account in self.accounts),
+                           "How many flood waits were hit")
+        self.metrics.gauge("running_tasks", lambda: sum(len(account.handler_tasks()) for account in self.accounts),
+                           "How many command runs are in progress")
+        self.metrics.gauge("accounts", lambda: len(self._accounts), "How many accounts are running")
+        self.metrics.gauge("connected_accounts", lambda: sum(account.connection.connected for account in self.accounts),
+                           "How many accounts are connected to Telegram")
+        self.metrics.gauge("outages", lambda: sum(account.connection.outages for account in self.accounts),
+                           "How many times an account lost its connection")
+        self.metrics.gauge("outage_seconds", lambda: sum(account.connection.outage_seconds for account in self.accounts),
+                           "How long the accounts were disconnected in total")
+        self.metrics.gauge("last_outage_seconds", lambda: max(account.connection.last_outage for account in self.accounts),
+                           "How long the last outage lasted, the longest one between the accounts")
+        self.metrics.gauge("catch_up_updates", lambda: sum(account.connection.replayed for account in self.accounts),
+                           "How many missed updates were replayed after reconnecting")
+        self.metrics.gauge("catch_up_gaps", lambda: sum(account.connection.gaps for account in self.accounts),
+                           "How many outages missed too many updates to replay them")
+        self.metrics.gauge("channel_catch_up_gaps",
+                           lambda: sum(account.connection.channel_gaps for account in self.accounts),
+                           "How many channel catch ups missed too many updates to replay them or failed")
+        self.metrics.gauge("catch_up_lag_seconds", lambda: max(account.connection.catch_up_lag for account in self.accounts),
+                           "How late the oldest update replayed by the last catch up was handled")
+
+    def add(self, name, account):
+        if name in self._accounts:
+            raise ValueError(f"An account named {name} already exists")
+        account.account_name = name
+        self._accounts[name] = account
+        return account
+
+    @property
+    def accounts(self):
+        return list(self._accounts.values())
+
+    @property
+    def primary(self):
+        return next(iter(self._accounts.values()))
+
+    def current(self):
+        return current_client.get() or self.primary
+
+    @contextlib.contextmanager
+    def use(self, account):
+        """ Forwards `client` to `account` inside the block. Tasks created inside it keep using `account` """
+        token = current_client.set(account)
+        try:
+            yield account
+        finally:
+            current_client.reset(token)
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.current(), name)
+
+    def __call__(self, request, ordered=False):
+        return self.current()(request, ordered=ordered)
+
+    def login(self, interactive=True):
+        """ Signs in every account. Exits with `NOT_SIGNED_IN` if one has to be signed in and `interactive` is False """
+        not_signed_in = []
+        for name, account in self._accounts.items():
+            if len(self._accounts) > 1:
+                LOGGER.info("Signing in the %s account", name)
+            with startup.phase(name), self.use(account):
+                if not account.login(interactive):
+                    not_signed_in.append(name)
+
+        if not_signed_in:
+            LOGGER.error("%s must be signed in first. Start the companion with `python3 -m tg_companion` to sign in",
+                         ", ".join(not_signed_in))
+            self.disconnect()
+            sys.exit(NOT_SIGNED_IN)
+
+    def start_jobs(self):
+        for account in self.accounts:
+            with self.use(account):
+                account.jobs.start()
+
+    def watch_connections(self):
+        """ Starts the `ConnectionSupervisor` of every account """
+        for account in self.accounts:
+            with self.use(account):
+                account.connection.start()
+
+    def disconnect(self):
+        for account in self.accounts:
+            account.disconnect()
+        result = asyncio.get_event_loop().create_future()
+        result.set_result(None)
+        return result
+
+    def loop_until_disconnected(self):
+        """ Runs until every account is disconnected. Lost connections are reestablished meanwhile """
+        try:
+            asyncio.get_event_loop().run_until_complete(
+                asyncio.gather(*(account.connection.stopped for account in self.accounts)))
+        except KeyboardInterrupt:
+            LOGGER.info("Thanks for using Telegram Companion. Goodbye!")
+            self.disconnect()
+
+    def _limited(self, account, callback):
+        limits = self._limits.get(callback)
+        if limits is None:
+            return callback
+        return account.limit(*limits)(callback)
+
+    def on(self, event):
+        def decorator(f):
+            self.add_event_handler(f, event)
+            return f
+        return decorator
+
+    def add_event_handler(self, callback, event=None):
+        for account in self.accounts:
+            handler = self._handlers[(account, callback)] = self._limited(account, callback)
+            account.add_event_handler(handler, event)
+
+    def remove_event_handler(self, callback, event=None):
+        removed = 0
+        for account in self.accounts:
+            removed += account.remove_event_handler(self._handlers.pop((account, callback), callback), event)
+        return removed
+
+    def CommandHandler(self, *args, **kwargs):
+        """ Registers the command on every account. See `CustomClient.CommandHandler` """
+        def decorator(f):
+            for account in self.accounts:
+                account.CommandHandler(*args, **kwargs)(f)
+            return f
+        return decorator
+
+    def limit(self, max_concurrent=None, timeout=None, policy=QUEUE):
+        """ Limits a handler registered with `client.on()` on every account. See `CustomClient.limit` """
+        def decorator(f):
+            self._limits[f] = (max_concurrent, timeout, policy)
+            return f
+        return decorator
+
+    def job(self, *args, **kwargs):
+        """ Runs the job on every account. See `CustomClient.job` """
+        def decorator(f):
+            for account in self.accounts:
+                account.job(*args, **kwargs)(f)
+            return f
+        return decorator
+
+    def on_timer(self, seconds):
+        return self.job(seconds)
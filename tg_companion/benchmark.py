@@ -0,0 +1,484 @@
+"""
+Pushes synthetic updates through every handler of the companion and reports how many messages per second it
+handles, the CPU time used by each handler and how many requests it sends to Telegram per message.
+
+    python3 -m tg_companion.benchmark --messages 5000 --mix chatter=60,mentions=10,commands=15,edits=10,joins=5
+
+Telegram is replaced by a fake connection answering every request locally and the session and the database
+live in a temporary directory, so no network, account or config is needed. Results are saved to
+logs/benchmarks/<label>.json and `--compare` prints the difference with a previous result.
+
+    python3 -m tg_companion.benchmark --stats-dialogs 2000 --latency 0.05 --concurrency 8
+
+times how long the stats job takes to count the messages of 2000 dialogs one at a time, like it used to, with
+at most `--concurrency` requests in flight, and in chunks pausing for the commands like the stats job does. A
+command sends a request every 50ms meanwhile and the p95 of its latency is reported for each of them.
+"""
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from telethon import utils
+from telethon.errors import FloodWaitError
+from telethon.tl import functions, types
+
+import tg_companion
+
+# The kinds of updates the workload is made of and their default share of the messages
+DEFAULT_MIX = {"chatter": 60, "mentions": 5, "private": 5, "commands": 15, "edits": 10, "joins": 5}
+
+# Commands that only read the companion state or the database, so the result doesn't depend on Telegram
+DEFAULT_COMMANDS = (
+    "version", "notes", "get benchmark", "save benchmark a note saved by the benchmark",
+    "cache", "requests", "tasks", "pipeline", "lag", "metrics", "db",
+)
+
+WORDS = ("hello", "there", "how", "are", "you", "the", "release", "is", "out", "today", "check",
+         "this", "link", "https://example.com", "lol", "thanks", "see", "you", "tomorrow", "ok")
+
+
+class FakeSender(object):
+    """
+    Stands in for the MTProto sender of the client. Every request is answered locally after `latency` seconds
+    with the smallest result the client methods accept, and counted by type.
+    """
+
+    def __init__(self, me, latency=0.0, flood_every=0):
+        self.me = me
+        self.latency = latency
+        # Answer every n-th history request with a flood wait of one second
+        self.flood_every = flood_every
+        self.requests = collections.Counter()
+        self._ids = itertools.count(1000000)
+        self._pts = itertools.count(1)
+
+    def is_connected(self):
+        return True
+
+    async def disconnect(self):
+        pass
+
+    def send(self, request, ordered=False):
+        if utils.is_list_like(request):
+            return [self.send(r) for r in request]
+
+        self.requests[type(request).__name__] += 1
+        future = asyncio.get_event_loop().create_future()
+        result = self._answer(request)
+        if (self.flood_every and isinstance(request, functions.messages.GetHistoryRequest)
+                and self.requests["GetHistoryRequest"] % self.flood_every == 0):
+            future.set_exception(FloodWaitError(request, capture=1))
+        elif self.latency:
+            asyncio.get_event_loop().call_later(self.latency, future.set_result, result)
+        else:
+            future.set_result(result)
+        return future
+
+    def _answer(self, request):
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        if isinstance(request, functions.messages.SendMessageRequest):
+            return types.UpdateShortSentMessage(next(self._ids), next(self._pts), 1, now, out=True)
+        if isinstance(request, functions.users.GetUsersRequest):
+            return [self.me]
+        if isinstance(request, (functions.messages.DeleteMessagesRequest, functions.channels.DeleteMessagesRequest,
+                                functions.messages.ReadHistoryRequest)):
+            return types.messages.AffectedMessages(next(self._pts), 1)
+        if isinstance(request, functions.channels.ReadHistoryRequest):
+            return True
+        if isinstance(request, functions.messages.GetHistoryRequest):
+            return types.messages.ChannelMessages(
+                pts=1, count=utils.get_peer_id(request.peer) % 10000, messages=[], chats=[], users=[])
+        if isinstance(request, functions.channels.GetFullChannelRequest):
+            full_chat = types.ChannelFull(
+                request.channel.channel_id, "", 1, 0, 0, 0, types.PhotoEmpty(0), types.PeerNotifySettings(),
+                types.ChatInviteEmpty(), [], 0, 0)
+            return types.messages.ChatFull(full_chat, [], [])
+        return types.Updates(updates=[], users=[], chats=[], date=now, seq=0)
+
+
+class Workload(object):
+    """ Builds the synthetic updates: `users` people talking in `groups` groups and to the companion account """
+
+    def __init__(self, seed=0, users=50, groups=10, commands=DEFAULT_COMMANDS):
+        self.random = random.Random(seed)
+        self._commands = commands
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        self.me = types.User(1000, is_self=True, access_hash=1000, first_name="Companion", username="companion")
+        self.users = [types.User(2000 + i, access_hash=2000 + i, first_name=f"User {i}", username=f"user{i}")
+                      for i in range(users)]
+        self.groups = [types.Channel(3000 + i, f"Group {i}", types.ChatPhotoEmpty(), now, 0,
+                                     megagroup=True, access_hash=3000 + i)
+                       for i in range(groups)]
+        self._ids = itertools.count(1)
+        self._pts = itertools.count(1)
+        self._chatter = collections.deque(maxlen=200)
+
+    def updates(self, count, mix):
+        kinds = list(mix)
+        weights = [mix[kind] for kind in kinds]
+        for _ in range(count):
+            yield getattr(self, self.random.choices(kinds, weights)[0])()
+
+    def _text(self, words=8):
+        return " ".join(self.random.choice(WORDS) for _ in range(self.random.randint(1, words)))
+
+    def _message(self, to_id, from_id, text, **kwargs):
+        return types.Message(next(self._ids), to_id=to_id, date=datetime.datetime.now(tz=datetime.timezone.utc),
+                             from_id=from_id, message=text, **kwargs)
+
+    def _update(self, update, *entities):
+        update._entities = {utils.get_peer_id(entity): entity for entity in entities}
+        return update
+
+    def _group_update(self, message, group, user):
+        return self._update(types.UpdateNewChannelMessage(message, next(self._pts), 1), group, user)
+
+    def chatter(self):
+        group, user = self.random.choice(self.groups), self.random.choice(self.users)
+        message = self._message(types.PeerChannel(group.id), user.id, self._text())
+        self._chatter.append((message, group, user))
+        return self._group_update(message, group, user)
+
+    def mentions(self):
+        group, user = self.random.choice(self.groups), self.random.choice(self.users)
+        message = self._message(types.PeerChannel(group.id), user.id,
+                                f"@{self.me.username} {self._text()}", mentioned=True)
+        return self._group_update(message, group, user)
+
+    def private(self):
+        user = self.random.choice(self.users)
+        message = self._message(types.PeerUser(self.me.id), user.id, self._text())
+        return self._update(types.UpdateNewMessage(message, next(self._pts), 1), user, self.me)
+
+    def commands(self):
+        text = tg_companion.CMD_HANDLER + self.random.choice(self._commands)
+        if self.random.random() < 0.5:
+            group = self.random.choice(self.groups)
+            message = self._message(types.PeerChannel(group.id), self.me.id, text, out=True)
+            return self._group_update(message, group, self.me)
+
+        user = self.random.choice(self.users)
+        message = self._message(types.PeerUser(user.id), self.me.id, text, out=True)
+        return self._update(types.UpdateNewMessage(message, next(self._pts), 1), user, self.me)
+
+    def edits(self):
+        if not self._chatter:
+            return self.chatter()
+        message, group, user = self.random.choice(self._chatter)
+        edited = self._message(message.to_id, message.from_id, self._text(),
+                               edit_date=datetime.datetime.now(tz=datetime.timezone.utc))
+        edited.id = message.id
+        return self._update(types.UpdateEditChannelMessage(edited, next(self._pts), 1), group, user)
+
+    def joins(self):
+        group, user = self.random.choice(self.groups), self.random.choice(self.users)
+        message = types.MessageService(
+            next(self._ids), to_id=types.PeerChannel(group.id), date=datetime.datetime.now(tz=datetime.timezone.utc),
+            from_id=user.id, action=types.MessageActionChatAddUser([user.id]))
+        return self._group_update(message, group, user)
+
+
+def _isolate(workdir):
+    """ Points the companion config at `workdir` so the benchmark never uses the real session or database """
+    tg_companion.APP_ID = 1
+    tg_companion.APP_HASH = "0" * 32
+    tg_companion.SESSION_NAME = "benchmark"
+    tg_companion.EXTRA_SESSIONS = []
+    tg_companion.DB_URI = "sqlite:///" + os.path.join(workdir, "benchmark.db")
+
+
+def _load_client(workload, latency, rate_limits, workdir, flood_every=0):
+    from tg_companion.modules import MODULES
+    from tg_companion.plugins import PLUGINS
+    from tg_companion.tgclient import client
+
+    account = client.primary
+    account._sender = FakeSender(workload.me, latency, flood_every)
+    account._self_input_peer = utils.get_input_peer(workload.me, allow_self=False)
+    if not rate_limits:
+        async def acquire(request):
+            pass
+        account._scheduler.acquire = acquire
+
+    client.modules.path = os.path.join(workdir, "module_manifest.json")
+    client.modules.load(
+        ["tg_companion.modules." + module_name for module_name in MODULES] +
+        ["tg_companion.plugins." + plugin_name for plugin_name in PLUGINS])
+    return account
+
+
+def _snapshot(client):
+    return {metrics.name: (metrics.calls, metrics.errors, metrics.rpcs, metrics.cpu)
+            for metrics in client.metrics.handlers()}
+
+
+async def _dispatch(client, updates, concurrency):
+    if concurrency <= 1:
+        for update in updates:
+            await client._dispatch_update(update)
+        return
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def dispatch(update):
+        async with semaphore:
+            await client._dispatch_update(update)
+
+    await asyncio.gather(*(dispatch(update) for update in updates))
+
+
+def run(messages=5000, mix=None, warmup=200, concurrency=1, latency=0.0, rate_limits=False, seed=0,
+        commands=DEFAULT_COMMANDS, label=None):
+    """ Runs the benchmark and returns its result as a dict """
+    mix = mix or DEFAULT_MIX
+    workdir = tempfile.mkdtemp(prefix="tg_companion_benchmark_")
+    _isolate(workdir)
+    workload = Workload(seed=seed, commands=commands)
+    client = _load_client(workload, latency, rate_limits, workdir)
+    loop = asyncio.get_event_loop()
+
+    loop.run_until_complete(_dispatch(client, list(workload.updates(warmup, mix)), concurrency))
+    updates = list(workload.updates(messages, mix))
+    before = _snapshot(client)
+    client._sender.requests.clear()
+    client.loop_lag.start()
+
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    loop.run_until_complete(_dispatch(client, updates, concurrency))
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    client.loop_lag.stop()
+
+    handlers = []
+    for name, (calls, errors, rpcs, handler_cpu) in _snapshot(client).items():
+        calls_before, errors_before, rpcs_before, cpu_before = before.get(name, (0, 0, 0, 0.0))
+        calls -= calls_before
+        if not calls:
+            continue
+        handler_cpu -= cpu_before
+        handlers.append({
+            "name": name,
+            "calls": calls,
+            "errors": errors - errors_before,
+            "rpcs": rpcs - rpcs_before,
+            "cpu": round(handler_cpu, 6),
+            "cpu_per_call_ms": round(handler_cpu / calls * 1000, 4),
+        })
+    handlers.sort(key=lambda handler: handler["cpu"], reverse=True)
+
+    rpcs = sum(client._sender.requests.values())
+    return {
+        "label": label or datetime.datetime.now().strftime("%Y%m%d-%H%M%S"),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "messages": messages,
+        "mix": mix,
+        "concurrency": concurrency,
+        "latency": latency,
+        "rate_limits": rate_limits,
+        "seed": seed,
+        "elapsed": round(elapsed, 4),
+        "cpu": round(cpu, 4),
+        "messages_per_second": round(messages / elapsed, 1),
+        "rpcs": rpcs,
+        "rpcs_per_message": round(rpcs / messages, 4),
+        "requests": dict(client._sender.requests.most_common()),
+        "loop_lag": client.loop_lag.stats(),
+        "handlers": handlers,
+    }
+
+
+async def _probe_commands(client, stopped, samples, interval=0.05):
+    """ Sends a request like a command would every `interval` seconds and saves how long each one took """
+    while not stopped.is_set():
+        started = time.perf_counter()
+        await client(functions.messages.ReadHistoryRequest(types.InputPeerSelf(), 0))
+        samples.append(time.perf_counter() - started)
+        await asyncio.sleep(interval)
+
+
+async def _count_with_commands(client, stats, peers, limit, chunk_size=None):
+    """ Counts the messages of `peers`, in chunks pausing for the commands when `chunk_size` is given """
+    samples = []
+    stopped = asyncio.Event()
+    probe = asyncio.get_event_loop().create_task(_probe_commands(client, stopped, samples))
+    try:
+        if chunk_size is None:
+            counts = await stats.count_messages(peers, limit)
+        else:
+            counts = []
+            cooperator = stats._cooperator()
+            for start in range(0, len(peers), chunk_size):
+                await cooperator.pause()
+                counts.extend(await stats.count_messages(peers[start:start + chunk_size], limit))
+    finally:
+        stopped.set()
+        await probe
+    samples.sort()
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))] if samples else 0.0
+    return counts, round(p95 * 1000, 1)
+
+
+def run_stats(dialogs=2000, concurrency=8, latency=0.05, rate_limits=False, flood_every=0, label=None):
+    """
+    Times the message counting of the stats job, sequential, concurrent and in chunks, and the latency of a command
+    running meanwhile. Returns the result as a dict
+    """
+    from tg_companion.fanout import AdaptiveLimit
+
+    workdir = tempfile.mkdtemp(prefix="tg_companion_benchmark_")
+    _isolate(workdir)
+    client = _load_client(Workload(), latency, rate_limits, workdir, flood_every)
+    from tg_companion.modules import stats
+
+    peers = [types.InputPeerChannel(5000 + i, 5000 + i) for i in range(dialogs)]
+    loop = asyncio.get_event_loop()
+    result = {
+        "label": label or datetime.datetime.now().strftime("%Y%m%d-%H%M%S"),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "dialogs": dialogs,
+        "concurrency": concurrency,
+        "latency": latency,
+        "rate_limits": rate_limits,
+        "flood_every": flood_every,
+        "chunk_size": tg_companion.STATS_CHUNK_SIZE,
+        "latency_target_ms": tg_companion.STATS_LATENCY_TARGET,
+    }
+    for name, maximum, chunk_size in (("sequential", 1, None), ("concurrent", concurrency, None),
+                                      ("chunked", concurrency, tg_companion.STATS_CHUNK_SIZE)):
+        client._sender.requests.clear()
+        limit = AdaptiveLimit(maximum, flood_waits=lambda: client._scheduler.flood_waits)
+        started = time.perf_counter()
+        counts, command_p95 = loop.run_until_complete(_count_with_commands(client, stats, peers, limit, chunk_size))
+        result[name] = {
+            "elapsed": round(time.perf_counter() - started, 4),
+            "requests": client._sender.requests["GetHistoryRequest"],
+            "failed": sum(isinstance(count, Exception) for count in counts),
+            "flood_waits": limit.flood_waits,
+            "final_limit": limit.limit,
+            "command_p95_ms": command_p95,
+        }
+    result["speedup"] = round(result["sequential"]["elapsed"] / max(result["concurrent"]["elapsed"], 1e-9), 2)
+    return result
+
+
+def report_stats(result):
+    lines = [f"Counting the messages of {result['dialogs']} dialogs, latency {result['latency']}s"]
+    for name in ("sequential", "concurrent", "chunked"):
+        run = result[name]
+        lines.append(f"{name:<12}{run['elapsed']:>10}s  {run['requests']} requests, {run['failed']} failed, "
+                     f"{run['flood_waits']} flood waits, final limit {run['final_limit']}, "
+                     f"commands p95 {run['command_p95_ms']}ms")
+    lines.append(f"Speedup: {result['speedup']}x with at most {result['concurrency']} requests in flight")
+    lines.append(f"Chunks of {result['chunk_size']} dialogs, command latency target {result['latency_target_ms']}ms "
+                 f"over the request latency of {result['latency'] * 1000:.0f}ms")
+    return "\n".join(lines)
+
+
+def write(result, directory="logs/benchmarks"):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{result['label']}.json")
+    with open(path, "w") as result_file:
+        json.dump(result, result_file, indent=2)
+    return path
+
+
+def _change(new, old):
+    if not old:
+        return ""
+    return f" ({(new - old) / old * 100:+.1f}%)"
+
+
+def report(result, previous=None):
+    """ Returns `result` as text, compared with the `previous` result if given """
+    previous = previous or {}
+    old_handlers = {handler["name"]: handler for handler in previous.get("handlers", ())}
+    lines = [
+        f"{result['messages']} messages in {result['elapsed']}s, concurrency {result['concurrency']}, "
+        f"latency {result['latency']}s",
+        f"Messages/s: {result['messages_per_second']}"
+        f"{_change(result['messages_per_second'], previous.get('messages_per_second'))}",
+        f"Requests/message: {result['rpcs_per_message']}"
+        f"{_change(result['rpcs_per_message'], previous.get('rpcs_per_message'))}",
+        f"Loop lag: p95 {result['loop_lag']['p95']}ms, max {result['loop_lag']['max']}ms",
+        "",
+        f"{'handler':<40}{'calls':>8}{'errors':>8}{'rpcs':>8}{'cpu ms/call':>14}",
+    ]
+    for handler in result["handlers"]:
+        old = old_handlers.get(handler["name"], {})
+        lines.append(
+            f"{handler['name']:<40}{handler['calls']:>8}{handler['errors']:>8}{handler['rpcs']:>8}"
+            f"{handler['cpu_per_call_ms']:>14}{_change(handler['cpu_per_call_ms'], old.get('cpu_per_call_ms'))}")
+    lines.append("")
+    lines.append("Requests: " + ", ".join(f"{name} {count}" for name, count in result["requests"].items()))
+    return "\n".join(lines)
+
+
+def _parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in DEFAULT_MIX:
+            raise ValueError(f"Unknown update kind {kind!r}, use one of {', '.join(DEFAULT_MIX)}")
+        mix[kind] = float(weight)
+    return mix
+
+
+def main():
+    parser = ArgumentParser(prog="tg_companion.benchmark", description="Benchmark the companion handlers offline")
+    parser.add_argument("--messages", type=int, default=5000, help="How many updates to measure")
+    parser.add_argument("--warmup", type=int, default=200, help="How many updates to send before measuring")
+    parser.add_argument("--mix", type=_parse_mix, default=None,
+                        help="Weights of the update kinds, e.g. chatter=60,mentions=5,private=5,commands=15,edits=10,joins=5")
+    parser.add_argument("--command", action="append", dest="commands",
+                        help="A command to use instead of the default ones, without the handler symbol. Can be repeated")
+    parser.add_argument("--concurrency", type=int, default=1, help="How many updates are handled at the same time. The CPU time of a handler includes the "
+                             "other handlers running while it waits when this is over 1")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the fake Telegram takes to answer")
+    parser.add_argument("--rate-limits", action="store_true", help="Keep the request rate limits of the companion")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--label", help="Name of the saved result. Defaults to the current time")
+    parser.add_argument("--compare", help="A previous result to compare with")
+    parser.add_argument("--verbose", action="store_true", help="Show the companion and Telethon logs")
+    parser.add_argument("--stats-dialogs", type=int, default=0,
+                        help="Benchmark counting the messages of this many dialogs for the stats instead of the handlers")
+    parser.add_argument("--flood-every", type=int, default=0,
+                        help="With --stats-dialogs, answer every n-th count with a flood wait")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger("telethon").setLevel(logging.CRITICAL)
+
+    if args.stats_dialogs:
+        result = run_stats(dialogs=args.stats_dialogs, concurrency=max(args.concurrency, 1), latency=args.latency,
+                           rate_limits=args.rate_limits, flood_every=args.flood_every, label=args.label)
+        print(report_stats(result))
+        print(f"\nSaved to {write(result)}")
+        return
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as previous_file:
+            previous = json.load(previous_file)
+
+    result = run(messages=args.messages, mix=args.mix, warmup=args.warmup, concurrency=args.concurrency,
+                 latency=args.latency, rate_limits=args.rate_limits, seed=args.seed,
+                 commands=tuple(args.commands or DEFAULT_COMMANDS), label=args.label)
+    print(report(result, previous))
+    print(f"\nSaved to {write(result)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+import asyncio
+import datetime
+import itertools
+import random
+import time
+
+from telethon import utils
+from telethon.tl import functions, types
+
+from tg_companion import (CATCH_UP_BATCH, HEALTH_CHECK_INTERVAL, LOGGER,
+                          RECONNECT_MAX_BACKOFF)
+from tg_companion.fanout import AdaptiveLimit, fan_out
+
+# Consecutive failed pings after which the connection is considered dead
+PROBE_FAILURES = 2
+# How many channels are caught up on at the same time
+CHANNEL_CONCURRENCY = 4
+
+
+def channel_of(update):
+    """ Returns the id of the channel whose own pts sequence `update` belongs to, or None """
+    channel_id = getattr(update, "channel_id", None)
+    if channel_id is not None:
+        return channel_id
+    if isinstance(update, (types.UpdateNewChannelMessage, types.UpdateEditChannelMessage)):
+        return getattr(getattr(update.message, "to_id", None), "channel_id", None)
+    return None
+
+
+class ConnectionSupervisor(object):
+    """
+    Keeps an account connected and replays the updates it missed while it wasn't.
+
+    Every `interval` seconds the connection is probed with a ping. When Telethon gives up reconnecting or the pings
+    keep failing, the account is reconnected with an exponential backoff capped at `max_backoff` seconds. After
+    every reconnection, Telethon's included, the missed updates are fetched with `updates.getDifference` and
+    dispatched to the handlers `batch_size` at a time, so a long outage doesn't start thousands of handlers at once.
+
+    Channels and supergroups have their own pts, tracked by `seen()` and saved in the session next to the common
+    state. After the common difference every channel with updates since the start, or reported too long by it,
+    is caught up on with `updates.getChannelDifference`.
+
+    Updates missed while the companion wasn't running are not replayed.
+    """
+
+    def __init__(self, client, interval=HEALTH_CHECK_INTERVAL, max_backoff=RECONNECT_MAX_BACKOFF,
+                 batch_size=CATCH_UP_BATCH):
+        self.client = client
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.batch_size = batch_size
+        self.stopped = asyncio.get_event_loop().create_future()
+        self._task = None
+        self._catch_up_lock = asyncio.Lock()
+
+        self.outages = 0
+        self.outage_seconds = 0.0
+        self.last_outage = 0.0
+        self.catch_ups = 0
+        self.replayed = 0
+        self.gaps = 0
+        self.channel_catch_ups = 0
+        self.channel_gaps = 0
+        # channel id -> `State` holding its pts, for the channels with updates since the start
+        self.channel_states = {}
+        # How late the oldest update replayed by the last catch up was handled
+        self.catch_up_lag = 0.0
+
+    @property
+    def connected(self):
+        return bool(self.client.is_connected())
+
+    def start(self):
+        if self._task is None and not self.stopped.done():
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+    async def _run(self):
+        # Start from the current state, what happened while the companion was stopped isn't replayed
+        try:
+            self.client._state = await self.client(functions.updates.GetStateRequest())
+        except Exception as exc:
+            LOGGER.warning("Failed to get the update state of %s: %r", self.client.account_name, exc)
+
+        failures = 0
+        while True:
+            disconnected = self.client.disconnected
+            done, _ = await asyncio.wait([disconnected], timeout=self.interval)
+            if done and not disconnected.cancelled():
+                # Telethon stores why it gave up, nobody else reads it
+                disconnected.exception()
+
+            if not self.connected:
+                failures = PROBE_FAILURES
+            elif await self._probe():
+                failures = 0
+            else:
+                failures += 1
+                LOGGER.info("%s didn't answer a ping (%s/%s)", self.client.account_name, failures, PROBE_FAILURES)
+
+            if failures >= PROBE_FAILURES:
+                await self._reconnect()
+                failures = 0
+
+    async def _probe(self):
+        try:
+            await asyncio.wait_for(
+                self.client(functions.PingRequest(random.randrange(-2 ** 63, 2 ** 63))), timeout=self.interval)
+            return True
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            return False
+
+    async def _reconnect(self):
+        LOGGER.warning("Lost the connection of %s, reconnecting", self.client.account_name)
+        started = time.monotonic()
+        self.outages += 1
+        backoff = 1
+        while True:
+            # Drops the dead connection without closing the session like `disconnect()` does
+            self.client._disconnect()
+            try:
+                await asyncio.wait_for(self.client.connect(), timeout=max(self.interval, 10))
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                delay = backoff * random.uniform(0.5, 1.5)
+                LOGGER.info("Failed to reconnect %s (%r), retrying in %.0fs",
+                            self.client.account_name, exc, delay)
+                await asyncio.sleep(delay)
+                backoff = min(backoff * 2, self.max_backoff)
+
+        self.last_outage = time.monotonic() - started
+        self.outage_seconds += self.last_outage
+        LOGGER.info("Reconnected %s after %.1fs", self.client.account_name, self.last_outage)
+        await self.catch_up()
+
+    async def catch_up(self):
+        """ Fetches the updates missed since the last known state and dispatches them to the handlers """
+        if self._catch_up_lock.locked():
+            return
+        async with self._catch_up_lock:
+            try:
+                await self._catch_up()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                LOGGER.exception("Failed to catch up on the updates of %s", self.client.account_name)
+
+    async def _catch_up(self):
+        state = self.client._state
+        if not state.pts:
+            return
+
+        self.catch_ups += 1
+        self.catch_up_lag = 0.0
+        replayed = 0
+        too_long = set()
+        try:
+            while True:
+                difference = await self.client(functions.updates.GetDifferenceRequest(
+                    state.pts, state.date, state.qts))
+
+                if isinstance(difference, types.updates.DifferenceEmpty):
+                    state.date = difference.date
+                    state.seq = difference.seq
+                    break
+                if isinstance(difference, types.updates.DifferenceTooLong):
+                    self.gaps += 1
+                    LOGGER.warning("%s missed too many updates to replay them", self.client.account_name)
+                    state.pts = difference.pts
+                    break
+
+                self.client.session.process_entities(difference)
+                too_long.update(update.channel_id for update in difference.other_updates
+                                if isinstance(update, types.UpdateChannelTooLong))
+                replayed += await self._dispatch(difference)
+                if isinstance(difference, types.updates.Difference):
+                    state = difference.state
+                    break
+                state = difference.intermediate_state
+        finally:
+            self.client._state = state
+            self.client.session.set_update_state(0, state)
+            self.replayed += replayed
+
+        channels = list(set(self.channel_states) | too_long)
+        results = await fan_out(self._catch_up_channel, channels, AdaptiveLimit(
+            CHANNEL_CONCURRENCY, flood_waits=lambda: self.client.request_stats()["flood_waits"]))
+        for channel_id, result in zip(channels, results):
+            if isinstance(result, Exception):
+                self.channel_gaps += 1
+                LOGGER.warning("Failed to catch up on the channel %s of %s: %r",
+                               channel_id, self.client.account_name, result)
+            else:
+                replayed += result
+                self.replayed += result
+
+        if replayed:
+            LOGGER.info("%s replayed %s missed updates, %s channels included, the oldest %.1fs late",
+                        self.client.account_name, replayed, len(channels), self.catch_up_lag)
+
+    def seen(self, update):
+        """ Records the pts of a channel update so the channel can be caught up on after an outage """
+        channel_id = channel_of(update)
+        pts = getattr(update, "pts", None)
+        if channel_id is None or not pts:
+            return
+        state = self.channel_states.get(channel_id)
+        if state is None or pts > state.pts:
+            state = self.channel_states[channel_id] = types.updates.State(
+                pts, 0, datetime.datetime.now(datetime.timezone.utc), 0, 0)
+            self.client.session.set_update_state(channel_id, state)
+
+    async def _catch_up_channel(self, channel_id):
+        state = self.channel_states.get(channel_id) or self.client.session.get_update_state(channel_id)
+        if state is None or not state.pts:
+            # Nothing tells where the channel was left, its next update starts tracking it
+            self.channel_gaps += 1
+            return 0
+
+        channel = utils.get_input_channel(await self.client.get_input_entity(types.PeerChannel(channel_id)))
+        self.channel_catch_ups += 1
+        pts = state.pts
+        replayed = 0
+        while True:
+            difference = await self.client(functions.updates.GetChannelDifferenceRequest(
+                channel, types.ChannelMessagesFilterEmpty(), pts, self.batch_size, force=True))
+            if isinstance(difference, types.updates.ChannelDifferenceEmpty):
+                pts = difference.pts
+                break
+            if isinstance(difference, types.updates.ChannelDifferenceTooLong):
+                self.channel_gaps += 1
+                LOGGER.warning("%s missed too many updates in the channel %s to replay them",
+                               self.client.account_name, channel_id)
+                pts = difference.pts
+                break
+
+            self.client.session.process_entities(difference)
+            replayed += await self._dispatch(difference, [
+                types.UpdateNewChannelMessage(message, 0, 0) for message in difference.new_messages])
+            pts = difference.pts
+            if difference.final:
+                break
+
+        self.seen(types.UpdateChannelTooLong(channel_id, pts))
+        return replayed
+
+    async def _dispatch(self, difference, new_messages=None):
+        entities = {utils.get_peer_id(entity): entity for entity in itertools.chain(difference.users, difference.chats)}
+        if new_messages is None:
+            new_messages = [types.UpdateNewMessage(message, 0, 0) for message in difference.new_messages]
+        updates = difference.other_updates + new_messages
+        for update in difference.other_updates:
+            self.seen(update)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for message in difference.new_messages:
+            if getattr(message, "date", None):
+                self.catch_up_lag = max(self.catch_up_lag, (now - message.date).total_seconds())
+
+        for start in range(0, len(updates), self.batch_size):
+            batch = updates[start:start + self.batch_size]
+            for update in batch:
+                update._entities = entities
+            await asyncio.gather(*(self.client._dispatch_update(update) for update in batch))
+        return len(updates)
+
+    def stats(self):
+        return {
+            "connected": self.connected,
+            "outages": self.outages,
+            "outage_seconds": round(self.outage_seconds, 1),
+            "last_outage": round(self.last_outage, 1),
+            "catch_ups": self.catch_ups,
+            "replayed": self.replayed,
+            "gaps": self.gaps,
+            "channel_catch_ups": self.channel_catch_ups,
+            "channel_gaps": self.channel_gaps,
+            "channels_tracked": len(self.channel_states),
+            "catch_up_lag": round(self.catch_up_lag, 1),
+        }
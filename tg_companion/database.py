@@ -0,0 +1,245 @@
+import asyncio
+import contextlib
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlalchemy as db
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError
+
+from tg_companion import (DB_MAX_OVERFLOW, DB_POOL_RECYCLE, DB_POOL_SIZE,
+                          DB_URI, LOGGER, SHARED_STATE_TTL)
+
+
+class PoolStats(object):
+    """ Counts the connections opened by the engine and how they are checked out of the pool """
+
+    def __init__(self):
+        self.connects = 0
+        self.checkouts = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+
+    def listen(self, engine):
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.checkouts += 1
+        self.checked_out += 1
+        self.max_checked_out = max(self.max_checked_out, self.checked_out)
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        self.checked_out -= 1
+
+
+def _create_engine(uri):
+    kwargs = {"pool_pre_ping": True}
+    # sqlite uses a pool without size limits
+    if make_url(uri).get_backend_name() != "sqlite":
+        kwargs.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_recycle=DB_POOL_RECYCLE)
+    return db.create_engine(uri, **kwargs)
+
+
+engine = _create_engine(DB_URI) if DB_URI else None
+metadata = db.MetaData()
+pool_stats = PoolStats()
+
+if engine is not None:
+    pool_stats.listen(engine)
+else:
+    LOGGER.info("DB_URI is not set. The modules using the database won't work")
+
+
+def create_tables(*tables):
+    metadata.create_all(bind=engine, tables=tables, checkfirst=True)
+
+
+def drop_if_outdated(table):
+    """ Drops `table` when the stored one has other columns. Only for tables rebuilt by the companion anyway """
+    if not engine.has_table(table.name):
+        return
+    columns = {column["name"] for column in db.inspect(engine).get_columns(table.name)}
+    if columns != set(table.columns.keys()):
+        LOGGER.info("Recreating the %s table with the columns %s", table.name, ", ".join(table.columns.keys()))
+        table.drop(bind=engine)
+
+
+@contextlib.contextmanager
+def transaction():
+    """ A connection whose statements are committed together when the block exits without errors """
+    with engine.begin() as connection:
+        yield connection
+
+
+def fetch_all(query):
+    with engine.connect() as connection:
+        return connection.execute(query).fetchall()
+
+
+def fetch_one(query):
+    with engine.connect() as connection:
+        return connection.execute(query).first()
+
+
+def execute(query):
+    """ Runs a statement and returns the number of rows it matched """
+    with engine.begin() as connection:
+        return connection.execute(query).rowcount
+
+
+def insert_many(table, rows):
+    """ Inserts the `rows` dicts into `table` with one batched statement """
+    if not rows:
+        return 0
+    with engine.begin() as connection:
+        return connection.execute(table.insert(), rows).rowcount
+
+
+def upsert(table, key, **values):
+    """
+    Updates the row of `table` matching the `key` dict or inserts it.
+
+        upsert(notes_tbl, {"notename": name}, note=content)
+    """
+    where = db.and_(*(table.columns[column] == value for column, value in key.items()))
+    update = db.update(table).where(where).values(**values)
+    try:
+        with engine.begin() as connection:
+            if not connection.execute(update).rowcount:
+                connection.execute(db.insert(table).values(**key, **values))
+    except IntegrityError:
+        # Another call inserted the row between the update and the insert, it can be updated now
+        with engine.begin() as connection:
+            if not connection.execute(update).rowcount:
+                raise
+
+
+class AsyncDatabase(object):
+    """
+    Runs the database helpers in a thread pool so the event loop never waits for the database.
+    The sync helpers are only meant for startup, handlers and jobs should use these:
+
+        rows = await database.aio.fetch_all(query)
+    """
+
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="database")
+        self.calls = 0
+        self.pending = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def _timed(self, func, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.monotonic() - started
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+    async def run(self, func, *args, **kwargs):
+        """ Runs `func(*args, **kwargs)` in the database thread pool and returns its result """
+        self.calls += 1
+        self.pending += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(
+                self._executor, functools.partial(self._timed, func, *args, **kwargs))
+        finally:
+            self.pending -= 1
+
+    async def fetch_all(self, query):
+        return await self.run(fetch_all, query)
+
+    async def fetch_one(self, query):
+        return await self.run(fetch_one, query)
+
+    async def execute(self, query):
+        return await self.run(execute, query)
+
+    async def insert_many(self, table, rows):
+        return await self.run(insert_many, table, rows)
+
+    async def upsert(self, table, key, **values):
+        return await self.run(upsert, table, key, **values)
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "pending": self.pending,
+            "avg_time": round(self.total_time / self.calls, 4) if self.calls else 0.0,
+            "max_time": round(self.max_time, 4),
+        }
+
+
+# One worker per pooled connection, more would only wait for a connection
+aio = AsyncDatabase(DB_POOL_SIZE)
+
+
+class Reloader(object):
+    """
+    Keeps a module-level dict or set filled from the database in step with the other companion processes, like
+    the workers of the supervisor, which change the same rows.
+
+    `load` returns the new content and runs in the database thread pool. `refresh()` is cheap enough for the checks
+    of the handlers, it only starts a reload in the background when the content is older than `ttl` seconds and
+    the caller goes on with the content as it is. Call `changed()` after changing the content locally, a reload
+    started before doesn't overwrite it then.
+
+        GBANNED_USERS = {}
+        gbanned_users = database.Reloader(_load_gbanned_users, GBANNED_USERS)
+    """
+
+    def __init__(self, load, target, ttl=SHARED_STATE_TTL):
+        self._load = load
+        self.target = target
+        self.ttl = ttl
+        self.reloads = 0
+        self._version = 0
+        self._task = None
+        self._replace(load())
+        self.loaded = time.monotonic()
+
+    def _replace(self, content):
+        self.target.clear()
+        self.target.update(content)
+
+    def changed(self):
+        self._version += 1
+
+    def refresh(self):
+        if self.ttl <= 0 or self._task is not None or time.monotonic() - self.loaded < self.ttl:
+            return
+        self._task = asyncio.get_event_loop().create_task(self._reload(self._version))
+
+    async def _reload(self, version):
+        try:
+            content = await aio.run(self._load)
+            if version == self._version:
+                self._replace(content)
+                self.reloads += 1
+        except Exception:
+            LOGGER.exception("Failed to reload %s", self._load.__name__)
+        finally:
+            self.loaded = time.monotonic()
+            self._task = None
+
+
+def stats():
+    result = {
+        "connects": pool_stats.connects,
+        "checkouts": pool_stats.checkouts,
+        "checked_out": pool_stats.checked_out,
+        "max_checked_out": pool_stats.max_checked_out,
+        "queries": aio.stats(),
+    }
+    if engine is not None:
+        result["pool"] = engine.pool.status()
+    return result
@@ -0,0 +1,449 @@
+import asyncio
+import time
+
+import sqlalchemy as db
+from telethon import utils
+from telethon.tl import functions, types
+
+from tg_companion import LOGGER, SESSION_FLUSH_INTERVAL, database
+from tg_companion.database import metadata
+from tg_companion.ratelimit import background
+
+USER = "user"
+BOT = "bot"
+GROUP = "group"
+SUPERGROUP = "supergroup"
+CHANNEL = "channel"
+
+# Every dialog is fetched again when the last full crawl is older than this, it fixes what no update tells about
+RESYNC_INTERVAL = 24 * 3600
+# A refresh stops after this many dialogs in a row which didn't change since they were indexed
+UNCHANGED_STREAK = 10
+# How many ids go in one `IN (...)` clause
+CHUNK_SIZE = 500
+# How many dialogs `unread()` fetches in one request
+PEER_DIALOGS_CHUNK = 100
+
+dialogs_tbl = db.Table("dialog_index", metadata,
+                       db.Column("account", db.String(), primary_key=True),
+                       db.Column("dialog_id", db.BigInteger(), primary_key=True),
+                       db.Column("kind", db.String()),
+                       db.Column("name", db.String()),
+                       db.Column("access_hash", db.BigInteger()),
+                       db.Column("top_message", db.Integer()),
+                       db.Column("date", db.Integer()),
+                       db.Column("unread", db.Integer()),
+                       db.Column("mentions", db.Integer()))
+
+sync_tbl = db.Table("dialog_index_sync", metadata,
+                    db.Column("account", db.String(), primary_key=True),
+                    db.Column("synced", db.Float()))
+
+
+def _kind(entity):
+    if isinstance(entity, types.User):
+        return BOT if entity.bot else USER
+    if isinstance(entity, (types.Channel, types.ChannelForbidden)):
+        return SUPERGROUP if entity.megagroup else CHANNEL
+    return GROUP
+
+
+def _timestamp(date):
+    return int(date.timestamp()) if date else 0
+
+
+class IndexedDialog(object):
+    """ A dialog of the `DialogIndex`. `id` is the marked id, `entity_id` the id of the user, chat or channel """
+    __slots__ = ("id", "kind", "name", "access_hash", "top_message", "date", "unread", "mentions")
+
+    def __init__(self, id, kind, name, access_hash, top_message, date, unread, mentions=0):
+        self.id = id
+        self.kind = kind
+        self.name = name
+        self.access_hash = access_hash
+        self.top_message = top_message
+        self.date = date
+        self.unread = unread
+        self.mentions = mentions
+
+    @classmethod
+    def from_entity(cls, entity, top_message=0, date=0, unread=0, mentions=0):
+        return cls(utils.get_peer_id(entity), _kind(entity), utils.get_display_name(entity),
+                   getattr(entity, "access_hash", None), top_message, date, unread, mentions)
+
+    @classmethod
+    def from_dialog(cls, dialog):
+        return cls.from_entity(dialog.entity, dialog.dialog.top_message, _timestamp(dialog.date),
+                               dialog.unread_count, dialog.unread_mentions_count)
+
+    @property
+    def is_user(self):
+        return self.kind in (USER, BOT)
+
+    @property
+    def is_group(self):
+        return self.kind in (GROUP, SUPERGROUP)
+
+    @property
+    def is_channel(self):
+        return self.kind in (SUPERGROUP, CHANNEL)
+
+    @property
+    def entity_id(self):
+        return utils.resolve_id(self.id)[0]
+
+    @property
+    def input_entity(self):
+        """ The input peer of the dialog, or its id to resolve it from the session when the access hash is unknown """
+        if self.kind == GROUP:
+            return types.InputPeerChat(self.entity_id)
+        if self.access_hash is None:
+            return self.id
+        if self.is_user:
+            return types.InputPeerUser(self.entity_id, self.access_hash)
+        return types.InputPeerChannel(self.entity_id, self.access_hash)
+
+    def row(self):
+        return dict(dialog_id=self.id, kind=self.kind, name=self.name, access_hash=self.access_hash,
+                    top_message=self.top_message, date=self.date, unread=self.unread, mentions=self.mentions)
+
+    def __repr__(self):
+        return f"<IndexedDialog {self.kind} {self.id} {self.name!r}>"
+
+
+class DialogIndex(object):
+    """
+    The dialogs of an account, kept up to date from the updates so they can be listed without asking Telegram.
+
+    The index is saved to the database and loaded the first time it's used. Only the dialogs which changed since
+    it was saved are fetched then, unless it's empty, and every dialog is fetched again in the background once
+    every `RESYNC_INTERVAL` seconds. New messages move their dialog to the top and count as unread, and as a
+    mention when they mention the account, until the dialog is read. Joining or leaving a chat adds or removes it.
+
+    Changes are written `SESSION_FLUSH_INTERVAL` seconds after the first one and when the client disconnects.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._dialogs = {}
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+        self._sync_task = None
+        self.synced = 0.0
+        self._dirty = set()
+        self._removed = set()
+        self._synced_changed = False
+        self._flush_handle = None
+        self._flush_task = None
+        # A dialog got a message the index has no entity for, the next listing refreshes the index first
+        self._unknown = False
+        self.crawls = 0
+        self.refreshes = 0
+        self.fetched = 0
+        self.live_updates = 0
+        if database.engine is not None:
+            # It had no mentions column before, the next load fetches every dialog again
+            database.drop_if_outdated(dialogs_tbl)
+            database.create_tables(dialogs_tbl, sync_tbl)
+
+    def __len__(self):
+        return len(self._dialogs)
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def get(self, dialog_id):
+        return self._dialogs.get(dialog_id)
+
+    async def dialogs(self, *kinds):
+        """ Returns the indexed dialogs of the given kinds, or all of them, the last active first """
+        await self.load()
+        if self._unknown:
+            await self.refresh()
+        if time.time() - self.synced > RESYNC_INTERVAL and self._sync_task is None:
+            self._sync_task = asyncio.get_event_loop().create_task(self._background_sync())
+        dialogs = [dialog for dialog in self._dialogs.values() if not kinds or dialog.kind in kinds]
+        dialogs.sort(key=lambda dialog: dialog.date, reverse=True)
+        return dialogs
+
+    async def load(self):
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded:
+                return
+            rows, synced = await database.aio.run(self._read, self.client.account_name)
+            for row in rows:
+                # The updates handled meanwhile are newer
+                self._dialogs.setdefault(row[0], IndexedDialog(*row))
+            self.synced = synced or 0.0
+            if not rows:
+                await self.sync()
+            else:
+                await self.refresh()
+            self._loaded = True
+
+    async def refresh(self):
+        """ Fetches the dialogs from the top until `UNCHANGED_STREAK` of them in a row didn't change """
+        self.refreshes += 1
+        self._unknown = False
+        streak = 0
+        async for dialog in self.client.iter_dialogs(limit=None):
+            self.fetched += 1
+            known = self._dialogs.get(dialog.id)
+            unchanged = known is not None and known.top_message == dialog.dialog.top_message
+            self._set(IndexedDialog.from_dialog(dialog))
+            # Pinned dialogs stay on top even when they're older
+            if dialog.pinned:
+                continue
+            streak = streak + 1 if unchanged else 0
+            if streak >= UNCHANGED_STREAK:
+                break
+
+    async def unread(self):
+        """
+        Returns the dialogs with unread messages or mentions.
+
+        The dialogs the updates marked as unread are fetched again to get their current counters. Every dialog is
+        when the index is stale, the updates may have missed some
+        """
+        await self.load()
+        if self._unknown:
+            await self.refresh()
+        if time.time() - self.synced > RESYNC_INTERVAL:
+            await self.sync()
+        else:
+            marked = [dialog for dialog in self._dialogs.values() if dialog.unread or dialog.mentions]
+            for start in range(0, len(marked), PEER_DIALOGS_CHUNK):
+                await self._fetch_counters(marked[start:start + PEER_DIALOGS_CHUNK])
+        return [dialog for dialog in self._dialogs.values() if dialog.unread or dialog.mentions]
+
+    async def _fetch_counters(self, dialogs):
+        peers = []
+        for dialog in dialogs:
+            peer = dialog.input_entity
+            if isinstance(peer, int):
+                try:
+                    peer = await self.client.get_input_entity(peer)
+                except ValueError:
+                    continue
+            peers.append(types.InputDialogPeer(peer))
+        if not peers:
+            return
+
+        result = await self.client(functions.messages.GetPeerDialogsRequest(peers))
+        self.fetched += len(result.dialogs)
+        for fetched in result.dialogs:
+            dialog = self._dialogs.get(utils.get_peer_id(fetched.peer))
+            if dialog is not None and (dialog.unread, dialog.mentions, dialog.top_message) != (
+                    fetched.unread_count, fetched.unread_mentions_count, fetched.top_message):
+                dialog.unread = fetched.unread_count
+                dialog.mentions = fetched.unread_mentions_count
+                dialog.top_message = max(dialog.top_message, fetched.top_message)
+                self._changed(dialog.id)
+
+    async def sync(self):
+        """ Fetches every dialog and drops the ones which aren't there anymore """
+        self.crawls += 1
+        self._unknown = False
+        dialogs = {}
+        async for dialog in self.client.iter_dialogs(limit=None):
+            self.fetched += 1
+            dialogs[dialog.id] = IndexedDialog.from_dialog(dialog)
+        for dialog_id in set(self._dialogs) - set(dialogs):
+            self._remove(dialog_id)
+        for dialog in dialogs.values():
+            self._set(dialog)
+        self.synced = time.time()
+        self._synced_changed = True
+        LOGGER.info("Indexed the %s dialogs of %s", len(dialogs), self.client.account_name)
+        self._schedule()
+
+    async def _background_sync(self):
+        try:
+            with background():
+                await self.sync()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            LOGGER.exception("Failed to index the dialogs of %s", self.client.account_name)
+        finally:
+            self._sync_task = None
+
+    def read(self, dialog_id, mentions=True):
+        """ Marks a dialog as read, and its mentions too unless `mentions` is False """
+        dialog = self._dialogs.get(dialog_id)
+        if dialog is not None and (dialog.unread or mentions and dialog.mentions):
+            dialog.unread = 0
+            if mentions:
+                dialog.mentions = 0
+            self._changed(dialog_id)
+
+    def _set(self, dialog):
+        known = self._dialogs.get(dialog.id)
+        if known is None or known.row() != dialog.row():
+            self._dialogs[dialog.id] = dialog
+            self._changed(dialog.id)
+
+    def _changed(self, dialog_id):
+        self._dirty.add(dialog_id)
+        self._removed.discard(dialog_id)
+        self._schedule()
+
+    def _remove(self, dialog_id):
+        if self._dialogs.pop(dialog_id, None) is not None:
+            self._dirty.discard(dialog_id)
+            self._removed.add(dialog_id)
+            self._schedule()
+
+    async def on_update(self, update):
+        """ Applies a raw update to the index """
+        if isinstance(update, (types.UpdateNewMessage, types.UpdateNewChannelMessage)):
+            self._on_message(update.message, getattr(update, "_entities", {}))
+        elif isinstance(update, types.UpdateShortMessage):
+            self._on_new_message(update.user_id, update.id, update.date, update.out, update.mentioned)
+        elif isinstance(update, types.UpdateShortChatMessage):
+            self._on_new_message(-update.chat_id, update.id, update.date, update.out, update.mentioned)
+        elif isinstance(update, types.UpdateReadHistoryInbox):
+            self._on_read(utils.get_peer_id(update.peer), update.max_id)
+        elif isinstance(update, types.UpdateReadChannelInbox):
+            self._on_read(utils.get_peer_id(types.PeerChannel(update.channel_id)), update.max_id)
+        elif isinstance(update, types.UpdateChannel):
+            dialog_id = utils.get_peer_id(types.PeerChannel(update.channel_id))
+            entity = getattr(update, "_entities", {}).get(dialog_id)
+            if isinstance(entity, types.ChannelForbidden) or getattr(entity, "left", False):
+                self._remove(dialog_id)
+            elif isinstance(entity, types.Channel):
+                self._add_entity(entity)
+
+    def _on_message(self, message, entities):
+        if isinstance(message, types.MessageEmpty):
+            return
+        if isinstance(message.to_id, types.PeerUser) and not message.out:
+            dialog_id = message.from_id
+        else:
+            dialog_id = utils.get_peer_id(message.to_id)
+
+        self_id = getattr(self.client._self_input_peer, "user_id", None)
+        action = getattr(message, "action", None)
+        if isinstance(action, types.MessageActionChatDeleteUser) and action.user_id == self_id:
+            self._remove(dialog_id)
+            return
+        joined = (isinstance(action, types.MessageActionChatAddUser) and self_id in action.users or
+                  isinstance(action, types.MessageActionChatJoinedByLink) and message.from_id == self_id)
+        if joined or dialog_id not in self._dialogs:
+            self._add_entity(entities.get(dialog_id))
+        self._on_new_message(dialog_id, message.id, message.date, message.out, message.mentioned)
+
+    def _add_entity(self, entity):
+        if entity is None or getattr(entity, "min", False):
+            return
+        dialog = IndexedDialog.from_entity(entity)
+        known = self._dialogs.get(dialog.id)
+        if known is not None:
+            dialog.top_message, dialog.date = known.top_message, known.date
+            dialog.unread, dialog.mentions = known.unread, known.mentions
+        self._set(dialog)
+
+    def _on_new_message(self, dialog_id, message_id, date, out, mentioned=False):
+        dialog = self._dialogs.get(dialog_id)
+        if dialog is None:
+            self._unknown = True
+            return
+        self.live_updates += 1
+        dialog.top_message = max(dialog.top_message, message_id)
+        dialog.date = max(dialog.date, _timestamp(date))
+        # Sending a message reads the dialog
+        dialog.unread = 0 if out else dialog.unread + 1
+        if mentioned and not out:
+            dialog.mentions += 1
+        self._changed(dialog_id)
+
+    def _on_read(self, dialog_id, max_id):
+        dialog = self._dialogs.get(dialog_id)
+        # Reading the history doesn't read the mentions
+        if dialog is not None and max_id >= dialog.top_message:
+            self.read(dialog_id, mentions=False)
+
+    @property
+    def pending(self):
+        return len(self._dirty) + len(self._removed) + self._synced_changed
+
+    def _schedule(self):
+        if self._flush_handle is None and self._flush_task is None and database.engine is not None:
+            self._flush_handle = asyncio.get_event_loop().call_later(SESSION_FLUSH_INTERVAL, self._start_flush)
+
+    def _take_changes(self):
+        rows = [self._dialogs[dialog_id].row() for dialog_id in self._dirty if dialog_id in self._dialogs]
+        removed = list(self._removed)
+        self._dirty, self._removed = set(), set()
+        self._synced_changed = False
+        return rows, removed
+
+    def _start_flush(self):
+        self._flush_handle = None
+        if self.pending:
+            self._flush_task = asyncio.get_event_loop().create_task(self._flush())
+
+    async def _flush(self):
+        rows, removed = self._take_changes()
+        try:
+            await database.aio.run(self._write, self.client.account_name, rows, removed, self.synced)
+        except Exception:
+            LOGGER.exception("Failed to save the dialogs of %s, retrying later", self.client.account_name)
+            # The changes made since are newer
+            for row in rows:
+                if row["dialog_id"] not in self._removed:
+                    self._dirty.add(row["dialog_id"])
+            self._removed.update(dialog_id for dialog_id in removed if dialog_id not in self._dialogs)
+            self._synced_changed = True
+        finally:
+            self._flush_task = None
+            if self.pending:
+                self._schedule()
+
+    @staticmethod
+    def _read(account):
+        columns = dialogs_tbl.columns
+        rows = database.fetch_all(db.select([
+            columns.dialog_id, columns.kind, columns.name, columns.access_hash, columns.top_message, columns.date,
+            columns.unread, columns.mentions]).where(columns.account == account))
+        synced = database.fetch_one(db.select([sync_tbl.columns.synced]).where(sync_tbl.columns.account == account))
+        return [tuple(row) for row in rows], synced[0] if synced else None
+
+    @staticmethod
+    def _write(account, rows, removed, synced):
+        columns = dialogs_tbl.columns
+        ids = [row["dialog_id"] for row in rows] + removed
+        with database.transaction() as connection:
+            for start in range(0, len(ids), CHUNK_SIZE):
+                connection.execute(dialogs_tbl.delete().where(db.and_(
+                    columns.account == account, columns.dialog_id.in_(ids[start:start + CHUNK_SIZE]))))
+            if rows:
+                connection.execute(dialogs_tbl.insert(), [dict(row, account=account) for row in rows])
+            connection.execute(sync_tbl.delete().where(sync_tbl.columns.account == account))
+            connection.execute(sync_tbl.insert().values(account=account, synced=synced))
+
+    def close(self):
+        """ Writes the changes still buffered before the client disconnects """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+        if self.pending and database.engine is not None:
+            try:
+                self._write(self.client.account_name, *self._take_changes(), self.synced)
+            except Exception:
+                LOGGER.exception("Failed to save the dialogs of %s", self.client.account_name)
+
+    def stats(self):
+        return {
+            "dialogs": len(self._dialogs),
+            "crawls": self.crawls,
+            "refreshes": self.refreshes,
+            "fetched": self.fetched,
+            "live_updates": self.live_updates,
+            "pending": self.pending,
+        }
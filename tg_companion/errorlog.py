@@ -0,0 +1,140 @@
+import atexit
+import datetime
+import gzip
+import inspect
+import logging
+import os
+import queue
+import reprlib
+import shutil
+import time
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Locals listed in a frame with this name are skipped ( the frame of the logging wrapper itself )
+MARKER = "__lgw_marker_local__"
+
+
+class _BoundedQueueHandler(QueueHandler):
+    def __init__(self, log_queue, error_log):
+        super().__init__(log_queue)
+        self._error_log = error_log
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._error_log.dropped += 1
+
+
+def _walk_traceback(tb):
+    while tb is not None:
+        yield tb
+        tb = tb.tb_next
+
+
+def _gzip_rotator(source, dest):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def _gzip_namer(name):
+    return name + ".gz"
+
+
+class ErrorLog(object):
+    """
+    Writes the exceptions caught by `client.log_exception` to `logs/errors.log` from a background thread.
+
+    The frames and locals are formatted on the event loop, but every local is cut to `repr_limit`
+    characters so large objects stay cheap. The file rotates every `max_bytes` and the old files are gzipped.
+    The same exception raised from the same place is written at most once per `dedup_window` seconds,
+    the next record says how many times it was repeated in between.
+    """
+
+    def __init__(self, directory="logs", max_bytes=1024 * 1024, backup_count=5,
+                 repr_limit=256, dedup_window=300, queue_size=1000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._repr = reprlib.Repr()
+        self._repr.maxstring = repr_limit
+        self._repr.maxother = repr_limit
+        self._repr.maxlong = repr_limit
+        self._repr.maxlevel = 3
+        self.dedup_window = dedup_window
+        # fingerprint -> [time it was last written, times it was repeated since]
+        self._seen = OrderedDict()
+        self._queue = queue.Queue(queue_size)
+        self._logger = None
+        self._listener = None
+        self.written = 0
+        self.deduplicated = 0
+        self.dropped = 0
+
+    def _start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        file_handler = RotatingFileHandler(
+            os.path.join(self.directory, "errors.log"),
+            maxBytes=self.max_bytes, backupCount=self.backup_count, encoding="utf-8")
+        file_handler.rotator = _gzip_rotator
+        file_handler.namer = _gzip_namer
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+
+        self._listener = QueueListener(self._queue, file_handler)
+        self._listener.start()
+        atexit.register(self._listener.stop)
+
+        self._logger = logging.getLogger("tg_companion.errors")
+        self._logger.propagate = False
+        self._logger.addHandler(_BoundedQueueHandler(self._queue, self))
+
+    def _safe_repr(self, value):
+        try:
+            return self._repr.repr(value).replace("\n", "\\n")
+        except Exception as exc:
+            return f"<repr failed: {type(exc).__name__}>"
+
+    def log(self, exc, func_name):
+        """ Queues `exc` to be written. Must be called from the `except` block that caught it """
+        fingerprint = (type(exc).__name__, func_name, tuple(
+            (tb.tb_frame.f_code.co_filename, tb.tb_lineno) for tb in _walk_traceback(exc.__traceback__)))
+        now = time.monotonic()
+        seen = self._seen.get(fingerprint)
+        if seen is not None and now - seen[0] < self.dedup_window:
+            seen[1] += 1
+            self.deduplicated += 1
+            return
+        repeated = seen[1] if seen is not None else 0
+        self._seen[fingerprint] = [now, 0]
+        self._seen.move_to_end(fingerprint)
+        while len(self._seen) > 256:
+            self._seen.popitem(last=False)
+
+        if self._logger is None:
+            self._start()
+
+        frames = [frame_info for frame_info in reversed(inspect.getinnerframes(exc.__traceback__, context=1))
+                  if MARKER not in frame_info.frame.f_locals]
+
+        exc_time = datetime.datetime.now().strftime("%m/%d %H:%M:%S")
+        lines = [f"[{exc_time}] {func_name}: Exception thrown, {type(exc)}: {self._safe_repr(str(exc))}"]
+        if repeated:
+            lines.append(f"Repeated {repeated} times since it was last written")
+        for frame_info in frames:
+            code = frame_info.code_context[0].strip() if frame_info.code_context else ""
+            lines.append(f"File {frame_info.filename}, line {frame_info.lineno} in {frame_info.function}")
+            lines.append(f"    {code}")
+            for k, v in frame_info.frame.f_locals.items():
+                lines.append(f"        {k} = {self._safe_repr(v)}")
+        lines.append("")
+
+        self.written += 1
+        self._logger.error("\n".join(lines))
+
+    def stats(self):
+        return {"written": self.written, "deduplicated": self.deduplicated, "dropped": self.dropped}
@@ -0,0 +1,142 @@
+import asyncio
+import collections
+import time
+
+from telethon.errors import FloodWaitError
+
+
+class AdaptiveLimit(object):
+    """
+    A semaphore whose size follows the flood waits.
+
+    It starts at `maximum` slots. A flood wait halves it, down to `minimum`, and every `increase_after` calls in
+    a row without one give a slot back. The slots taken away are freed as the running calls end.
+
+    `flood_waits` returns how many flood waits the client hit so far. The client retries the short ones by itself,
+    so a call is also counted as flood waited when that number grew while it ran.
+    """
+
+    def __init__(self, maximum, minimum=1, increase_after=20, flood_waits=None):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.increase_after = increase_after
+        self.limit = self.maximum
+        self.active = 0
+        self.flood_waits = 0
+        self._flood_waits = flood_waits
+        self._seen = flood_waits() if flood_waits else 0
+        self._successes = 0
+        self._waiters = collections.deque()
+
+    async def acquire(self):
+        while self.active >= self.limit:
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                else:
+                    self._wake()
+                raise
+        self.active += 1
+
+    def release(self, flood_waited=False):
+        self.active -= 1
+        if self._flood_waits is not None:
+            seen = self._flood_waits()
+            # Only the first call to end after a flood wait shrinks the limit, the others ran alongside it
+            flood_waited = flood_waited or seen > self._seen
+            self._seen = seen
+
+        if flood_waited:
+            self.flood_waits += 1
+            self.limit = max(self.minimum, self.limit // 2)
+            self._successes = 0
+        else:
+            self._successes += 1
+            if self._successes >= self.increase_after and self.limit < self.maximum:
+                self.limit += 1
+                self._successes = 0
+        self._wake()
+
+    def _wake(self):
+        free = self.limit - self.active
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+async def fan_out(func, items, limit):
+    """ Awaits `func(item)` for every item under `limit` and returns the results in order, exceptions included """
+    async def run(item):
+        await limit.acquire()
+        flood_waited = False
+        try:
+            return await func(item)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            flood_waited = isinstance(exc, FloodWaitError)
+            return exc
+        finally:
+            limit.release(flood_waited)
+
+    return await asyncio.gather(*(run(item) for item in items))
+
+
+class Cooperator(object):
+    """
+    Lets a bulk job run in chunks between the commands.
+
+    `pause()` is awaited before every chunk. It measures how late the event loop runs a callback, which is how
+    long a command arriving now waits before its handler starts, and waits while that lag is above `target`
+    seconds or `busy()` returns True. It never waits more than `max_wait` seconds so the job still progresses
+    when commands keep coming.
+    """
+
+    def __init__(self, target, busy=None, max_wait=5.0, poll=0.05, samples=1000):
+        self.target = target
+        self.busy = busy
+        self.max_wait = max_wait
+        self.poll = poll
+        self.chunks = 0
+        self.yields = 0
+        self.waited = 0.0
+        self._lags = collections.deque(maxlen=samples)
+
+    async def _lag(self):
+        loop = asyncio.get_event_loop()
+        scheduled = loop.time()
+        ran = loop.create_future()
+        loop.call_soon(lambda: ran.done() or ran.set_result(loop.time()))
+        lag = await ran - scheduled
+        self._lags.append(lag)
+        return lag
+
+    async def pause(self):
+        self.chunks += 1
+        started = time.monotonic()
+        while True:
+            lag = await self._lag()
+            if lag <= self.target and not (self.busy and self.busy()):
+                break
+            if time.monotonic() - started >= self.max_wait:
+                break
+            self.yields += 1
+            await asyncio.sleep(self.poll)
+        self.waited += time.monotonic() - started
+
+    def stats(self):
+        lags = sorted(self._lags)
+        return {
+            "chunks": self.chunks,
+            "yields": self.yields,
+            "waited": round(self.waited, 2),
+            "target_ms": round(self.target * 1000, 1),
+            "lag_p95_ms": round(lags[min(len(lags) - 1, int(len(lags) * 0.95))] * 1000, 1) if lags else 0.0,
+            "lag_max_ms": round(lags[-1] * 1000, 1) if lags else 0.0,
+        }
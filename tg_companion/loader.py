@@ -0,0 +1,156 @@
+import importlib
+import importlib.util
+import json
+import os
+import sys
+
+from telethon import events
+
+from tg_companion import CMD_HANDLER, LOG_DIR, LOGGER, startup
+
+# Each worker of the supervisor has its own LOG_DIR, so its own manifest
+MANIFEST_PATH = os.path.join(LOG_DIR, "module_manifest.json")
+MANIFEST_VERSION = 2
+
+
+class ModuleLoader(object):
+    """
+    Imports the companion modules and plugins, lazily when possible.
+
+    After every module was imported once, a manifest mapping the modules to the commands they register is saved.
+    On the next starts the modules that only register commands are not imported: a stub is registered for each
+    of their commands instead and the module is imported by the first message using one of them. Modules with
+    passive handlers, raw event handlers or jobs are always imported. The manifest is rebuilt when a module file changes.
+
+    The stubs are built with the `outgoing`, `incoming`, `chats`, ... filters of the commands they stand for, so only
+    the messages the real handlers accept import a module. Modules whose filters can't be saved are always imported.
+    """
+
+    def __init__(self, client, cmd_help, path=MANIFEST_PATH):
+        """ `client` is the `ClientProxy`, the stubs are registered on each of its accounts """
+        self._client = client
+        self._cmd_help = cmd_help
+        self.path = path
+        self._registered = {}
+        self._stubs = {}
+        self.lazy = set()
+
+    def _entry(self, module):
+        return self._registered.setdefault(
+            module, {"eager": False, "commands": [], "edited_commands": [], "filters": {}, "help": {}})
+
+    def record_command(self, module, name, edited=False, filters=None):
+        """ `filters` are the keyword arguments the event builder of the command was created with """
+        entry = self._entry(module)
+        commands = entry["edited_commands"] if edited else entry["commands"]
+        if name not in commands:
+            commands.append(name)
+
+        filters = filters or {}
+        try:
+            json.dumps(filters)
+        except (TypeError, ValueError):
+            self.record_eager(module)
+            return
+        known = entry["filters"].setdefault(name, [])
+        if filters not in known:
+            known.append(filters)
+
+    def record_help(self, module, name, help):
+        self._entry(module)["help"][name] = help
+
+    def record_eager(self, module):
+        self._entry(module)["eager"] = True
+
+    @staticmethod
+    def _mtime(name):
+        spec = importlib.util.find_spec(name)
+        return os.path.getmtime(spec.origin)
+
+    def _read_manifest(self, names):
+        try:
+            with open(self.path) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            return None
+
+        modules = manifest.get("modules", {})
+        if manifest.get("version") != MANIFEST_VERSION or sorted(modules) != sorted(names):
+            return None
+        for name in names:
+            if modules[name]["mtime"] != self._mtime(name):
+                return None
+        return modules
+
+    def _write_manifest(self, names):
+        modules = {}
+        for name in names:
+            entry = dict(self._entry(name))
+            entry["mtime"] = self._mtime(name)
+            modules[name] = entry
+        # Written to a temporary file first so a start reading it meanwhile never sees half of it
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(temporary, "w") as manifest_file:
+                json.dump({"version": MANIFEST_VERSION, "modules": modules}, manifest_file, indent=2)
+            os.replace(temporary, self.path)
+        except OSError:
+            LOGGER.exception("Failed to write the module manifest")
+
+    def load(self, names):
+        """ Imports or registers stubs for the given modules ( full module names ) """
+        modules = self._read_manifest(names)
+        if modules is None:
+            LOGGER.info("Building the module manifest")
+            for name in names:
+                with startup.phase(name):
+                    importlib.import_module(name)
+            self._write_manifest(names)
+            return
+
+        for name in names:
+            entry = modules[name]
+            if entry["eager"]:
+                with startup.phase(name):
+                    importlib.import_module(name)
+            else:
+                self._add_stubs(name, entry)
+        LOGGER.info("Lazy modules: %s", ", ".join(sorted(name.rsplit(".", 1)[-1] for name in self.lazy)))
+
+    def _add_stubs(self, name, entry):
+        self.lazy.add(name)
+        self._cmd_help.update(entry["help"])
+        symbol = "".join("\\" + char for char in CMD_HANDLER)
+        stubs = self._stubs[name] = []
+        for account in self._client.accounts:
+            for router, builder, commands in (
+                    (account._commands, events.NewMessage, entry["commands"]),
+                    (account._edited_commands, events.MessageEdited, entry["edited_commands"])):
+                for command in commands:
+                    for filters in entry["filters"].get(command, [{}]):
+                        stub = self._stub(name, account, router)
+                        router.add(command, builder(pattern=symbol + command, **filters), stub)
+                        stubs.append((router, stub))
+
+    def _stub(self, name, account, router):
+        async def stub(event):
+            self.import_module(name)
+            routes = [route for route in router.lookup(event.message.message)
+                      if getattr(route[1], "__module__", None) == name]
+            await router.dispatch(account, event, routes)
+        return stub
+
+    def import_module(self, name):
+        """ Imports a lazy module and removes the stubs of every lazy module it imported """
+        if name not in self.lazy:
+            return sys.modules.get(name)
+
+        LOGGER.info("Loading module: %s", name)
+        module = importlib.import_module(name)
+        for lazy_name in list(self.lazy):
+            if lazy_name in sys.modules:
+                self.lazy.discard(lazy_name)
+                for router, stub in self._stubs.pop(lazy_name, ()):
+                    router.remove(stub)
+        return module
@@ -0,0 +1,170 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import time
+
+from telethon import events
+
+from tg_companion import LOGGER
+
+# The `HandlerMetrics` of the handler running in the current task, used to count the requests it sends
+current_handler = contextvars.ContextVar("current_handler", default=None)
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+
+class Histogram(object):
+    """ A fixed bucket histogram. Quantiles are interpolated inside the bucket they fall in """
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = BUCKETS[index - 1] if index else 0.0
+                upper = BUCKETS[index]
+                if upper == float("inf"):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return BUCKETS[-2]
+
+
+class HandlerMetrics(object):
+    __slots__ = ("name", "calls", "errors", "rpcs", "cpu", "latency")
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.rpcs = 0
+        # CPU time of the event loop thread while the handler ran, other tasks included when it awaited
+        self.cpu = 0.0
+        self.latency = Histogram()
+
+
+class Metrics(object):
+    """
+    Times every handler of the companion and counts its calls, errors and the requests it sends to Telegram.
+
+    The results are shown by the `metrics` command and, if `METRICS_PORT` is set, served on
+    http://127.0.0.1:METRICS_PORT/metrics in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._handlers = {}
+        self._gauges = {}
+        self._server = None
+
+    def handler(self, name):
+        metrics = self._handlers.get(name)
+        if metrics is None:
+            metrics = self._handlers[name] = HandlerMetrics(name)
+        return metrics
+
+    def handlers(self):
+        return sorted(self._handlers.values(), key=lambda metrics: metrics.calls, reverse=True)
+
+    def wrap(self, callback):
+        """ Returns `callback` timed under the name `<module>.<function>` """
+        if getattr(callback, "__metered__", False):
+            return callback
+        name = f"{callback.__module__.rsplit('.', 1)[-1]}.{getattr(callback, '__name__', repr(callback))}"
+        metrics = self.handler(name)
+
+        @functools.wraps(callback)
+        async def timed(*args, **kwargs):
+            token = current_handler.set(metrics)
+            started = time.perf_counter()
+            cpu_started = time.thread_time()
+            try:
+                return await callback(*args, **kwargs)
+            except (events.StopPropagation, asyncio.CancelledError):
+                raise
+            except Exception:
+                metrics.errors += 1
+                raise
+            finally:
+                metrics.calls += 1
+                metrics.cpu += time.thread_time() - cpu_started
+                metrics.latency.observe(time.perf_counter() - started)
+                current_handler.reset(token)
+
+        timed.__metered__ = True
+        return timed
+
+    @staticmethod
+    def count_requests(count=1):
+        metrics = current_handler.get()
+        if metrics is not None:
+            metrics.rpcs += count
+
+    def gauge(self, name, func, help=""):
+        """ Exports the value returned by `func()` as the `tg_companion_<name>` gauge """
+        self._gauges[name] = (func, help)
+
+    def render(self):
+        """ Returns every metric in the Prometheus text format """
+        lines = [
+            "# HELP tg_companion_handler_duration_seconds How long the handlers took",
+            "# TYPE tg_companion_handler_duration_seconds histogram",
+        ]
+        for metrics in self.handlers():
+            label = f'handler="{metrics.name}"'
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS, metrics.latency.counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'tg_companion_handler_duration_seconds_bucket{{{label},le="{le}"}} {cumulative}')
+            lines.append(f"tg_companion_handler_duration_seconds_sum{{{label}}} {metrics.latency.sum}")
+            lines.append(f"tg_companion_handler_duration_seconds_count{{{label}}} {metrics.latency.count}")
+
+        for counter, attribute, help in (
+                ("handler_calls_total", "calls", "How many times the handlers ran"),
+                ("handler_errors_total", "errors", "How many times the handlers raised"),
+                ("handler_requests_total", "rpcs", "How many requests the handlers sent to Telegram"),
+                ("handler_cpu_seconds_total", "cpu", "The CPU time used while the handlers ran")):
+            lines.append(f"# HELP tg_companion_{counter} {help}")
+            lines.append(f"# TYPE tg_companion_{counter} counter")
+            for metrics in self.handlers():
+                lines.append(f'tg_companion_{counter}{{handler="{metrics.name}"}} {getattr(metrics, attribute)}')
+
+        for name, (func, help) in sorted(self._gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                LOGGER.exception("Failed to read the %s gauge", name)
+                continue
+            lines.append(f"# HELP tg_companion_{name} {help}")
+            lines.append(f"# TYPE tg_companion_{name} gauge")
+            lines.append(f"tg_companion_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, port, host="127.0.0.1"):
+        """ Serves `render()` on http://host:port/metrics """
+        from aiohttp import web
+
+        async def handle(request):
+            return web.Response(text=self.render(), content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        self._server = web.AppRunner(app)
+        await self._server.setup()
+        await web.TCPSite(self._server, host, port).start()
+        LOGGER.info(f"Serving metrics on http://{host}:{port}/metrics")
@@ -35,12 +35,14 @@ async def ban_user(event):
     me = await client.get_me()
     split_text = event.text.split(None, 1)
 
-    if chat.creator or chat.admin_rights:
-        if chat.admin_rights:
-            if not chat.admin_rights.ban_users:
-                await client.update_message(event, "You don't have permission to ban users here")
+    permissions = await client.get_permissions(chat)
+
+    if permissions.is_admin:
+        if not permissions.can("ban_users"):
+            await client.update_message(event, "You don't have permission to ban users here")
+            return
         if event.reply_to_msg_id:
-            rep_msg = await event.get_reply_message()
+            rep_msg = await client.get_reply_message(event)
             user = await rep_msg.get_sender()
 
         elif len(split_text) > 1:
@@ -89,14 +91,15 @@ async def unban_user(event):
     me = await client.get_me()
     split_text = event.text.split(None, 1)
 
-    if chat.creator or chat.admin_rights:
-        if chat.admin_rights:
-            if not chat.admin_rights.ban_users:
-                await client.update_message(event, "You don't have permission to ban users here")
-                return
+    permissions = await client.get_permissions(chat)
+
+    if permissions.is_admin:
+        if not permissions.can("ban_users"):
+            await client.update_message(event, "You don't have permission to ban users here")
+            return
 
         if event.reply_to_msg_id:
-            rep_msg = await event.get_reply_message()
+            rep_msg = await client.get_reply_message(event)
             user = await rep_msg.get_sender()
 
         elif len(split_text) > 1:
@@ -148,12 +151,14 @@ async def mute_user(event):
     me = await client.get_me()
     split_text = event.text.split(None, 1)
 
-    if chat.creator or chat.admin_rights:
-        if chat.admin_rights:
-            if not chat.admin_rights.ban_users:
-                await client.update_message(event, "You don't have permission to mute users here")
+    permissions = await client.get_permissions(chat)
+
+    if permissions.is_admin:
+        if not permissions.can("ban_users"):
+            await client.update_message(event, "You don't have permission to mute users here")
+            return
         if event.reply_to_msg_id:
-            rep_msg = await event.get_reply_message()
+            rep_msg = await client.get_reply_message(event)
             user = await rep_msg.get_sender()
 
         elif len(split_text) > 1:
@@ -203,12 +208,14 @@ async def unmute_user(event):
     me = await client.get_me()
     split_text = event.text.split(None, 1)
 
-    if chat.creator or chat.admin_rights:
-        if chat.admin_rights:
-            if not chat.admin_rights.ban_users:
-                await client.update_message(event, "You don't have permission to unmute users here")
+    permissions = await client.get_permissions(chat)
+
+    if permissions.is_admin:
+        if not permissions.can("ban_users"):
+            await client.update_message(event, "You don't have permission to unmute users here")
+            return
         if event.reply_to_msg_id:
-            rep_msg = await event.get_reply_message()
+            rep_msg = await client.get_reply_message(event)
             user = await rep_msg.get_sender()
 
         elif len(split_text) > 1:
@@ -49,24 +49,30 @@ async def afk(event):
         await client.update_message(event, f"**I will be afk for a while.**")
 
 
-@client.CommandHandler(
-    outgoing=True,
-    func=lambda e: True if f"{CMD_HANDLER}afk" not in e.message.text else False)
+def _is_afk(event):
+    return "yes" in USER_AFK
+
+
+def _not_afk_command(event):
+    return f"{CMD_HANDLER}afk" not in (event.message.message or "")
+
+
+def _mentioned_or_private(event):
+    return event.mentioned or event.is_private
+
+
+@client.CommandHandler(outgoing=True, checks=(_is_afk, _not_afk_command))
 @client.log_exception
 async def no_afk(event):
-    chat = await event.get_chat()
     if "yes" in USER_AFK:
-        await client.send_message(chat.id, "`I'm no longer afk`")
         del USER_AFK["yes"]
+        await client.send_message(event.chat_id, "`I'm no longer afk`")
 
 
-@client.CommandHandler(
-    incoming=True,
-    func=lambda e: True if e.mentioned or e.is_private else False)
+@client.CommandHandler(incoming=True, checks=(_is_afk, _mentioned_or_private))
 @client.log_exception
 async def reply_afk(event):
     global afk_time
-    chat = await event.get_chat()
     afk_since = "**a while ago**"
 
     if event.mentioned or event.is_private:
@@ -103,8 +109,8 @@ async def reply_afk(event):
                     afk_since = f"`{int(seconds)}s` **ago**"
 
             if not reason:
-                await client.send_message(chat.id, f"**I'm afk since** {afk_since} **and I will be back soon**", reply_to=event.id)
+                await client.send_message(event.chat_id, f"**I'm afk since** {afk_since} **and I will be back soon**", reply_to=event.id)
                 return
 
-            await client.send_message(chat.id, f"**I'm afk since** {afk_since} **and I will be back soon**"
+            await client.send_message(event.chat_id, f"**I'm afk since** {afk_since} **and I will be back soon**"
                                       f" \n__Reason:__ {reason}", reply_to=event.id)
@@ -40,9 +40,10 @@ CNAME_HELP = """
 @client.log_exception
 async def update_profile_pic(event):
     if event.reply:
-        message = await event.get_reply_message()
+        message = await client.get_reply_message(event)
         chat = await event.get_chat()
-        if not chat.admin_rights or not chat.creator:
+        permissions = await client.get_permissions(chat)
+        if not permissions.can("change_info"):
             await client.update_message(event, "`Chat admin privileges are required to do that`")
             return
         photo = None
@@ -93,7 +94,8 @@ async def update_profile_bio(event):
     about = split_text[1]
     chat = await event.get_chat()
 
-    if not chat.admin_rights or not chat.creator:
+    permissions = await client.get_permissions(chat)
+    if not permissions.can("change_info"):
         await client.update_message(event, "`Chat admin privileges are required to do that`")
         return
 
@@ -119,7 +121,8 @@ async def change_profile_username(event):
     username = event.pattern_match.group(1)
     chat = await event.get_chat()
 
-    if not chat.admin_rights or not chat.creator:
+    permissions = await client.get_permissions(chat)
+    if not permissions.can("change_info"):
         await client.update_message(event, "`Chat admin privileges are required to do that`")
         return
 
@@ -166,7 +169,8 @@ async def change_profile_name(event):
 
     title = split_text[1]
     chat = await event.get_chat()
-    if not chat.admin_rights or not chat.creator:
+    permissions = await client.get_permissions(chat)
+    if not permissions.can("change_info"):
         await client.update_message(event, "`Chat admin privileges are required to do that`")
         return
     try:
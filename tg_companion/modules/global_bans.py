@@ -1,13 +1,12 @@
 import sqlalchemy as db
 from telethon import events
 from telethon.tl.functions.channels import EditBannedRequest
-from telethon.tl.types import (ChannelParticipantCreator,
-                               ChannelParticipantsAdmins, ChatBannedRights)
+from telethon.tl.types import ChatBannedRights
 
-from tg_companion.tgclient import DB_URI, client
-
-engine = db.create_engine(DB_URI)
-metadata = db.MetaData()
+from tg_companion import database
+from tg_companion.database import metadata
+from tg_companion.pipeline import raw_chat_id
+from tg_companion.tgclient import client
 
 
 gbans_tbl = db.Table("global_bans", metadata,
@@ -34,41 +33,27 @@ UNGBAN_HELP = """
             **Because of the API limitations you'll need to manually unban the user from your chats**
 """
 
-metadata.create_all(
-    bind=engine,
-    tables=[gbans_tbl, gban_chats_tbl],
-    checkfirst=True
-)
+database.create_tables(gbans_tbl, gban_chats_tbl)
 
 
 GBANNED_USERS = {}
 
-GBAN_ALLOWED_CHATS = []
+GBAN_ALLOWED_CHATS = set()
 
 
 def _load_gbanned_users():
-    GBANNED_USERS.clear()
-    connection = engine.connect()
-    query = db.select([gbans_tbl])
-    for row in connection.execute(query).fetchall():
-        if row:
-            GBANNED_USERS.update({row[0]: row[1]})
-    connection.close()
+    return {row[0]: row[1] for row in database.fetch_all(db.select([gbans_tbl])) if row}
 
 
 def _load_gban_enabled_chats():
-    GBAN_ALLOWED_CHATS.clear()
-    connection = engine.connect()
     query = db.select([gban_chats_tbl.columns.chat_id]).where(
         gban_chats_tbl.columns.is_enabled == db.true())
-    for row in connection.execute(query).fetchall():
-        if row:
-            GBAN_ALLOWED_CHATS.append(row[0])
-    connection.close()
+    return {row[0] for row in database.fetch_all(query) if row}
 
 
-_load_gbanned_users()
-_load_gban_enabled_chats()
+# Other processes, like the workers of the supervisor, ban users and enable chats too
+gbanned_users = database.Reloader(_load_gbanned_users, GBANNED_USERS)
+gban_allowed_chats = database.Reloader(_load_gban_enabled_chats, GBAN_ALLOWED_CHATS)
 
 
 @client.CommandHandler(outgoing=True, command="gban", help=GBAN_HELP)
@@ -82,7 +67,7 @@ async def gban_user(event):
     split_text = del_cmd_text.split(None, 1)
 
     if event.reply_to_msg_id:
-        rep_msg = await event.get_reply_message()
+        rep_msg = await client.get_reply_message(event)
         user = await rep_msg.get_sender()
         reason = del_cmd_text
 
@@ -110,28 +95,22 @@ async def gban_user(event):
     else:
         banned_user = user.first_name
 
-    connection = engine.connect()
-    query = db.select([gbans_tbl]).where(gbans_tbl.columns.user_id == user.id)
-    extract_db_user = connection.execute(query).fetchall()
-    if extract_db_user:
-        for user_data in extract_db_user:
-            if user_data[0]:
-                if reason:
-                    await event.reply(f"`This user is already banned but I will update the gban reason!`")
-                    query = db.update(gbans_tbl).where(
-                        gbans_tbl.columns.user_id == user.id).values(
-                        reason=reason)
-                    connection.close()
-                    _load_gbanned_users()
-                    return
-                else:
-                    await event.reply("`This user is already gbanned. You can update the gban reason by sending another one`")
-                    connection.close()
-                    return
+    gbanned_users.refresh()
+    if user.id in GBANNED_USERS:
+        if reason:
+            await event.reply(f"`This user is already banned but I will update the gban reason!`")
+            await database.aio.execute(db.update(gbans_tbl).where(
+                gbans_tbl.columns.user_id == user.id).values(
+                reason=reason))
+            GBANNED_USERS[user.id] = reason
+            gbanned_users.changed()
+        else:
+            await event.reply("`This user is already gbanned. You can update the gban reason by sending another one`")
+        return
 
-    query = db.insert(gbans_tbl).values(user_id=user.id, reason=reason)
-    connection.execute(query)
-    connection.close()
+    await database.aio.upsert(gbans_tbl, {"user_id": user.id}, reason=reason)
+    GBANNED_USERS[user.id] = reason
+    gbanned_users.changed()
 
     if reason:
         await event.reply(f"__Gbanned:__ `{banned_user}`"
@@ -142,7 +121,6 @@ async def gban_user(event):
         await event.reply(f"__Gbanned:__ `{banned_user}`"
                           "\n**This user will be banned in any chat I'm admin and the owner allows/allowed global bans from this companion"
                           " using** `.enablegbans` **command**")
-    _load_gbanned_users()
 
 
 @client.CommandHandler(outgoing=True, command="ungban", help=UNGBAN_HELP)
@@ -154,7 +132,7 @@ async def un_gban(event):
     split_text = del_cmd_text.split(None, 1)
 
     if event.reply_to_msg_id:
-        rep_msg = await event.get_reply_message()
+        rep_msg = await client.get_reply_message(event)
         user = await rep_msg.get_sender()
 
     else:
@@ -177,29 +155,28 @@ async def un_gban(event):
     else:
         unbanned_user = user.first_name
 
-    connection = engine.connect()
-    query = db.select([gbans_tbl]).where(gbans_tbl.columns.user_id == user.id)
-    extract_db_user = connection.execute(query).fetchall()
-    if extract_db_user:
-        query = gbans_tbl.delete().where(
-            gbans_tbl.columns.user_id == user.id)
-        connection.execute(query)
+    if await database.aio.execute(gbans_tbl.delete().where(gbans_tbl.columns.user_id == user.id)):
+        GBANNED_USERS.pop(user.id, None)
+        gbanned_users.changed()
         await event.reply(f"__Ungbanned:__ `{unbanned_user}`"
                           "\n**This user have been deleted from the globally banned users database"
                           " but because of the API limitation you need to manually ungban him in any chat you want him to join again**")
 
     else:
         await event.reply("`This user isn't globally banned`.")
-    connection.close()
-    _load_gbanned_users()
 
 
-@client.on(
-    events.NewMessage(
-        incoming=True,
-        outgoing=False,
-        chats=GBAN_ALLOWED_CHATS,
-        from_users=[id for id, _ in GBANNED_USERS.items()]))
+def _gbans_enabled_chat(event):
+    gban_allowed_chats.refresh()
+    return raw_chat_id(event) in GBAN_ALLOWED_CHATS
+
+
+def _sender_gbanned(event):
+    gbanned_users.refresh()
+    return event.sender_id in GBANNED_USERS
+
+
+@client.CommandHandler(incoming=True, checks=(_gbans_enabled_chat, _sender_gbanned))
 @client.log_exception
 async def ban_on_msg(event):
     chat = await event.get_chat()
@@ -224,13 +201,14 @@ async def ban_on_msg(event):
     await client(EditBannedRequest(chat.id, user, rights))
 
 
-@client.on(events.ChatAction(chats=GBAN_ALLOWED_CHATS))
+@client.on(events.ChatAction(func=_gbans_enabled_chat))
 @client.log_exception
 async def ban_on_join(event):
     chat = await event.get_chat()
     user = await event.get_user()
     if event.user_joined:
-        if chat.creator or chat.admin_rights:
+        permissions = await client.get_permissions(chat)
+        if permissions.can("ban_users"):
             if user.id in GBANNED_USERS:
                 reason = GBANNED_USERS.get(user.id)
                 if reason:
@@ -257,6 +235,7 @@ async def ban_on_join(event):
         outgoing=True,
         incoming=True,
         pattern=r"\.disablegbans"))
+@client.limit(max_concurrent=1, policy="drop")
 @client.log_exception
 async def disable_gbans(event):
     if not event.reply_to_msg_id:
@@ -265,29 +244,19 @@ async def disable_gbans(event):
 
     chat = await event.get_chat()
     user = await event.get_sender()
-    for admin in await client.get_participants(chat.id, filter=ChannelParticipantsAdmins):
-        if isinstance(admin.participant, ChannelParticipantCreator):
-            if user.id == admin.participant.user_id:
-                connection = engine.connect()
-                query = db.select(
-                    [gban_chats_tbl]).where(
-                    gban_chats_tbl.columns.chat_id == chat.id)
-                for row in connection.execute(query).fetchall():
-                    if row:
-                        if row[1] is True:
-                            query = db.update(
-                                [gban_chats_tbl]).where(
-                                gban_chats_tbl.columns.chat_id == chat.id).values(
-                                is_enabled=False)
-                            await event.reply("`Disabled global bans from this companion.\m`"
-                                              "**Because of the API limitations you'll need to manually unban gbanned users from this group**")
-                            connection.execute(query)
-                            connection.close()
-                    else:
-                        await event.reply("This chat doesn't have the companion's global bans enabled")
-            else:
-                await event.reply("`Only chat owners can disable global bans from this companion`")
-            _load_gban_enabled_chats()
+    admins = await client.get_chat_admins(chat)
+    gban_allowed_chats.refresh()
+    if user.id == admins.creator_id:
+        if chat.id in GBAN_ALLOWED_CHATS:
+            await database.aio.upsert(gban_chats_tbl, {"chat_id": chat.id}, is_enabled=False)
+            GBAN_ALLOWED_CHATS.discard(chat.id)
+            gban_allowed_chats.changed()
+            await event.reply("`Disabled global bans from this companion.\m`"
+                              "**Because of the API limitations you'll need to manually unban gbanned users from this group**")
+        else:
+            await event.reply("This chat doesn't have the companion's global bans enabled")
+    else:
+        await event.reply("`Only chat owners can disable global bans from this companion`")
 
 
 @client.on(
@@ -295,6 +264,7 @@ async def disable_gbans(event):
         outgoing=True,
         incoming=True,
         pattern=r"\.enablegbans"))
+@client.limit(max_concurrent=1, policy="drop")
 @client.log_exception
 async def enable_gbans(event):
     if not event.reply_to_msg_id:
@@ -303,29 +273,16 @@ async def enable_gbans(event):
 
     chat = await event.get_chat()
     user = await event.get_sender()
-    for admin in await client.get_participants(chat.id, filter=ChannelParticipantsAdmins):
-        if isinstance(admin.participant, ChannelParticipantCreator):
-            if user.id == admin.participant.user_id:
-                connection = engine.connect()
-                query = db.select(
-                    [gban_chats_tbl]).where(
-                    gban_chats_tbl.columns.chat_id == chat.id)
-                for row in connection.execute(query).fetchall():
-                    if row:
-                        if row[1] is False:
-                            query = db.update(
-                                [gban_chats_tbl]).where(
-                                gban_chats_tbl.columns.chat_id == chat.id).values(
-                                is_enabled=True)
-                            await event.reply("`Enabled global bans from this companion.\m`"
-                                              "**Because of the API limitations you'll need to manually unban gbanned users from this group**")
-                        else:
-                            await event.reply("This chat already has enabled the companion's global bans")
-                    else:
-                        query = db.insert(gban_chats_tbl).values(
-                            chat_id=chat.id, is_enabled=True)
-                    connection.execute(query)
-                    connection.close()
-            else:
-                await event.reply("`Only chat owners can enable global bans from this companion`")
-            _load_gban_enabled_chats
+    admins = await client.get_chat_admins(chat)
+    gban_allowed_chats.refresh()
+    if user.id == admins.creator_id:
+        if chat.id not in GBAN_ALLOWED_CHATS:
+            await database.aio.upsert(gban_chats_tbl, {"chat_id": chat.id}, is_enabled=True)
+            GBAN_ALLOWED_CHATS.add(chat.id)
+            gban_allowed_chats.changed()
+            await event.reply("`Enabled global bans from this companion.\m`"
+                              "**Because of the API limitations you'll need to manually unban gbanned users from this group**")
+        else:
+            await event.reply("This chat already has enabled the companion's global bans")
+    else:
+        await event.reply("`Only chat owners can enable global bans from this companion`")
@@ -1,31 +1,25 @@
 import sqlalchemy as db
 
-from tg_companion.tgclient import DB_URI, client
+from tg_companion import database
+from tg_companion.database import metadata
+from tg_companion.tgclient import client
 
 NOTES = {}
 
-engine = db.create_engine(DB_URI)
-metadata = db.MetaData()
-
 notes_tbl = db.Table("notes", metadata,
                      db.Column("notename", db.String(), primary_key=True),
                      db.Column("note", db.String()))
 
 
-metadata.create_all(engine, [notes_tbl], checkfirst=True)
+database.create_tables(notes_tbl)
 
 
 def _load_notes():
-    NOTES.clear()
-    query = db.select([notes_tbl])
-    connection = engine.connect()
-    for row in connection.execute(query).fetchall():
-        if row:
-            NOTES.update({row[0]: row[1]})
-    connection.close()
+    return {row[0]: row[1] for row in database.fetch_all(db.select([notes_tbl])) if row}
 
 
-_load_notes()
+# Notes saved from the other processes show up after a reload
+notes = database.Reloader(_load_notes, NOTES)
 
 SAVE_HELP = """
     **Globally save a note.**
@@ -56,7 +50,7 @@ async def save_note(event):
     split_text = event.text.split(None, 2)
 
     if event.reply_to_msg_id:
-        repl_msg = await event.get_reply_message()
+        repl_msg = await client.get_reply_message(event)
         if len(split_text) == 1:
             await client.update_message(event, SAVE_HELP)
             return
@@ -73,20 +67,11 @@ async def save_note(event):
         note_name = split_text[1]
         note_content = split_text[2]
 
-    connection = engine.connect()
-
-    if note_name not in NOTES:
-        query = db.insert(notes_tbl).values(
-            notename=note_name, note=note_content)
-    else:
-        query = db.update(notes_tbl).where(
-            notes_tbl.columns.notename == note_name).values(
-            note=note_content)
-    connection.execute(query)
-    connection.close()
+    await database.aio.upsert(notes_tbl, {"notename": note_name}, note=note_content)
+    NOTES[note_name] = note_content
+    notes.changed()
 
     await client.update_message(event, f"Globally saved `{note_name}`. Get it using the command `get {note_name}`")
-    _load_notes()
 
 
 @client.CommandHandler(outgoing=True, command="get", help=GET_HELP)
@@ -99,6 +84,7 @@ async def get_note(event):
         return
 
     note_name = split_text[1]
+    notes.refresh()
 
     if note_name not in NOTES:
         await client.update_message(event, "There's no note with that name")
@@ -116,22 +102,22 @@ async def remove_note(event):
         return
 
     note_name = split_text[1]
+    notes.refresh()
 
     if note_name not in NOTES:
         await client.update_message(event, "There's no note with that name")
         return
 
-    query = notes_tbl.delete().where(notes_tbl.columns.notename == note_name)
-    connection = engine.connect()
-    connection.execute(query)
-    connection.close()
-    _load_notes()
+    await database.aio.execute(notes_tbl.delete().where(notes_tbl.columns.notename == note_name))
+    NOTES.pop(note_name, None)
+    notes.changed()
     await client.update_message(event, f"Deleted `{note_name}` from database")
 
 
 @client.CommandHandler(outgoing=True, command="notes", help=NOTES_HELP)
 @client.log_exception
 async def list_notes(event):
+    notes.refresh()
     listnotes = []
     for notename, _ in NOTES.items():
         listnotes.append(notename)
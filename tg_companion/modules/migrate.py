@@ -3,13 +3,10 @@ from telethon.tl.functions.channels import InviteToChannelRequest
 from telethon.tl.functions.messages import AddChatUserRequest
 from telethon.tl.types import User
 
+from tg_companion.dialogs import GROUP, SUPERGROUP
+from tg_companion.ratelimit import background
 from tg_companion.tgclient import client
 
-CHAT_IDS = []
-FAILED_CHATS = []
-FAILED_CHATS_COUNT = 0
-MIGRATED_CHATS_COUNT = 0
-
 MIGRATE_HELP = """
     **Migrate all your chats to a second account**
         __Args:__
@@ -19,13 +16,11 @@ MIGRATE_HELP = """
 
 @client.CommandHandler(
     outgoing=True,
-    command="migrate")
+    command="migrate",
+    max_concurrent=1,
+    policy="drop")
 @client.log_exception
 async def account_migrate(event):
-    global CHAT_IDS
-    global FAILED_CHATS
-    global FAILED_CHATS_COUNT
-
     await client.update_message(event, 
         "`Migrating Chats. This might take a while so relax. and check this message later`"
     )
@@ -39,43 +34,50 @@ async def account_migrate(event):
     username = split_text[1]
     entity = await client.get_entity(username)
 
+    with background():
+        await _migrate_chats(event, entity, username)
+
+
+async def _migrate_chats(event, entity, username):
+    # Local to the run, each account migrates its own chats
+    CHAT_IDS = []
+    FAILED_CHATS = []
+    FAILED_CHATS_COUNT = 0
+
     if isinstance(entity, User):
         if entity.contact:
-            dialogs = await client.get_dialogs(limit=None)
-            for dialog in dialogs:
-                if dialog.is_group:
-                    if dialog.id not in CHAT_IDS:
-                        CHAT_IDS.append(dialog.id)
-                if dialog.is_channel:
-                    if dialog.is_group:
-                        if dialog.id not in CHAT_IDS:
-                            CHAT_IDS.append(dialog.id)
+            for dialog in await client.dialog_index.dialogs(GROUP, SUPERGROUP):
+                if dialog.id not in CHAT_IDS:
+                    CHAT_IDS.append(dialog.id)
             if CHAT_IDS:
-                for id in CHAT_IDS:
-                    try:
-                        await client(
-                            AddChatUserRequest(
-                                chat_id=id, user_id=username, fwd_limit=1
-                            )
-                        )
-                    except Exception as exc:
-                        if isinstance(exc, errors.ChatIdInvalidError):
-                            try:
-                                await client(
-                                    InviteToChannelRequest(channel=id, users=[username])
+                async with client.progress_message(event) as progress:
+                    for done, id in enumerate(CHAT_IDS, start=1):
+                        try:
+                            await client(
+                                AddChatUserRequest(
+                                    chat_id=id, user_id=username, fwd_limit=1
                                 )
-                            except Exception:
+                            )
+                        except Exception as exc:
+                            if isinstance(exc, errors.ChatIdInvalidError):
+                                try:
+                                    await client(
+                                        InviteToChannelRequest(channel=id, users=[username])
+                                    )
+                                except Exception:
+                                    chat = await client.get_entity(id)
+                                    if id not in FAILED_CHATS:
+                                        FAILED_CHATS.append(chat.id)
+                                        FAILED_CHATS_COUNT = FAILED_CHATS_COUNT + 1
+
+                                    pass
+                            else:
                                 chat = await client.get_entity(id)
                                 if id not in FAILED_CHATS:
                                     FAILED_CHATS.append(chat.id)
                                     FAILED_CHATS_COUNT = FAILED_CHATS_COUNT + 1
 
-                                pass
-                        else:
-                            chat = await client.get_entity(id)
-                            if id not in FAILED_CHATS:
-                                FAILED_CHATS.append(chat.id)
-                                FAILED_CHATS_COUNT = FAILED_CHATS_COUNT + 1
+                        progress.update(f"`Migrating chats: {done}/{len(CHAT_IDS)}`")
 
                 REPLY = f"Failed to migrate `{FAILED_CHATS_COUNT}` chat because a problem has occurred or you are already in those groups/channels\n"
 
@@ -1,3 +1,5 @@
+import asyncio
+import datetime
 import io
 import os
 import platform
@@ -6,13 +8,14 @@ import sys
 import time
 from html import escape
 
-import aiohttp
 import telethon
 from telethon.tl.functions.users import GetFullUserRequest
 from telethon.tl.types import User
 
+from tg_companion import LOG_DIR, database, startup, web
 from tg_companion.modules.rextester.api import Rextester, UnknownLanguage
 from tg_companion.modules.global_bans import GBANNED_USERS
+from tg_companion.ratelimit import background
 from tg_companion.tgclient import client
 
 from .._version import __version__
@@ -55,6 +58,50 @@ DISCONNECT_HELP = """
     **Disconnects the companion from Telegram**
 """
 
+PIPELINE_HELP = """
+    **Show how many messages each stage of the passive handlers let through (hits) or skipped (misses)**
+"""
+
+CACHE_HELP = """
+    **Show the size and hit ratio of the entity, username and reply caches**
+"""
+
+REQUESTS_HELP = """
+    **Show how many requests were sent by commands and background jobs, how many were delayed and the flood waits hit**
+"""
+
+JOBS_HELP = """
+    **List the periodic jobs or control one of them**
+        __Args:__
+            `run <job>` - __Start the job now__
+            `pause <job>` - __Stop running the job__
+            `resume <job>` - __Run the job again__
+"""
+
+TASKS_HELP = """
+    **List the commands that are still running or cancel one of them**
+        __Args:__
+            `cancel <id>` - **(optional)** __Cancel the command with the given id__
+"""
+
+DB_HELP = """
+    **Show how the database connections are used and how long the queries take**
+"""
+
+PERF_HELP = """
+    **Show performance reports**
+        __Args:__
+            `startup` - __Where the startup time went__
+"""
+
+METRICS_HELP = """
+    **Show how many times each handler ran, how long it took (p50/p95/p99 in ms), its errors and the requests it sent**
+"""
+
+LAG_HELP = """
+    **Show how late the companion reacts because something blocked it, in milliseconds**
+"""
+
 LOGOUT_HELP = """
     **Logs out the companion from Telegram and deletes the session**
 """
@@ -63,11 +110,11 @@ LOGOUT_HELP = """
 @client.log_exception
 async def ping(event):
     start_time = time.time()
-    async with aiohttp.ClientSession() as session:
-        async with session.get("https://www.google.com"):
-            end_time = time.time()
-            ping_time = float(end_time - start_time) * 1000
-            await client.update_message(event, f"Ping time was: {ping_time}ms")
+    session = web.session()
+    async with session.get("https://www.google.com"):
+        end_time = time.time()
+        ping_time = float(end_time - start_time) * 1000
+        await client.update_message(event, f"Ping time was: {ping_time}ms")
 
 
 @client.CommandHandler(outgoing=True, command="version", help=VER_HELP)
@@ -91,7 +138,7 @@ async def user_info(event):
     chat = await event.get_chat()
 
     if event.reply_to_msg_id:
-        message = await event.get_reply_message()
+        message = await client.get_reply_message(event)
         user = await message.get_sender()
 
     if len(event.text.split()) > 1:
@@ -196,8 +243,8 @@ async def rextestercli(event):
 @client.log_exception
 async def send_logs(event):
 
-    if os.path.isdir("logs/"):
-        await client.send_from_disk(event, "logs/")
+    if os.path.isdir(LOG_DIR):
+        await client.send_from_disk(event, os.path.join(LOG_DIR, ""))
     else:
         await client.update_message(event, "`There are no logs saved!`")
 
@@ -251,14 +298,180 @@ async def py_execute(event):
         await client.update_message(event, "Did you forget to output something?")
 
 
-@client.CommandHandler(outgoing=True, command="readall", help=READALL_HELP)
+@client.CommandHandler(outgoing=True, command="readall", help=READALL_HELP, max_concurrent=1, policy="drop")
 @client.log_exception
 async def readall(event):
     await client.update_message(event, "`Marking all the unread messages as read.. Please wait...`")
-    async for dialog in client.iter_dialogs(limit=None):
-        await client.send_read_acknowledge(dialog, clear_mentions=True)
+    with background():
+        # The index marks the unread dialogs from the updates, only their counters are fetched again
+        for dialog in await client.dialog_index.unread():
+            await client.send_read_acknowledge(dialog.input_entity, clear_mentions=bool(dialog.mentions))
+            client.dialog_index.read(dialog.id)
     await client.update_message(event, "`Done. All the messages are marked as read`")
 
+
+@client.CommandHandler(outgoing=True, command="pipeline", help=PIPELINE_HELP)
+@client.log_exception
+async def pipeline_stats(event):
+    OUTPUT = "**Passive handlers:**\n"
+    for label, stats in (("new", client.passive_stats()), ("edited", client.passive_stats(edited=True))):
+        for name, calls, stages in stats:
+            OUTPUT += f"\n`{name}` ({label}) - __calls:__ `{calls}`"
+            for stage, hits, misses in stages:
+                OUTPUT += f"\n    `{stage}`: `{hits}` hits / `{misses}` misses"
+    await client.update_message(event, OUTPUT)
+
+
+@client.CommandHandler(outgoing=True, command="cache", help=CACHE_HELP)
+@client.log_exception
+async def cache_stats(event):
+    OUTPUT = "**Caches:**\n"
+    for name, stats in client.cache_stats().items():
+        OUTPUT += (f"\n`{name}`: `{stats['size']}/{stats['maxsize']}` entries,"
+                   f" `{stats['hits']}` hits, `{stats['misses']}` misses (`{stats['hit_ratio']}`),"
+                   f" `{stats['evictions']}` evicted, `{stats['expired']}` expired")
+    await client.update_message(event, OUTPUT)
+
+
+@client.CommandHandler(outgoing=True, command="requests", help=REQUESTS_HELP)
+@client.log_exception
+async def request_stats(event):
+    stats = client.request_stats()
+    OUTPUT = "**Requests:**\n"
+    for lane, sent in stats["requests"].items():
+        OUTPUT += f"\n`{lane}`: `{sent}` sent, `{stats['delayed'][lane]}` delayed"
+    OUTPUT += f"\n\n__Flood waits:__ `{stats['flood_waits']}`"
+    await client.update_message(event, OUTPUT)
+
+
+@client.CommandHandler(outgoing=True, command="jobs", help=JOBS_HELP)
+@client.log_exception
+async def jobs(event):
+    split_text = event.text.split()[1:]
+    if len(split_text) == 2:
+        action, name = split_text
+        if action not in ("run", "pause", "resume"):
+            await client.update_message(event, JOBS_HELP)
+            return
+        if client.jobs.get(name) is None:
+            await client.update_message(event, f"`No job named {name}`")
+            return
+        if action == "run" and not client.jobs.run(name):
+            await client.update_message(event, f"`{name} is already running`")
+            return
+        if action == "pause":
+            client.jobs.pause(name)
+        elif action == "resume":
+            client.jobs.resume(name)
+        await client.update_message(event, f"`{action}: {name}`")
+        return
+
+    OUTPUT = "**Jobs:**\n"
+    for job in client.jobs.jobs():
+        if job.running:
+            state = "running"
+        elif job.paused:
+            state = "paused"
+        else:
+            state = "next run " + datetime.datetime.fromtimestamp(job.next_run).strftime("%m/%d %H:%M:%S")
+        OUTPUT += (f"\n`{job.name}` - __every__ `{job.interval}s`, `{state}`,"
+                   f" `{job.runs}` runs, `{job.failures}` failed, `{job.skipped}` skipped")
+        if job.last_duration is not None:
+            OUTPUT += f", __last took__ `{round(job.last_duration, 1)}s`"
+    await client.update_message(event, OUTPUT)
+
+
+@client.CommandHandler(outgoing=True, command="tasks", help=TASKS_HELP)
+@client.log_exception
+async def tasks(event):
+    split_text = event.text.split()[1:]
+    if len(split_text) == 2 and split_text[0] == "cancel" and split_text[1].isdigit():
+        if client.cancel_task(int(split_text[1])):
+            await client.update_message(event, f"`Cancelled task {split_text[1]}`")
+        else:
+            await client.update_message(event, f"`No running task with id {split_text[1]}`")
+        return
+
+    OUTPUT = "**Running tasks:**\n"
+    for task in client.handler_tasks():
+        if task.task is asyncio.current_task():
+            continue
+        OUTPUT += f"\n`{task.id}` - `{task.name}` in `{task.chat_id}` for `{round(task.elapsed)}s`"
+    await client.update_message(event, OUTPUT)
+
+
+@client.CommandHandler(outgoing=True, command="db", help=DB_HELP)
+@client.log_exception
+async def db_stats(event):
+    stats = database.stats()
+    OUTPUT = (f"**Database:**\n"
+              f"\n__Connections opened:__ `{stats['connects']}`"
+              f"\n__Checkouts:__ `{stats['checkouts']}`"
+              f"\n__In use:__ `{stats['checked_out']}` (max `{stats['max_checked_out']}`)")
+    if "pool" in stats:
+        OUTPUT += f"\n__Pool:__ `{stats['pool']}`"
+    queries = stats["queries"]
+    OUTPUT += (f"\n\n__Queries:__ `{queries['calls']}`, `{queries['pending']}` pending"
+               f"\n__Query time:__ `{queries['avg_time']}s` avg, `{queries['max_time']}s` max")
+    session = client.session.stats()
+    OUTPUT += (f"\n\n__Session rows:__ `{session['received']}` received, `{session['skipped']}` unchanged, "
+               f"`{session['pending']}` pending"
+               f"\n__Session writes:__ `{session['written']}` rows in `{session['flushes']}` batches")
+    index = client.dialog_index.stats()
+    OUTPUT += (f"\n\n__Dialog index:__ `{index['dialogs']}` dialogs, `{index['pending']}` changes pending"
+               f"\n__Dialogs fetched:__ `{index['fetched']}` in `{index['crawls']}` crawls and "
+               f"`{index['refreshes']}` refreshes, `{index['live_updates']}` live updates")
+    await client.update_message(event, OUTPUT)
+
+
+@client.CommandHandler(outgoing=True, command="perf", help=PERF_HELP)
+@client.log_exception
+async def perf(event):
+    split_text = event.text.split()
+    if len(split_text) != 2 or split_text[1] != "startup":
+        await client.update_message(event, PERF_HELP)
+        return
+
+    OUTPUT = f"**Startup:** __ready after__ `{startup.ready_at}s`\n"
+    for phase in startup.phases:
+        OUTPUT += f"\n{'    ' * phase['depth']}`{phase['name']}`: `{phase['duration']}s`"
+    if len(OUTPUT) > 4096:
+        OUTPUT = f"**Startup:** __ready after__ `{startup.ready_at}s`\n\n__Slowest phases:__"
+        for phase in startup.slowest(10):
+            OUTPUT += f"\n`{phase['name']}`: `{phase['duration']}s`"
+    await client.update_message(event, OUTPUT)
+
+
+@client.CommandHandler(outgoing=True, command="metrics", help=METRICS_HELP)
+@client.log_exception
+async def metrics(event):
+    OUTPUT = "**Handlers:**\n"
+    for handler in client.metrics.handlers():
+        if not handler.calls:
+            continue
+        latency = [round(handler.latency.quantile(q) * 1000, 1) for q in (0.5, 0.95, 0.99)]
+        line = (f"\n`{handler.name}` - `{handler.calls}` calls, `{handler.errors}` errors,"
+                f" `{handler.rpcs}` requests, `{latency[0]}/{latency[1]}/{latency[2]}ms`")
+        if len(OUTPUT) + len(line) > 4096:
+            break
+        OUTPUT += line
+    await client.update_message(event, OUTPUT)
+
+
+@client.CommandHandler(outgoing=True, command="lag", help=LAG_HELP)
+@client.log_exception
+async def loop_lag(event):
+    stats = client.loop_lag.stats()
+    await client.update_message(
+        event,
+        f"**Event loop lag:**\n"
+        f"\n__Last:__ `{stats['last']}ms`"
+        f"\n__Average:__ `{stats['avg']}ms`"
+        f"\n__95th percentile:__ `{stats['p95']}ms`"
+        f"\n__Max:__ `{stats['max']}ms`"
+        f"\n__Samples:__ `{stats['samples']}`")
+
+
 @client.CommandHandler(outgoing=True, command="disconnect", help=DISCONNECT_HELP)
 async def disconnect_companion(event):
     await client.update_message(event, "Thanks for using Telegram Companion. Goodbye!")
@@ -1,80 +1,85 @@
 import sqlalchemy as db
 from telethon.tl.functions.contacts import BlockRequest
 
-from tg_companion import BLOCK_PM, NOPM_SPAM
-from tg_companion.tgclient import DB_URI, client
+from tg_companion import BLOCK_PM, NOPM_SPAM, database
+from tg_companion.database import metadata
+from tg_companion.tgclient import client
 
 PM_WARNS = {}
 
 
-ACCEPTED_USERS = []
+ACCEPTED_USERS = set()
 
 APPROVE_HELP = """
     **Aprove a private message from a user. Works only if NOPM_SPAM is enabled in config.env or exported**
         __Usage:__
             __Send in in PM of any unaproved user__ **Works only in private**
 """
-engine = db.create_engine(DB_URI)
-metadata = db.MetaData()
-
 private_messages_tbl = db.Table("private_messages", metadata,
                                 db.Column("chat_id", db.Integer()))
 
 
-connection = engine.connect()
+database.create_tables(private_messages_tbl)
+
+
+def _load_accepted_users():
+    return {row[0] for row in database.fetch_all(db.select([private_messages_tbl])) if row}
+
+
+# Users approved from the other processes show up after a reload
+accepted_users = database.Reloader(_load_accepted_users, ACCEPTED_USERS)
+
+
+def _block_pm_enabled(event):
+    return BLOCK_PM
 
-metadata.create_all(
-    bind=engine,
-    tables=[private_messages_tbl],
-    checkfirst=True)
 
-query = db.select([private_messages_tbl])
-load_privates = connection.execute(query).fetchall()
-for row in load_privates:
-    if row:
-        ACCEPTED_USERS.append(row[0])
+def _nopm_spam_enabled(event):
+    return NOPM_SPAM and not BLOCK_PM
 
 
-@client.CommandHandler(incoming=True, func=lambda e: BLOCK_PM and e.is_private)
+def _is_private(event):
+    return event.is_private
+
+
+def _not_accepted(event):
+    accepted_users.refresh()
+    return event.chat_id not in ACCEPTED_USERS
+
+
+@client.CommandHandler(incoming=True, checks=(_block_pm_enabled, _is_private, _not_accepted))
 async def block_pm(event):
     sender = await event.get_sender()
-    if BLOCK_PM and not sender.bot:
-        chat = await event.get_chat()
-        if chat.id not in ACCEPTED_USERS:
-            await client(BlockRequest(chat.id))
+    if not sender.bot:
+        await client(BlockRequest(event.chat_id))
 
 
-@client.CommandHandler(
-    incoming=True,
-    func=lambda e: not BLOCK_PM and e.is_private)
+@client.CommandHandler(incoming=True, checks=(_nopm_spam_enabled, _is_private, _not_accepted))
 @client.log_exception
 async def await_permission(event):
     global PM_WARNS
-    global ACCEPTED_USERS
     sender = await event.get_sender()
 
-    if NOPM_SPAM and not sender.bot:
-        me = await client.get_me()
-        chat = await event.get_chat()
-        if chat.id not in ACCEPTED_USERS and chat.id != me.id:
-
-            if chat.id not in PM_WARNS:
-                PM_WARNS.update({chat.id: 0})
+    if not sender.bot:
+        chat_id = event.chat_id
 
-            if PM_WARNS[chat.id] == 3:
-                await client.send_message(
-                    chat.id,
-                    message="You are spamming this user. I will ban you until he decides to unban you. Thanks "
-                )
-                await client(BlockRequest(chat.id))
-                return
+        if chat_id not in PM_WARNS:
+            PM_WARNS.update({chat_id: 0})
 
+        if PM_WARNS[chat_id] == 3:
             await client.send_message(
-                chat.id,
-                message="`Hi! This user will answer to your message soon. Please wait for his response and don't spam his PM. Thanks`"
+                chat_id,
+                message="You are spamming this user. I will ban you until he decides to unban you. Thanks "
             )
+            await client(BlockRequest(chat_id))
+            return
+
+        await client.send_message(
+            chat_id,
+            message="`Hi! This user will answer to your message soon. Please wait for his response and don't spam his PM. Thanks`"
+        )
 
-            PM_WARNS[chat.id] += 1
+        PM_WARNS[chat_id] += 1
 
 
 @client.CommandHandler(outgoing=True, command="approve", help=APPROVE_HELP)
@@ -83,13 +88,12 @@ async def accept_permission(event):
     chat = await event.get_chat()
     if NOPM_SPAM or BLOCK_PM:
         if event.is_private:
+            accepted_users.refresh()
             if chat.id not in ACCEPTED_USERS:
 
                 if chat.id in PM_WARNS:
                     del PM_WARNS[chat.id]
-                connection = engine.connect()
-                query = db.insert(private_messages_tbl).values(chat_id=chat.id)
-                ACCEPTED_USERS.append(chat.id)
-                connection.execute(query)
-                connection.close()
+                await database.aio.execute(db.insert(private_messages_tbl).values(chat_id=chat.id))
+                ACCEPTED_USERS.add(chat.id)
+                accepted_users.changed()
                 await client.update_message(event, "Private Message Accepted")
@@ -1,24 +1,18 @@
 import sqlalchemy as db
-from profanity_check import predict
 
-from tg_companion.tgclient import DB_URI, client
-
-engine = db.create_engine(DB_URI)
-metadata = db.MetaData()
+from tg_companion import database
+from tg_companion.database import metadata
+from tg_companion.pipeline import raw_chat_id
+from tg_companion.tgclient import client
 
 profanity_tbl = db.Table("profanity", metadata,
                          db.Column("chat_id", db.Integer(), primary_key=True),
                          db.Column("profanity_filter", db.Boolean()))
 
 
-connection = engine.connect()
-
-metadata.create_all(
-    bind=engine,
-    tables=[profanity_tbl],
-    checkfirst=True)
+database.create_tables(profanity_tbl)
 
-PROFANITY_CHECK_CHATS = []
+PROFANITY_CHECK_CHATS = set()
 
 PROFANITY_HELP = """
     **Toggle the profanity filter on/off.**
@@ -29,13 +23,15 @@ PROFANITY_HELP = """
                             Will display the filter status in the chat if sent without any value.__
 """
 
-query = db.select([profanity_tbl.columns.chat_id]).where(
-    profanity_tbl.columns.profanity_filter == db.true())
-load_profanity_tbl = connection.execute(query).fetchall()
-for row in load_profanity_tbl:
-    if row:
-        PROFANITY_CHECK_CHATS.append(row[0])
-connection.close()
+
+def _load_filtered_chats():
+    query = db.select([profanity_tbl.columns.chat_id]).where(
+        profanity_tbl.columns.profanity_filter == db.true())
+    return {row[0] for row in database.fetch_all(query) if row}
+
+
+# Chats switched from the other processes show up after a reload
+filtered_chats = database.Reloader(_load_filtered_chats, PROFANITY_CHECK_CHATS)
 
 
 @client.CommandHandler(
@@ -53,8 +49,10 @@ async def profanity_switch(event):
         return
 
     on_off = split_text[1]
+    filtered_chats.refresh()
 
-    if not chat.admin_rights:
+    permissions = await client.get_permissions(chat)
+    if not permissions.is_admin:
         await client.update_message(event, "You need to have admin righs to disable or enable the profanity filter")
         return
 
@@ -64,25 +62,9 @@ async def profanity_switch(event):
                              " All the incoming messages containing profanity will be deleted")
             return
 
-        connection = engine.connect()
-        query = db.select([profanity_tbl.columns.profanity_filter]).where(
-            profanity_tbl.columns.chat_id == chat.id)
-
-        load_profanity_tbl = connection.execute(query).fetchall()
-
-        if load_profanity_tbl:
-            for profanity_bool in load_profanity_tbl:
-                if profanity_bool[0] is False:
-                    query = db.update(profanity_tbl).where(
-                        profanity_tbl.columns.chat_id == chat.id).values(
-                        profanity_filter=True)
-        else:
-            query = db.insert(profanity_tbl).values(
-                chat_id=chat.id, profanity_filter=True)
-
-        PROFANITY_CHECK_CHATS.append(chat.id)
-        connection.execute(query)
-        connection.close()
+        await database.aio.upsert(profanity_tbl, {"chat_id": chat.id}, profanity_filter=True)
+        PROFANITY_CHECK_CHATS.add(chat.id)
+        filtered_chats.changed()
         await client.update_message(event, "The profanity filter is on."
                          " All the incoming messages containing profanity will be deleted")
 
@@ -92,45 +74,41 @@ async def profanity_switch(event):
                              " All the incoming messages containing profanity will be ignored")
             return
 
-        connection = engine.connect()
-        query = db.select([profanity_tbl.columns.profanity_filter]).where(
-            profanity_tbl.columns.chat_id == chat.id)
-
-        load_profanity_tbl = connection.execute(query).fetchall()
-        if load_profanity_tbl:
-            for profanity_bool in load_profanity_tbl:  # query the result
-
-                if profanity_bool[0] is True:
-                    query = db.update(profanity_tbl).where(
-                        profanity_tbl.columns.chat_id == chat.id).values(
-                        profanity_filter=False)
-        else:
-            db.insert(profanity_tbl).values(
-                chat_id=chat.id, profanity_filter=False)
-
-        PROFANITY_CHECK_CHATS.remove(chat.id)
-        connection.execute(query)
-        connection.close()
+        await database.aio.upsert(profanity_tbl, {"chat_id": chat.id}, profanity_filter=False)
+        PROFANITY_CHECK_CHATS.discard(chat.id)
+        filtered_chats.changed()
         await client.update_message(event, "The profanity filter is off."
                          " Users can use swear words here")
 
 
+def _not_private(event):
+    return not event.is_private
+
+
+def _filter_enabled(event):
+    filtered_chats.refresh()
+    return raw_chat_id(event) in PROFANITY_CHECK_CHATS
+
+
+def _has_text(event):
+    return bool(event.message.message)
+
+
 @client.CommandHandler(
     incoming=True,
     outgoing=True,
     allow_edited=True,
-    func=lambda e: not e.is_private)
+    checks=(_not_private, _filter_enabled, _has_text))
 async def check_profanity_filter(event):
     chat = await event.get_chat()
-    text = event.text
+    permissions = await client.get_permissions(chat)
 
-    if chat.id in PROFANITY_CHECK_CHATS:
-        if chat.admin_rights:
-            if chat.admin_rights.delete_messages:
-                if text:
-                    predict_profanity = predict([text])
-                    if predict_profanity[0] == 1:
-                        await event.delete()
+    if permissions.can("delete_messages"):
+        # profanity_check loads sklearn and its model, so it's only imported once a filtered chat needs it
+        from profanity_check import predict
+        predict_profanity = predict([event.text])
+        if predict_profanity[0] == 1:
+            await event.delete()
 
 
 @client.CommandHandler(
@@ -144,6 +122,7 @@ async def check_profanity_filter(event):
             "off"]))
 async def profanity_filter_status(event):
     chat = await event.get_chat()
+    filtered_chats.refresh()
     if chat.id in PROFANITY_CHECK_CHATS:
         await client.update_message(event, "The profanity filter is on."
                          " All the incoming messages containing profanity will be deleted")
@@ -40,7 +40,7 @@ PNAME_HELP = """
 @client.log_exception
 async def update_profile_pic(event):
     if event.reply_to_msg_id:
-        message = await event.get_reply_message()
+        message = await client.get_reply_message(event)
         photo = None
         if message.media:
             if isinstance(message.media, MessageMediaPhoto):
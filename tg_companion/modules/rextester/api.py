@@ -1,7 +1,6 @@
 import asyncio
 
-import aiohttp
-
+from tg_companion import web
 from tg_companion.modules.rextester.langs import languages
 
 
@@ -25,13 +24,13 @@ class Rextester(object):
             "Program": self.code,
             "Input": self.stdin}
 
-        async with aiohttp.ClientSession() as session:
-            response = await self.fetch(session, "https://rextester.com/rundotnet/api", data)
-            self.result = response["Result"]
-            self.warnings = response["Warnings"]
-            self.errors = response["Errors"]
-            self.stats = response["Stats"]
-            self.files = response["Files"]
+        session = web.session()
+        response = await self.fetch(session, "https://rextester.com/rundotnet/api", data)
+        self.result = response["Result"]
+        self.warnings = response["Warnings"]
+        self.errors = response["Errors"]
+        self.stats = response["Stats"]
+        self.files = response["Files"]
         return self
 
 
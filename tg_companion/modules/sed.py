@@ -50,9 +50,7 @@ async def regex_no_symb(event):
         await client.update_message(event, SED_HELP)
         return
 
-    rep_msg = await event.get_reply_message(
-
-    )
+    rep_msg = await client.get_reply_message(event)
     to_replace = regex_group.group(1)
     replacement = regex_group.group(2).replace('\\/', '/')
     flags = 0
@@ -1,20 +1,25 @@
-import asyncio
+import datetime
+import re
 import time
 
-import progressbar
 import sqlalchemy as db
-from telethon import utils
-from telethon.errors import FloodWaitError
+from telethon import events
 from telethon.tl.functions.channels import GetFullChannelRequest
 
-from tg_companion import STATS_TIMER
-from tg_companion.tgclient import DB_URI, LOGGER, client
-
-engine = db.create_engine(DB_URI)
-metadata = db.MetaData()
+from tg_companion import (ENTITY_CACHE_SIZE, STATS_CHUNK_SIZE,
+                          STATS_CONCURRENCY, STATS_HISTORY_DAYS,
+                          STATS_LATENCY_TARGET, STATS_TIMER, database)
+from tg_companion.cache import TTLCache
+from tg_companion.database import metadata
+from tg_companion.dialogs import BOT, CHANNEL, GROUP, SUPERGROUP, USER
+from tg_companion.fanout import AdaptiveLimit, Cooperator, fan_out
+from tg_companion.tgclient import LOGGER, client
 
+# The last run of each account
 stats_tbl = db.Table("stats", metadata,
-                     db.Column("updatetime", db.String(), primary_key=True),
+                     db.Column("account", db.String(), primary_key=True),
+
+                     db.Column("updatetime", db.String()),
 
                      db.Column("totaldialogs", db.Integer()),
 
@@ -42,24 +47,262 @@ GroupsInfo_tbl = db.Table("groups_info", metadata,
                           db.Column("supergroupid", db.Integer()),
                           db.Column("oldgroupid", db.Integer()))
 
-FirstRun = None
+# One row per stats run. Runs older than `HISTORY_RAW_DAYS` are downsampled to the last one of each day
+history_tbl = db.Table("stats_history", metadata,
+                       db.Column("account", db.String(), primary_key=True),
+                       db.Column("time", db.Integer(), primary_key=True),
+                       db.Column("totaldialogs", db.Integer()),
+                       db.Column("usercount", db.Integer()),
+                       db.Column("channelcount", db.Integer()),
+                       db.Column("supcount", db.Integer()))
+
+# The message count of every dialog, written by a run only when it changed since the one before. The count of a
+# dialog at a given time is the one of its last row up to then
+dialogs_tbl = db.Table("stats_dialogs", metadata,
+                       db.Column("account", db.String(), primary_key=True),
+                       db.Column("dialog_id", db.BigInteger(), primary_key=True),
+                       db.Column("time", db.Integer(), primary_key=True),
+                       db.Column("category", db.String()),
+                       db.Column("top_message", db.Integer()),
+                       db.Column("count", db.Integer()),
+                       db.Column("name", db.String()),
+                       db.Index("ix_stats_dialogs_time", "account", "time"))
+
+# The counts fetched by the run in progress, so a run stopped by a restart doesn't fetch them again. Emptied when
+# the run ends
+checkpoint_tbl = db.Table("stats_checkpoint", metadata,
+                          db.Column("account", db.String(), primary_key=True),
+                          db.Column("dialog_id", db.BigInteger(), primary_key=True),
+                          db.Column("category", db.String()),
+                          db.Column("top_message", db.Integer()),
+                          db.Column("count", db.Integer()))
+
+# It had no account column before several accounts were supported, the next run of each account fills it again
+database.drop_if_outdated(stats_tbl)
+database.create_tables(stats_tbl, GroupsInfo_tbl, history_tbl, dialogs_tbl, checkpoint_tbl)
+
+# The stats pause for the commands running for less than this many seconds
+BULK_COMMAND_AFTER = 5
+
+# Every this many runs the count of every dialog is fetched again, which fixes the drift of the live counts
+FULL_RECOUNT_EVERY = 24
+
+# The `stats_tbl` column each kind of dialog adds its messages to
+USERS = "usercount"
+CHANNELS = "channelcount"
+SUPERGROUPS = "supcount"
+
+# Every run is kept for this many days, only the last run of each day is kept after
+HISTORY_RAW_DAYS = 30
+
+# `.stats history` picks the smallest of these bucket widths giving at most `HISTORY_BUCKETS` buckets
+BUCKET_WIDTHS = (3600, 6 * 3600, 86400, 7 * 86400, 30 * 86400)
+HISTORY_BUCKETS = 30
+RANGE_UNITS = {"h": 3600, "d": 86400, "w": 7 * 86400, "m": 30 * 86400, "y": 365 * 86400}
 
 STATS_HELP = """
     **Counts all the messages in joined chats and all the chats/groups/PMs you have a conversations with.**
+        __Args:__
+            `history <range>` - **(optional)** __How many messages were sent in each hour/day/week of the range, e.g.__ `24h`, `7d`, `3m`, `1y`. __Defaults to__ `7d`
+            `top <range> <count>` - **(optional)** __The chats with the most messages in the range. Defaults to the__ `10` __most active of the last__ `7d`
 """
 
 
-@client.on_timer(STATS_TIMER)
+class DialogCount(object):
+    __slots__ = ("category", "top_message", "count")
+
+    def __init__(self, category, top_message, count):
+        self.category = category
+        self.top_message = top_message
+        self.count = count
+
+
+class StatsEngine(object):
+    """
+    Keeps the message count of every dialog of an account up to date from the live updates.
+
+    New and deleted messages change the count of their dialog as they arrive, so a `GetStats` run only asks
+    Telegram for the count of the dialogs it doesn't know, the ones whose top message changed without a live
+    update and the ones a chat action made stale. Deletions in private chats and normal groups don't say which
+    chat they come from, they're matched with the messages seen recently and the others are fixed by the full
+    recount done every `FULL_RECOUNT_EVERY` runs.
+    """
+
+    def __init__(self):
+        self.dialogs = {}
+        # dialog id -> (count, top message id) in the last snapshot written to `dialogs_tbl`
+        self.saved = {}
+        self.loaded = False
+        self.last_snapshot = 0
+        self.runs_until_recount = 0
+        # dialog id -> top message id of the dialogs counted by the run in progress
+        self.counted = {}
+        self.stale = set()
+        # message id -> chat id of the messages seen in private chats and normal groups
+        self._message_chats = TTLCache(ENTITY_CACHE_SIZE * 8, 86400)
+        self.runs = 0
+        self.live_updates = 0
+        self.unmatched_deletions = 0
+        self.fetched = 0
+        # The `Cooperator` stats of the last run
+        self.cooperation = {}
+
+    @property
+    def full_recount(self):
+        return self.runs_until_recount <= 0
+
+    def load(self, rows):
+        """ Starts from the last snapshot so only the dialogs which changed since are counted again """
+        for dialog_id, category, top_message, count, _, snapshot in rows:
+            self.dialogs[dialog_id] = DialogCount(category, top_message, count)
+            self.saved[dialog_id] = (count, top_message)
+            self.last_snapshot = max(self.last_snapshot, snapshot)
+        if rows:
+            self.runs_until_recount = FULL_RECOUNT_EVERY
+        self.loaded = True
+
+    def resume(self, rows):
+        """ Keeps the counts the interrupted run had fetched so it doesn't fetch them again """
+        for dialog_id, category, top_message, count in rows:
+            self.set(dialog_id, category, top_message, count)
+            self.counted[dialog_id] = top_message
+
+    def finish_run(self):
+        if self.full_recount:
+            self.runs_until_recount = FULL_RECOUNT_EVERY
+        self.runs_until_recount -= 1
+        self.runs += 1
+        self.counted = {}
+
+    def changed(self):
+        """ Returns (category, top message id, count) of the dialogs which changed since the last snapshot """
+        return {dialog_id: (dialog.category, dialog.top_message, dialog.count)
+                for dialog_id, dialog in self.dialogs.items()
+                if self.saved.get(dialog_id) != (dialog.count, dialog.top_message)}
+
+    def mark_saved(self, changed):
+        """ Records the rows returned by `changed()` as written, once they are """
+        for dialog_id, (_, top_message, count) in changed.items():
+            self.saved[dialog_id] = (count, top_message)
+
+    def new_message(self, chat_id, message_id, is_channel):
+        self.live_updates += 1
+        if not is_channel:
+            self._message_chats.set(message_id, chat_id)
+        dialog = self.dialogs.get(chat_id)
+        if dialog is None:
+            # A new dialog, the next run fetches its count
+            self.stale.add(chat_id)
+            return
+        dialog.count += 1
+        dialog.top_message = max(dialog.top_message, message_id)
+
+    def deleted(self, chat_id, message_ids):
+        self.live_updates += 1
+        for message_id in message_ids:
+            dialog = self.dialogs.get(chat_id or self._message_chats.pop(message_id))
+            if dialog is None:
+                self.unmatched_deletions += 1
+            else:
+                dialog.count = max(0, dialog.count - 1)
+
+    def needs_count(self, dialog_id, top_message):
+        dialog = self.dialogs.get(dialog_id)
+        if dialog is None or dialog_id in self.stale or dialog.top_message != top_message:
+            return True
+        return self.full_recount and dialog_id not in self.counted
+
+    def set(self, dialog_id, category, top_message, count):
+        self.dialogs[dialog_id] = DialogCount(category, top_message, count)
+        self.stale.discard(dialog_id)
+
+    def keep(self, dialog_ids):
+        """ Forgets the dialogs not in `dialog_ids`, the ones which were left or deleted """
+        for dialog_id in set(self.dialogs) - dialog_ids:
+            del self.dialogs[dialog_id]
+            self.saved.pop(dialog_id, None)
+
+    def totals(self):
+        totals = {USERS: 0, CHANNELS: 0, SUPERGROUPS: 0}
+        for dialog in self.dialogs.values():
+            totals[dialog.category] += dialog.count
+        return totals
+
+
+_engines = {}
+
+client.metrics.gauge("stats_loop_lag_p95_ms", lambda: max(
+    [engine.cooperation.get("lag_p95_ms", 0.0) for engine in _engines.values()], default=0.0),
+    "How late the event loop ran the commands during the last stats update, p95")
+client.metrics.gauge("stats_pauses", lambda: sum(
+    engine.cooperation.get("yields", 0) for engine in _engines.values()),
+    "How many times the last stats update paused for the commands")
+
+
+def _engine():
+    """ Returns the `StatsEngine` of the account running the current update or job """
+    engine = _engines.get(client.account_name)
+    if engine is None:
+        engine = _engines[client.account_name] = StatsEngine()
+    return engine
+
+
+def _counting(event):
+    engine = _engines.get(client.account_name)
+    return engine is not None and engine.runs > 0
+
+
+def _category(dialog):
+    if dialog.is_channel:
+        return SUPERGROUPS if dialog.kind == SUPERGROUP else CHANNELS
+    return USERS
+
+
+def _limit():
+    return AdaptiveLimit(STATS_CONCURRENCY, flood_waits=lambda: client.request_stats()["flood_waits"])
+
+
+def _cooperator():
+    # The stats job isn't a handler run. Commands running for long are bulk work like `.readall`, not waited for
+    return Cooperator(STATS_LATENCY_TARGET / 1000, busy=lambda: any(
+        task.elapsed < BULK_COMMAND_AFTER for task in client.handler_tasks()))
+
+
+async def count_messages(peers, limit):
+    """ Returns the message count of every peer, or the exception raised while counting it """
+    async def count(peer):
+        return (await client.get_messages(peer, limit=0)).total
+
+    return await fan_out(count, peers, limit)
+
+
+@client.CommandHandler(checks=(_counting,))
+async def count_new_message(event):
+    _engine().new_message(event.chat_id, event.message.id, event.is_channel)
+
+
+@client.on(events.MessageDeleted(func=_counting))
+async def count_deleted_messages(event):
+    _engine().deleted(event.chat_id, event.deleted_ids)
+
+
+@client.on(events.ChatAction(func=_counting))
+async def count_chat_action(event):
+    # Service messages are counted too and joining or leaving changes the dialogs, the next run fetches the count
+    _engine().stale.add(event.chat_id)
+
+
+@client.job(STATS_TIMER, name="stats", jitter=60, timeout=1800)
 @client.log_exception
 async def GetStats():
-    global FirstRun
-
-    TotalDialogs = 0
-    UserCount = 0
-    ChannelCount = 0
-    SupCount = 0
-    ConvertedGroupsIDs = []
-    NewGroupsIDs = []
+    engine = _engine()
+    if not engine.loaded:
+        engine.load(await database.aio.run(dialog_counts, client.account_name))
+        engine.resume(await database.aio.fetch_all(db.select([
+            checkpoint_tbl.columns.dialog_id, checkpoint_tbl.columns.category, checkpoint_tbl.columns.top_message,
+            checkpoint_tbl.columns.count]).where(checkpoint_tbl.columns.account == client.account_name)))
+        if engine.counted:
+            LOGGER.info("Resuming the stats update stopped after %s chats", len(engine.counted))
     NumChannel = 0
     NumUser = 0
     NumBot = 0
@@ -71,235 +314,331 @@ async def GetStats():
 
     UpdateTime = time.strftime("%c")
 
-    connection = engine.connect()
-    if not engine.dialect.has_table(engine, stats_tbl):
-        metadata.create_all(
-            bind=engine, tables=[
-                stats_tbl, GroupsInfo_tbl])
-    connection.close()
-
-    connection = engine.connect()
-    query = db.select([stats_tbl])
-    if not connection.execute(query).fetchall():
+    if await database.aio.fetch_one(
+            db.select([stats_tbl]).where(stats_tbl.columns.account == client.account_name)) is None:
         FirstTimeRunning = True
 
-    if FirstRun:
+    if FirstTimeRunning:
         LOGGER.info(
             "Gathering Stats. You'll be able to use this app during this process without problems"
         )
-        LOGGER.info(
-            "The companion may not respond to your command for 5 second. Don't panic and try again if your command didn't worked")
-
         LOGGER.info("You can disable this in the config.env file")
-
-        if FirstTimeRunning:
-            LOGGER.info(
-                "Because this is your first time running this, the .stats command won't work until this process isn't over"
-            )
+        LOGGER.info(
+            "Because this is your first time running this, the .stats command won't work until this process isn't over"
+        )
 
     else:
         LOGGER.info("Updating Stats...")
-        LOGGER.info(
-            "The companion may not respond to your command for 5 second. Don't panic and try again if your command didn't worked")
-
-    CachedSupergroups = []
 
-    if not FirstTimeRunning:
-        connection = engine.connect()
-        query = db.select([GroupsInfo_tbl.columns.supergroupid])
-        result = connection.execute(query).fetchall()
-        for row in result:
-            CachedSupergroups.append(row[0])
-        connection.close()
+    # supergroup id -> id of the normal group it was converted from, or None
+    GroupsInfo = dict(await database.aio.fetch_all(
+        db.select([GroupsInfo_tbl.columns.supergroupid, GroupsInfo_tbl.columns.oldgroupid])))
 
-    UserId = await client.get_me()
-    UserId = UserId.id
-
-    dialogs = await client.get_dialogs(limit=None)
+    # The top of the dialogs may have changed without an update, during an outage too long to catch up on
+    if client.dialog_index.loaded:
+        await client.dialog_index.refresh()
+    dialogs = await client.dialog_index.dialogs()
     for dialog in dialogs:
         if dialog.is_group:
             NumChat = NumChat + 1
-        if dialog.is_user:
-            if dialog.entity.bot:
-                NumBot = NumBot + 1
-            else:
-                NumUser = NumUser + 1
-        if dialog.is_channel:
-            if dialog.is_group:
-                NumSuper = NumSuper + 1
-            else:
-                NumChannel = NumChannel + 1
-    completed = 0
-    bar = progressbar.ProgressBar(
-        max_value=NumSuper,
-        widget=None,
-        poll_interval=1)
-    bar.update(completed)
+        if dialog.kind == USER:
+            NumUser = NumUser + 1
+        elif dialog.kind == BOT:
+            NumBot = NumBot + 1
+        elif dialog.kind == SUPERGROUP:
+            NumSuper = NumSuper + 1
+        elif dialog.kind == CHANNEL:
+            NumChannel = NumChannel + 1
+
+    limit = _limit()
+    cooperator = _cooperator()
+    uncached = [dialog for dialog in dialogs if dialog.kind == SUPERGROUP and dialog.entity_id not in GroupsInfo]
+    # Each chunk is saved to `groups_info` right away, a restarted run only asks for the others
+    for start in range(0, len(uncached), STATS_CHUNK_SIZE):
+        await cooperator.pause()
+        chunk = uncached[start:start + STATS_CHUNK_SIZE]
+        NewGroupsInfo = []
+        for dialog, gotChatFull in zip(chunk, await fan_out(
+                lambda dialog: client(GetFullChannelRequest(dialog.input_entity)), chunk, limit)):
+            if isinstance(gotChatFull, Exception):
+                LOGGER.warning("Failed to get the info of %s: %r", dialog.name, gotChatFull)
+                continue
+            GroupsInfo[gotChatFull.full_chat.id] = gotChatFull.full_chat.migrated_from_chat_id
+            NewGroupsInfo.append({
+                "supergroupid": gotChatFull.full_chat.id,
+                "oldgroupid": gotChatFull.full_chat.migrated_from_chat_id})
+        await database.aio.insert_many(GroupsInfo_tbl, NewGroupsInfo)
+
+    # supergroup id -> normal group id of the supergroups in the dialogs which were converted from a normal group
+    ConvertedGroups = {dialog.entity_id: GroupsInfo[dialog.entity_id] for dialog in dialogs
+                       if dialog.kind == SUPERGROUP and GroupsInfo.get(dialog.entity_id) is not None}
+    OldGroupsIDs = set(ConvertedGroups.values())
+
+    # (dialog id, category, top message id, peer) of the dialogs to count
+    Outdated = []
+    Seen = set()
+    Names = {}
     for dialog in dialogs:
-        if dialog.is_channel:
-            if dialog.is_group:
-                ID1 = utils.get_peer_id(
-                    utils.get_input_peer(
-                        dialog, allow_self=False))
-                strid = str(ID1).replace("-100", "")
-                ID = int(strid)
-                if ID not in CachedSupergroups:
-                    ent = await client.get_input_entity(ID1)
-                    try:
-                        gotChatFull = await client(GetFullChannelRequest(ent))
-                    except Exception as exc:
-                        asyncio.sleep(exc.time())
-                        gotChatFull = await client(GetFullChannelRequest(ent))
-
-                    connection = engine.connect()
-
-                    query = db.insert(GroupsInfo_tbl).values(
-                        supergroupid=gotChatFull.full_chat.id,
-                        oldgroupid=gotChatFull.full_chat.migrated_from_chat_id)
-
-                    connection.execute(query)
-                    connection.close()
-
-    LookIds = []
-
-    for dialog in dialogs:
-        ID = None
-        try:
-            ID = utils.get_peer_id(
-                utils.get_input_peer(
-                    dialog, allow_self=False))
-        except Exception:
-            ID = UserId
-        if dialog.is_channel:
-            strid = str(ID).replace("-100", "")
-            ID = int(strid)
-        elif dialog.is_group:
-            strid = str(ID).replace("-", "")
-            ID = int(strid)
-        LookIds.append(ID)
-
-    for dialog in dialogs:
-        if dialog.is_group:
-            ID = utils.get_peer_id(
-                utils.get_input_peer(
-                    dialog, allow_self=False))
-            strid = str(ID).replace("-100", "")
-            ID = int(strid)
-
-            connection = engine.connect()
-            query = db.select(
-                [GroupsInfo_tbl]).where(
-                GroupsInfo_tbl.columns.supergroupid == ID)
-            exec = connection.execute(query)
-            result = exec.fetchall()
-            connection.close()
-            for row in result:
-                if row[1] is not None:
-                    NewGroupsIDs.append(row[0])
-                    ConvertedGroupsIDs.append(row[1])
-    bar.finish()
-
-    print("Counting your chats...")
-
-    for dialog in dialogs:
-        try:
-            ID = utils.get_peer_id(
-                utils.get_input_peer(
-                    dialog, allow_self=False))
-        except Exception:
-            ID = UserId
-        if dialog.is_channel:
-            strid = str(ID).replace("-100", "")
-            ID = int(strid)
-        elif dialog.is_group:
-            strid = str(ID).replace("-", "")
-            ID = int(strid)
-        if utils.get_display_name(dialog.entity) == "":
+        # The raw id of the user, chat or channel, as stored in `groups_info`
+        ID = dialog.entity_id
+        if dialog.name == "":
             NumDeleted = NumDeleted + 1
-        elif ID == UserId:
-            pass
-        if ID not in ConvertedGroupsIDs:
-            ent = await client.get_input_entity(dialog)
-            try:
-                msgs = await client.get_messages(ent, limit=0)
-            except FloodWaitError as exc:
-                asyncio.sleep(exc.seconds)
-                msgs = await client.get_messages(ent, limit=0)
-            count = msgs.total
-            if dialog.is_channel:
-                if dialog.entity.megagroup:
-                    SupCount = SupCount + count
-                else:
-                    ChannelCount = ChannelCount + count
-            elif dialog.is_group and dialog.is_user:
-                UserCount = UserCount + count
-        if ID in NewGroupsIDs:
-            if ID in LookIds and ID not in ConvertedGroupsIDs:
-                index = NewGroupsIDs.index(ID)
-                ent = await client.get_input_entity(int("-" + str(ConvertedGroupsIDs[index])))
-                try:
-                    msgs = await client.get_messages(ent)
-                except FloodWaitError as exc:
-                    asyncio.sleep(exc.seconds)
-                    msgs = await client.get_messages(ent)
-
-                OldChatCount = msgs.total
-                UserCount = UserCount + OldChatCount
-
-    ConvertedCount = len(NewGroupsIDs)
+        # Converted groups are counted with their supergroup
+        if not (dialog.kind == GROUP and ID in OldGroupsIDs):
+            Seen.add(dialog.id)
+            Names[dialog.id] = dialog.name
+            if engine.needs_count(dialog.id, dialog.top_message):
+                Outdated.append((dialog.id, _category(dialog), dialog.top_message, dialog.input_entity))
+        if dialog.kind == SUPERGROUP and ID in ConvertedGroups:
+            OldChatId = -ConvertedGroups[ID]
+            Seen.add(OldChatId)
+            Names[OldChatId] = f"{dialog.name} (before the upgrade)"
+            # Migrated groups can't get new messages. A resumed run already has the ones it counted
+            if OldChatId not in engine.counted and (OldChatId not in engine.dialogs or engine.full_recount):
+                Outdated.append((OldChatId, USERS, 0, OldChatId))
+
+    for start in range(0, len(Outdated), STATS_CHUNK_SIZE):
+        await cooperator.pause()
+        chunk = Outdated[start:start + STATS_CHUNK_SIZE]
+        counts = await count_messages([peer for _, _, _, peer in chunk], limit)
+        Counted = []
+        for (DialogId, category, TopMessage, _), count in zip(chunk, counts):
+            if isinstance(count, Exception):
+                LOGGER.warning("Failed to count the messages of %s: %r", DialogId, count)
+                engine.stale.add(DialogId)
+            else:
+                engine.set(DialogId, category, TopMessage, count)
+                engine.counted[DialogId] = TopMessage
+                Counted.append({"dialog_id": DialogId, "category": category, "top_message": TopMessage,
+                                "count": count})
+        await database.aio.run(save_checkpoint, client.account_name, Counted)
+    engine.keep(Seen)
+    engine.finish_run()
+    engine.fetched = len(Outdated)
+    engine.cooperation = cooperator.stats()
+    LOGGER.info("Counted the messages of %s of %s dialogs, the others were kept up to date from the updates",
+                len(Outdated), len(Seen))
+    if engine.cooperation["chunks"]:
+        LOGGER.info("The stats ran in %s chunks and paused %s times (%ss) for the commands, loop lag p95 %sms "
+                    "for a target of %sms", engine.cooperation["chunks"], engine.cooperation["yields"],
+                    engine.cooperation["waited"], engine.cooperation["lag_p95_ms"], engine.cooperation["target_ms"])
+
+    totals = engine.totals()
+    UserCount = totals[USERS]
+    ChannelCount = totals[CHANNELS]
+    SupCount = totals[SUPERGROUPS]
+    ConvertedCount = len(ConvertedGroups)
     NumChat = NumChat - ConvertedCount
     TotalDialogs = UserCount + ChannelCount + SupCount
 
-    connection = engine.connect()
-    query = db.select([stats_tbl.columns.updatetime])
-
-    if not connection.execute(query).fetchall():
-        query = db.insert(stats_tbl).values(
-            updatetime=UpdateTime,
-            totaldialogs=TotalDialogs,
-            usercount=UserCount,
-            channelcount=ChannelCount,
-            supcount=SupCount,
-            convertedgroups=ConvertedCount,
-            numchannel=NumChannel,
-            numuser=NumUser,
-            numdeleted=NumDeleted,
-            numbot=NumBot,
-            numchat=NumChat,
-            numsuper=NumSuper,
-        )
-    else:
-        query = db.update(stats_tbl).values(
-            updatetime=UpdateTime,
-            totaldialogs=TotalDialogs,
-            usercount=UserCount,
-            channelcount=ChannelCount,
-            supcount=SupCount,
-            convertedgroups=ConvertedCount,
-            numchannel=NumChannel,
-            numuser=NumUser,
-            numdeleted=NumDeleted,
-            numbot=NumBot,
-            numchat=NumChat,
-            numsuper=NumSuper,
-        )
-    connection.execute(query)
-    connection.close()
+    await database.aio.upsert(
+        stats_tbl, {"account": client.account_name},
+        updatetime=UpdateTime,
+        totaldialogs=TotalDialogs,
+        usercount=UserCount,
+        channelcount=ChannelCount,
+        supcount=SupCount,
+        convertedgroups=ConvertedCount,
+        numchannel=NumChannel,
+        numuser=NumUser,
+        numdeleted=NumDeleted,
+        numbot=NumBot,
+        numchat=NumChat,
+        numsuper=NumSuper,
+    )
+    # Snapshots are keyed by the second they're taken in
+    now = engine.last_snapshot = max(int(time.time()), engine.last_snapshot + 1)
+    await database.aio.run(record_history, client.account_name, now, {
+        "totaldialogs": TotalDialogs, USERS: UserCount, CHANNELS: ChannelCount, SUPERGROUPS: SupCount})
+    Changed = engine.changed()
+    await database.aio.run(record_dialogs, client.account_name, now, [
+        {"dialog_id": DialogId, "category": category, "top_message": TopMessage, "count": count,
+         "name": Names.get(DialogId)}
+        for DialogId, (category, TopMessage, count) in Changed.items()])
+    # Only now, a failed write leaves them changed for the next run
+    engine.mark_saved(Changed)
+    await database.aio.execute(checkpoint_tbl.delete().where(checkpoint_tbl.columns.account == client.account_name))
 
     LOGGER.info("DONE!! You can see your stats by sending .stats in any chat")
 
 
+def save_checkpoint(account, rows):
+    """ Saves the counts fetched by a chunk of the run in progress """
+    if not rows:
+        return
+    columns = checkpoint_tbl.columns
+    with database.transaction() as connection:
+        connection.execute(checkpoint_tbl.delete().where(db.and_(
+            columns.account == account, columns.dialog_id.in_([row["dialog_id"] for row in rows]))))
+        connection.execute(checkpoint_tbl.insert(), [dict(row, account=account) for row in rows])
+
+
+def record_history(account, now, counts):
+    """ Saves the counts of a run and applies the downsampling and the retention of `history_tbl` """
+    raw_since = now - HISTORY_RAW_DAYS * 86400
+    day = history_tbl.columns.time / 86400
+    last_of_day = db.select([db.func.max(history_tbl.columns.time)]).where(db.and_(
+        history_tbl.columns.account == account, history_tbl.columns.time < raw_since)).group_by(day)
+
+    with database.transaction() as connection:
+        connection.execute(history_tbl.insert().values(account=account, time=now, **counts))
+        connection.execute(history_tbl.delete().where(db.and_(
+            history_tbl.columns.account == account,
+            history_tbl.columns.time < now - STATS_HISTORY_DAYS * 86400)))
+        connection.execute(history_tbl.delete().where(db.and_(
+            history_tbl.columns.account == account,
+            history_tbl.columns.time < raw_since,
+            history_tbl.columns.time.notin_(last_of_day))))
+
+
+def record_dialogs(account, now, rows):
+    """ Saves the counts of the dialogs which changed and deletes the expired ones """
+    columns = dialogs_tbl.columns
+    expired = now - STATS_HISTORY_DAYS * 86400
+    newer = dialogs_tbl.alias("newer")
+    with database.transaction() as connection:
+        if rows:
+            connection.execute(dialogs_tbl.insert(), [dict(row, account=account, time=now) for row in rows])
+        # An expired row is still the count of its dialog until the next row, keep the last one
+        connection.execute(dialogs_tbl.delete().where(db.and_(
+            columns.account == account,
+            columns.time < expired,
+            db.exists().where(db.and_(
+                newer.c.account == columns.account,
+                newer.c.dialog_id == columns.dialog_id,
+                newer.c.time > columns.time,
+                newer.c.time <= expired)))))
+
+
+def dialog_counts(account, at=None, first=False):
+    """
+    Returns (dialog id, category, top message id, count, name, time) of every dialog, as of the last snapshot before
+    `at` or, with `first`, as of the first snapshot it's in
+    """
+    columns = dialogs_tbl.columns
+    where = [columns.account == account]
+    if at is not None:
+        where.append(columns.time <= at)
+    pick = db.func.min if first else db.func.max
+    snapshots = db.select([columns.dialog_id, pick(columns.time).label("time")]).where(
+        db.and_(*where)).group_by(columns.dialog_id).alias("snapshots")
+    query = db.select([columns.dialog_id, columns.category, columns.top_message, columns.count, columns.name,
+                       columns.time]).select_from(
+        dialogs_tbl.join(snapshots, db.and_(columns.account == account, columns.dialog_id == snapshots.c.dialog_id,
+                                            columns.time == snapshots.c.time)))
+    return database.fetch_all(query)
+
+
+def top_dialogs(account, seconds, now, count):
+    """ Returns (name, messages) of the `count` dialogs with the most messages in the last `seconds` """
+    latest = dialog_counts(account)
+    before = {row[0]: row[3] for row in dialog_counts(account, at=now - seconds)}
+    # The dialogs which appeared during the range are counted from their first snapshot
+    missing = set(row[0] for row in latest) - set(before)
+    if missing:
+        before.update((row[0], row[3]) for row in dialog_counts(account, first=True) if row[0] in missing)
+    activity = [(row[4] or str(row[0]), row[3] - before[row[0]]) for row in latest]
+    activity.sort(key=lambda item: item[1], reverse=True)
+    return [item for item in activity[:count] if item[1] > 0]
+
+
+def parse_range(text):
+    """ `7d` -> seconds. Returns None if `text` isn't a number followed by h, d, w, m or y """
+    match = re.fullmatch(r"(\d+)([hdwmy])", text.lower())
+    if not match or not int(match.group(1)):
+        return None
+    return int(match.group(1)) * RANGE_UNITS[match.group(2)]
+
+
+def bucket_width(seconds, since, now):
+    # Downsampled days can't be split in hours
+    minimum = 86400 if since < now - HISTORY_RAW_DAYS * 86400 else 0
+    for width in BUCKET_WIDTHS:
+        if width >= minimum and seconds / width <= HISTORY_BUCKETS:
+            return width
+    return BUCKET_WIDTHS[-1]
+
+
+def history(account, seconds, now):
+    """
+    Returns the bucket width and a list of (bucket start, counts) with how many messages were added in each
+    bucket of the last `seconds`, according to the last run of every bucket.
+    """
+    since = now - seconds
+    width = bucket_width(seconds, since, now)
+    columns = history_tbl.columns
+    bucket = (columns.time / width) * width
+    # The last run of every bucket, including the one before the range to compute the first delta from
+    last_runs = db.select([bucket.label("bucket"), db.func.max(columns.time).label("time")]).where(db.and_(
+        columns.account == account, columns.time >= since - width)).group_by(bucket).alias("last_runs")
+    query = db.select([last_runs.c.bucket, columns.totaldialogs, columns.usercount, columns.channelcount,
+                       columns.supcount]).select_from(history_tbl.join(last_runs, db.and_(
+                           columns.account == account, columns.time == last_runs.c.time))).order_by(last_runs.c.bucket)
+
+    deltas = []
+    previous = None
+    for row in database.fetch_all(query):
+        if previous is not None and row[0] >= since - since % width:
+            deltas.append((row[0], [value - old for value, old in zip(row[1:], previous)]))
+        previous = row[1:]
+    return width, deltas
+
+
+def _bucket_label(start, width):
+    moment = datetime.datetime.utcfromtimestamp(start)
+    return moment.strftime("%d %b %H:%M" if width < 86400 else "%d %b %Y" if width >= 30 * 86400 else "%d %b")
+
+
+async def show_top(event, text, count):
+    seconds = parse_range(text)
+    if seconds is None or not count.isdigit():
+        await client.update_message(event, "`Use a range like 24h, 7d, 4w, 3m or 1y and a number of chats`")
+        return
+
+    top = await database.aio.run(top_dialogs, client.account_name, seconds, int(time.time()), int(count))
+    if not top:
+        await client.update_message(event, f"`No messages were counted in the last {text}`")
+        return
+
+    REPLY = f"**The most active chats of the last {text}:**\n"
+    for position, (name, messages) in enumerate(top, 1):
+        REPLY += f"\n{position}. {name}: `{messages}`"
+    await client.update_message(event, REPLY)
+
+
+async def show_history(event, text):
+    seconds = parse_range(text)
+    if seconds is None:
+        await client.update_message(event, "`Use a range like 24h, 7d, 4w, 3m or 1y`")
+        return
+
+    width, deltas = await database.aio.run(history, client.account_name, seconds, int(time.time()))
+    if not deltas:
+        await client.update_message(event, f"`There are no stats for the last {text} yet`")
+        return
+
+    REPLY = f"**Messages in the last {text} (UTC):**\n"
+    for start, (total, users, channels, supergroups) in deltas:
+        REPLY += (f"\n`{_bucket_label(start, width)}`: `{total:+}` "
+                  f"__(chats__ `{users:+}`__, channels__ `{channels:+}`__, supergroups__ `{supergroups:+}`__)__")
+    REPLY += f"\n\n**Total:** `{sum(delta[1][0] for delta in deltas):+}`"
+    await client.update_message(event, REPLY)
+
+
 @client.CommandHandler(outgoing=True, command="stats", help=STATS_HELP)
 @client.log_exception
 async def show_stats(event):
-    stats = None
-
-    connection = engine.connect()
-    query = db.select([stats_tbl])
-    result = connection.execute(query).fetchall()
-    if result:
-        stats = result[0]
-    connection.close()
+    args = event.text.split()[1:]
+    if args and args[0] == "history":
+        await show_history(event, args[1] if len(args) > 1 else "7d")
+        return
+    if args and args[0] == "top":
+        await show_top(event, args[1] if len(args) > 1 else "7d", args[2] if len(args) > 2 else "10")
+        return
+
+    columns = [column for column in stats_tbl.columns if column.name != "account"]
+    stats = await database.aio.fetch_one(
+        db.select(columns).where(stats_tbl.columns.account == client.account_name))
 
     if stats:
         updatetime, totaldialogs, usercount, channelcount, supcount, convertedgroups, numchannel, numuser, numdeleted, numbot, numchat, numsuper = (
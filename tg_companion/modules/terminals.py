@@ -8,7 +8,6 @@ from tg_companion import (ENABLE_SSH, SSH_HOSTNAME, SSH_KEY, SSH_PASSPHRASE,
                           SSH_PASSWORD, SSH_PORT, SSH_USERNAME,
                           SUBPROCESS_ANIM)
 from tg_companion.tgclient import client
-from telethon.errors import FloodWaitError
 
 TERM_HELP = """
     **Execute a bash command on your pc/server**
@@ -35,7 +34,7 @@ SSH_UPLOAD_HELP = """
 """
 
 
-@client.CommandHandler(outgoing=True, command="term", help=TERM_HELP)
+@client.CommandHandler(outgoing=True, command="term", help=TERM_HELP, max_concurrent=3, timeout=600)
 @client.log_exception
 async def terminal(event):
 
@@ -53,66 +52,62 @@ async def terminal(event):
     process = await asyncio.create_subprocess_shell(
         cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
     )
-    OUTPUT = f"**Query:**\n\n`{cmd}`\n\n**Result:**\n\n"
+    try:
+        OUTPUT = f"**Query:**\n\n`{cmd}`\n\n**Result:**\n\n"
 
-    if not SUBPROCESS_ANIM:
-        stdout, stderr = await process.communicate()
+        if not SUBPROCESS_ANIM:
+            stdout, stderr = await process.communicate()
 
-        if len(stdout) > 4096:
-            await event.reply(f"{OUTPUT}\n__Process killed:__ `Messasge too long`")
-            return
+            if len(stdout) > 4096:
+                await event.reply(f"{OUTPUT}\n__Process killed:__ `Messasge too long`")
+                return
 
-        if stderr.decode():
-            await client.update_message(event, f"{OUTPUT}`{stderr.decode()}`")
+            if stderr.decode():
+                await client.update_message(event, f"{OUTPUT}`{stderr.decode()}`")
+                return
+
+            await client.update_message(event, f"{OUTPUT}`{stdout.decode()}`")
             return
 
-        await client.update_message(event, f"{OUTPUT}`{stdout.decode()}`")
-        return
+        async with client.progress_message(event) as progress:
+            while process:
+                if time.time() > start_time:
+                    if process:
+                        process.kill()
+                    progress.update(f"{OUTPUT}\n__Process killed__: `Time limit reached`")
+                    break
 
-    while process:
-        if time.time() > start_time:
-            if process:
-                process.kill()
-            await client.update_message(event, f"{OUTPUT}\n__Process killed__: `Time limit reached`")
-            break
+                stdout = await process.stdout.readline()
 
-        stdout = await process.stdout.readline()
+                if not stdout:
+                    _, stderr = await process.communicate()
+                    if stderr.decode():
+                        OUTPUT += f"`{stderr.decode()}`"
+                        progress.update(OUTPUT)
+                    break
 
-        if not stdout:
-            _, stderr = await process.communicate()
-            if stderr.decode():
-                OUTPUT += f"`{stderr.decode()}`"
-                try:
-                    await client.update_message(event, OUTPUT)
-                except Exception:
+                OUTPUT += f"`{stdout.decode()}`"
+
+                if len(OUTPUT) > 4096:
+                    if process:
+                        process.kill()
+                    await event.reply(f"{OUTPUT}\n__Process killed:__ `Messasge too long`")
                     break
-                break
-
-        if stdout:
-            OUTPUT += f"`{stdout.decode()}`"
-
-        if len(OUTPUT) > 4096:
-            if process:
-                process.kill()
-            await event.reply(f"{OUTPUT}\n__Process killed:__ `Messasge too long`")
-            break
-        try:
-            await event.edit(OUTPUT)
-        except FloodWaitError:
-            stdout, stderr = await process.communicate()
-            if stderr:
-                await client.update_message(event, f"{OUTPUT}`{stderr}`")
-                break
 
-            await client.update_message(event, f"{OUTPUT}`{stdout}`")
-            break
+                progress.update(OUTPUT)
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+        raise
 
 
 @client.CommandHandler(
     outgoing=True,
     func=lambda x: ENABLE_SSH,
     command="rterm",
-    help=SSH_TERM_HELP)
+    help=SSH_TERM_HELP,
+    max_concurrent=3,
+    timeout=600)
 @client.log_exception
 async def ssh_terminal(event):
 
@@ -153,41 +148,30 @@ async def ssh_terminal(event):
                 await client.update_message(event, f"{OUTPUT}`{stdout}`")
                 return
 
-            while True:
-                if time.time() > start_time:
-                    break
+            async with client.progress_message(event) as progress:
+                while True:
+                    if time.time() > start_time:
+                        break
 
-                stdout = await process.stdout.readline()
+                    stdout = await process.stdout.readline()
 
-                if not stdout:
-                    _, stderr = await process.communicate()
-                    if stderr:
-                        OUTPUT += f"`{stderr}`"
-                        try:
-                            await client.update_message(event, OUTPUT)
-                        except Exception:
-                            break
+                    if not stdout:
+                        _, stderr = await process.communicate()
+                        if stderr:
+                            OUTPUT += f"`{stderr}`"
+                            progress.update(OUTPUT)
                         break
 
-                if stdout:
                     OUTPUT += f"`{stdout}`"
 
-                if len(OUTPUT) > 4096:
-                    await event.reply("__Process killed:__ `Messasge too long`")
-                    break
-                try:
-                    await client.update_message(event, OUTPUT)
-                except FloodWaitError:
-                    stdout, stderr = await process.communicate()
-                    if stderr:
-                        await client.update_message(event, f"{OUTPUT}`{stderr}`")
+                    if len(OUTPUT) > 4096:
+                        await event.reply("__Process killed:__ `Messasge too long`")
                         break
 
-                    await client.update_message(event, f"{OUTPUT}`{stdout}`")
-                    break
+                    progress.update(OUTPUT)
 
 
-@client.CommandHandler(outgoing=True, command="upload", help=UPLOAD_HELP)
+@client.CommandHandler(outgoing=True, command="upload", help=UPLOAD_HELP, max_concurrent=2)
 @client.log_exception
 async def upload_file(event):
     split_text = event.text.split(None, 1)
@@ -204,7 +188,8 @@ async def upload_file(event):
 @client.CommandHandler(
     outgoing=True,
     command="rupload (.+)",
-    help=SSH_UPLOAD_HELP)
+    help=SSH_UPLOAD_HELP,
+    max_concurrent=2)
 @client.log_exception
 async def ssh_upload_file(event):
     split_text = event.text.split(None, 1)
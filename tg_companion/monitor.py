@@ -0,0 +1,47 @@
+import asyncio
+import time
+from collections import deque
+
+
+class LoopLagMonitor(object):
+    """
+    Measures how late the event loop wakes up a task sleeping for `interval` seconds.
+
+    The lag is the time the loop spent running something else that didn't yield, like a blocking
+    database query or a long sync function. The last `samples` measurements are kept.
+    """
+
+    def __init__(self, interval=1.0, samples=300):
+        self.interval = interval
+        self._samples = deque(maxlen=samples)
+        self._task = None
+        self.max_lag = 0.0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - started - self.interval)
+            self._samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+    def stats(self):
+        if not self._samples:
+            return {"samples": 0, "last": 0.0, "avg": 0.0, "p95": 0.0, "max": 0.0}
+        ordered = sorted(self._samples)
+        return {
+            "samples": len(ordered),
+            "last": round(self._samples[-1] * 1000, 1),
+            "avg": round(sum(ordered) / len(ordered) * 1000, 1),
+            "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+            "max": round(self.max_lag * 1000, 1),
+        }
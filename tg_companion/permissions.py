@@ -0,0 +1,63 @@
+from telethon.tl.types import (ChannelParticipantAdmin,
+                               ChannelParticipantCreator,
+                               ChatParticipantAdmin, ChatParticipantCreator)
+
+
+class ChatPermissions(object):
+    """
+    The rights the companion account has in a chat, as read from the chat entity.
+
+    Attributes:
+        creator (bool): True if the companion account created the chat.
+        admin_rights (ChatAdminRights): The admin rights of the account or None.
+    """
+    __slots__ = ("creator", "admin_rights")
+
+    def __init__(self, creator=False, admin_rights=None):
+        self.creator = bool(creator)
+        self.admin_rights = admin_rights
+
+    @classmethod
+    def from_chat(cls, chat):
+        return cls(getattr(chat, "creator", False), getattr(chat, "admin_rights", None))
+
+    @property
+    def is_admin(self):
+        return self.creator or self.admin_rights is not None
+
+    def can(self, right):
+        """ Returns True if the account has the given admin right ( `ban_users`, `delete_messages`, ... ) """
+        if self.creator:
+            return True
+        return bool(self.admin_rights and getattr(self.admin_rights, right, False))
+
+    def same_as(self, chat):
+        return self.creator == bool(getattr(chat, "creator", False)) and \
+            self.admin_rights == getattr(chat, "admin_rights", None)
+
+
+class ChatAdmins(object):
+    """
+    The creator and the admins of a chat.
+
+    Attributes:
+        creator_id (int): The user id of the chat creator or None if it's not visible.
+        admin_ids (set): The user ids of every admin, creator included.
+    """
+    __slots__ = ("creator_id", "admin_ids")
+
+    def __init__(self, creator_id=None, admin_ids=None):
+        self.creator_id = creator_id
+        self.admin_ids = admin_ids or set()
+
+    @classmethod
+    def from_participants(cls, participants):
+        # Basic groups ignore the admins filter and list every member, only the participant type tells them apart
+        admins = cls()
+        for user in participants:
+            if isinstance(user.participant, (ChannelParticipantCreator, ChatParticipantCreator)):
+                admins.creator_id = user.id
+            elif not isinstance(user.participant, (ChannelParticipantAdmin, ChatParticipantAdmin)):
+                continue
+            admins.admin_ids.add(user.id)
+        return admins
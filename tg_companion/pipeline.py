@@ -0,0 +1,101 @@
+from telethon import events, utils
+
+from tg_companion import LOGGER
+
+
+def raw_chat_id(event):
+    """ Returns the unmarked id of the event chat, the same value as `(await event.get_chat()).id` """
+    return utils.resolve_id(event.chat_id)[0]
+
+
+class Stage(object):
+    """
+    A cheap synchronous predicate of a passive handler.
+
+    Stages only look at data already present in the update (direction, chat id, sender id, text)
+    and count how many events they let through (hits) and how many they rejected (misses).
+    """
+    __slots__ = ("name", "check", "hits", "misses")
+
+    def __init__(self, name, check):
+        self.name = name
+        self.check = check
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, event):
+        if self.check(event):
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+
+class PassiveHandler(object):
+    __slots__ = ("callback", "stages", "calls")
+
+    def __init__(self, callback, stages):
+        self.callback = callback
+        self.stages = stages
+        self.calls = 0
+
+    @property
+    def name(self):
+        return getattr(self.callback, "__name__", repr(self.callback))
+
+
+class PassivePipeline(object):
+    """
+    Runs the handlers that are registered without a command on every message.
+
+    The stages of a handler are evaluated in order, the built-in direction filter first and the
+    handler checks after it, and the first stage that rejects the event short-circuits the handler
+    so no coroutine is created for messages it doesn't care about.
+    """
+
+    def __init__(self):
+        self._handlers = []
+
+    @staticmethod
+    def build_stages(incoming=None, outgoing=None, checks=(), func=None):
+        if incoming and outgoing:
+            incoming = outgoing = None
+        stages = []
+        if incoming:
+            stages.append(Stage("incoming", lambda e: not e.message.out))
+        elif outgoing:
+            stages.append(Stage("outgoing", lambda e: e.message.out))
+
+        for check in checks:
+            stages.append(Stage(getattr(check, "__name__", repr(check)), check))
+
+        if func:
+            stages.append(Stage("func", func))
+        return stages
+
+    def add(self, callback, stages):
+        self._handlers.append(PassiveHandler(callback, stages))
+
+    def remove(self, callback):
+        found = len(self._handlers)
+        self._handlers = [h for h in self._handlers if h.callback != callback]
+        return found - len(self._handlers)
+
+    def stats(self):
+        """ Returns a list of (handler name, calls, [(stage name, hits, misses)]) """
+        return [(handler.name, handler.calls, [(s.name, s.hits, s.misses) for s in handler.stages])
+                for handler in self._handlers]
+
+    async def dispatch(self, event):
+        for handler in self._handlers:
+            for stage in handler.stages:
+                if not stage(event):
+                    break
+            else:
+                handler.calls += 1
+                try:
+                    await handler.callback(event)
+                except events.StopPropagation:
+                    raise
+                except Exception:
+                    LOGGER.exception("Unhandled exception on %s", handler.name)
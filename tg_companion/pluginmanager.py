@@ -29,7 +29,7 @@ parser.add_argument(
     "--plugins",
     help="Disply the installed plugins", action="store_true")
 
-args = parser.parse_args()
+args, _ = parser.parse_known_args()
 
 
 async def download_plugins(user="nitanmarcel", repo="TgCompanionPlugins", plugin=None):
@@ -0,0 +1,52 @@
+import contextlib
+import json
+import os
+import time
+
+
+class StartupProfiler(object):
+    """
+    Times the phases of the companion startup ( imports, database loads, connecting, logging in, ... )
+
+    Phases can be nested, every phase keeps its offset from the profiler creation, its duration and its depth.
+
+        with startup.phase("connect"):
+            ...
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+        self.ready_at = None
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        began = time.perf_counter()
+        entry = {"name": name, "start": round(began - self.started, 4), "depth": self._depth, "duration": None}
+        self.phases.append(entry)
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            entry["duration"] = round(time.perf_counter() - began, 4)
+
+    def ready(self):
+        self.ready_at = round(time.perf_counter() - self.started, 4)
+
+    def report(self):
+        return {"ready_after": self.ready_at, "phases": self.phases}
+
+    def slowest(self, count=5):
+        return sorted((phase for phase in self.phases if phase["duration"] is not None),
+                      key=lambda phase: phase["duration"], reverse=True)[:count]
+
+    def write(self, path="logs/startup.json"):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as report_file:
+            json.dump(self.report(), report_file, indent=2)
+
+
+# Created when the tg_companion package is imported, so its clock starts with the companion
+startup = StartupProfiler()
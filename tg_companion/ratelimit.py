@@ -0,0 +1,222 @@
+import asyncio
+import contextlib
+import contextvars
+import time
+
+from telethon import utils
+
+from tg_companion.cache import TTLCache
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+PRIORITY = contextvars.ContextVar("priority", default=INTERACTIVE)
+
+# The method class of every request that has its own limit. Everything else is "default"
+METHOD_CLASSES = {
+    "SendMessageRequest": "send",
+    "SendMediaRequest": "send",
+    "SendMultiMediaRequest": "send",
+    "ForwardMessagesRequest": "send",
+    "EditMessageRequest": "edit",
+    "DeleteMessagesRequest": "edit",
+    "GetHistoryRequest": "history",
+    "SearchRequest": "history",
+    "GetMessagesRequest": "history",
+    "GetDialogsRequest": "history",
+    "GetFullChannelRequest": "full",
+    "GetFullChatRequest": "full",
+    "GetFullUserRequest": "full",
+    "GetParticipantsRequest": "full",
+    "ResolveUsernameRequest": "resolve",
+    "ReadHistoryRequest": "read",
+    "ReadMentionsRequest": "read",
+    "AddChatUserRequest": "invite",
+    "InviteToChannelRequest": "invite",
+}
+
+# method class -> (requests per second, burst). Telegram doesn't publish the flood limits of user accounts, these are
+# conservative estimates kept under the limits documented for bots ( about 30 messages per second in total and 1 per
+# second in the same chat ), and much lower for resolving usernames and inviting users, the requests known to get
+# flood waits of several minutes. `RATE_LIMITS` in config.env overrides them
+METHOD_LIMITS = {
+    "default": (20, 30),
+    "send": (10, 20),
+    "edit": (10, 20),
+    "history": (10, 20),
+    "full": (4, 10),
+    "resolve": (0.5, 5),
+    "read": (5, 10),
+    "invite": (0.2, 3),
+}
+
+# The method classes that are also limited per chat, `chat` in `RATE_LIMITS`
+CHAT_LIMIT = (1, 3)
+CHAT_LIMITED = {"send", "edit"}
+
+
+def parse_limits(text):
+    """
+    Parses `RATE_LIMITS`, comma separated `class=rate/burst` items. Returns method class -> (rate, burst)
+
+        parse_limits("send=5/10,chat=0.5/2") == {"send": (5.0, 10), "chat": (0.5, 2)}
+    """
+    limits = {}
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        name, _, limit = item.partition("=")
+        name = name.strip()
+        if name not in METHOD_LIMITS and name != "chat":
+            raise ValueError(f"Unknown method class {name!r}, use one of {', '.join(METHOD_LIMITS)} or chat")
+        rate, _, burst = limit.partition("/")
+        try:
+            limits[name] = (float(rate), int(burst or max(1, float(rate))))
+        except ValueError:
+            raise ValueError(f"Invalid limit {limit!r} for {name}, use requests per second/burst e.g. 10/20")
+        if limits[name][0] <= 0 or limits[name][1] < 1:
+            raise ValueError(f"The limit of {name} must allow at least one request")
+    return limits
+
+
+class TokenBucket(object):
+    """ Allows `rate` requests per second with bursts of up to `capacity` requests """
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until", "waiting")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waiting = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, reserve=0.0):
+        """ Seconds until a token is available while keeping `reserve` tokens in the bucket """
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        missing = reserve + 1 - self.tokens
+        if missing > 0:
+            wait = max(wait, missing / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class RequestScheduler(object):
+    """
+    Spaces the requests sent to Telegram so they stay under the flood limits.
+
+    Requests take a token from the bucket of their method class and, for sends and edits, from the bucket of
+    their chat. Requests made in the background lane ( see `background()` ) leave a share of every bucket to
+    the interactive lane and give way while an interactive request waits on the same bucket, so commands never
+    queue behind bulk jobs such as stats, readall or migrate.
+    """
+
+    def __init__(self, background_reserve=0.3, limits=None):
+        merged = dict(METHOD_LIMITS, chat=CHAT_LIMIT)
+        merged.update(limits or {})
+        self.background_reserve = background_reserve
+        self._chat_limit = merged.pop("chat")
+        self._methods = {name: TokenBucket(*limit) for name, limit in merged.items()}
+        self._chats = TTLCache(4096, 600)
+        self.requests = {INTERACTIVE: 0, BACKGROUND: 0}
+        self.delayed = {INTERACTIVE: 0, BACKGROUND: 0}
+        self.flood_waits = 0
+
+    @staticmethod
+    def method_class(request):
+        return METHOD_CLASSES.get(type(request).__name__, "default")
+
+    @staticmethod
+    def chat_key(request):
+        peer = getattr(request, "peer", None) or getattr(request, "channel", None)
+        if peer is None:
+            return None
+        try:
+            return utils.get_peer_id(peer)
+        except TypeError:
+            return None
+
+    def _buckets(self, request):
+        method = self.method_class(request)
+        buckets = [self._methods[method]]
+        if method in CHAT_LIMITED:
+            key = self.chat_key(request)
+            if key is not None:
+                bucket = self._chats.peek(key)
+                if bucket is None:
+                    bucket = TokenBucket(*self._chat_limit)
+                    self._chats.set(key, bucket)
+                buckets.append(bucket)
+        return buckets
+
+    async def acquire(self, request):
+        lane = PRIORITY.get()
+        buckets = self._buckets(request)
+        self.requests[lane] += 1
+
+        if lane == INTERACTIVE:
+            for bucket in buckets:
+                bucket.waiting += 1
+        try:
+            delayed = False
+            while True:
+                if lane == BACKGROUND:
+                    delay = max(b.delay(b.capacity * self.background_reserve) for b in buckets)
+                    if delay <= 0 and any(b.waiting for b in buckets):
+                        delay = 0.05
+                else:
+                    delay = max(b.delay() for b in buckets)
+
+                if delay <= 0:
+                    break
+                if not delayed:
+                    self.delayed[lane] += 1
+                    delayed = True
+                await asyncio.sleep(delay)
+
+            for bucket in buckets:
+                bucket.take()
+        finally:
+            if lane == INTERACTIVE:
+                for bucket in buckets:
+                    bucket.waiting -= 1
+
+    def flood_wait(self, request, seconds):
+        """ Blocks the buckets of `request` for the flood wait duration so other callers wait too """
+        self.flood_waits += 1
+        for bucket in self._buckets(request):
+            bucket.block(seconds)
+
+    def stats(self):
+        return {
+            "requests": dict(self.requests),
+            "delayed": dict(self.delayed),
+            "flood_waits": self.flood_waits,
+        }
+
+
+@contextlib.contextmanager
+def background():
+    """
+    Runs the requests made inside the block in the background lane.
+
+        with background():
+            async for dialog in client.iter_dialogs():
+                ...
+    """
+    token = PRIORITY.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        PRIORITY.reset(token)
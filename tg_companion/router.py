@@ -0,0 +1,70 @@
+import re
+
+from telethon import events
+
+from tg_companion import CMD_HANDLER, LOGGER
+
+
+class CommandRouter(object):
+    """
+    Dispatches command messages to the handlers registered for them.
+
+    Commands are indexed by their name (the first word after the command handler symbol)
+    so every message costs one precompiled regex match and one dict lookup, no matter how
+    many commands the loaded modules and plugins register.
+    """
+
+    def __init__(self):
+        self._routes = {}
+        self._token = re.compile(re.escape(CMD_HANDLER) + r"(\w+)")
+
+    @staticmethod
+    def command_name(command):
+        """ Returns the literal name a command is looked up by. `cuname (.+)` -> `cuname` """
+        match = re.match(r"\w+", command)
+        if not match:
+            raise ValueError(f"Command {command!r} must start with a word character")
+        return match.group(0)
+
+    def add(self, command, builder, callback):
+        self._routes.setdefault(self.command_name(command), []).append((builder, callback))
+
+    def remove(self, callback):
+        found = 0
+        for name, routes in list(self._routes.items()):
+            kept = [route for route in routes if route[1] != callback]
+            found += len(routes) - len(kept)
+            if kept:
+                self._routes[name] = kept
+            else:
+                del self._routes[name]
+        return found
+
+    def commands(self):
+        return sorted(self._routes)
+
+    def lookup(self, text):
+        if not text:
+            return ()
+        match = self._token.match(text)
+        if not match:
+            return ()
+        return self._routes.get(match.group(1), ())
+
+    async def dispatch(self, client, event, routes=None):
+        if routes is None:
+            routes = tuple(self.lookup(event.message.message))
+        for builder, callback in routes:
+            if not builder.resolved:
+                await builder.resolve(client)
+
+            if not builder.filter(event):
+                continue
+
+            try:
+                await callback(event)
+            except events.StopPropagation:
+                raise
+            except Exception:
+                name = getattr(callback, "__name__", repr(callback))
+                LOGGER.exception("Unhandled exception on %s", name)
@@ -0,0 +1,209 @@
+import asyncio
+import random
+import time
+
+import sqlalchemy as db
+
+from tg_companion import LOGGER, database
+from tg_companion.database import metadata
+from tg_companion.ratelimit import background
+
+# What to do when a run was missed ( the companion was offline or the previous run took too long )
+SKIP = "skip"
+RUN_ONCE = "run_once"
+
+
+class Job(object):
+    """
+    A coroutine function run every `interval` seconds by the `JobScheduler`.
+
+    Attributes:
+        jitter (int): Up to this many random seconds are added to every run so jobs don't start together.
+        timeout (int): Runs taking longer are cancelled. None to never cancel them.
+        missed (str): `SKIP` waits for the next slot after a missed run, `RUN_ONCE` runs right away.
+        interrupted (bool): The last run was stopped by a restart. It runs again right away whatever `missed` is.
+    """
+
+    def __init__(self, name, func, interval, jitter=0, timeout=None, missed=SKIP):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.timeout = timeout
+        self.missed = missed
+        self.paused = False
+        self.task = None
+        self.last_run = None
+        self.interrupted = False
+        self.next_run = 0.0
+        self.last_duration = None
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+
+    @property
+    def running(self):
+        return self.task is not None
+
+    def schedule(self, now):
+        """ Sets `next_run` from the last run, applying the missed run policy and the jitter """
+        if self.last_run is None or self.interrupted:
+            next_run = now
+        else:
+            next_run = self.last_run + self.interval
+            if next_run < now:
+                if self.missed == RUN_ONCE:
+                    next_run = now
+                else:
+                    self.skipped += int((now - self.last_run) // self.interval) - 1
+                    next_run = now + self.interval - (now - self.last_run) % self.interval
+        self.next_run = next_run + random.uniform(0, self.jitter)
+
+
+jobs_tbl = db.Table("scheduled_jobs", metadata,
+                    db.Column("account", db.String(), primary_key=True),
+                    db.Column("name", db.String(), primary_key=True),
+                    db.Column("last_run", db.Float()),
+                    # The start of the run in progress, left set when the companion stops during the run
+                    db.Column("started", db.Float()))
+
+
+class JobScheduler(object):
+    """
+    Runs the periodic jobs of the companion.
+
+    A single task sleeps until the next job is due, so idle jobs cost nothing. A job is never started
+    while its previous run is still going and the time of its last run is stored in the database so
+    restarting the companion doesn't run every job again. A run is only recorded once it ends, the ones
+    stopped by a restart start again right away so the jobs keeping a checkpoint continue where they stopped. Each account has its own scheduler and its own rows.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._jobs = {}
+        self._task = None
+        self._wakeup = asyncio.Event()
+        if database.engine is not None:
+            # Older versions stored other columns, the jobs run again once
+            database.drop_if_outdated(jobs_tbl)
+            database.create_tables(jobs_tbl)
+
+    def add(self, name, func, interval, **kwargs):
+        if name in self._jobs:
+            raise ValueError(f"A job named {name} already exists")
+        job = Job(name, func, interval, **kwargs)
+        self._jobs[name] = job
+        if self._task is not None:
+            self._restore(job, self._load_last_runs())
+            job.schedule(time.time())
+            self._wakeup.set()
+        return job
+
+    def get(self, name):
+        return self._jobs.get(name)
+
+    def jobs(self):
+        return sorted(self._jobs.values(), key=lambda job: job.name)
+
+    def start(self):
+        if self._task is not None:
+            return
+        last_runs = self._load_last_runs()
+        now = time.time()
+        for job in self._jobs.values():
+            self._restore(job, last_runs)
+            job.schedule(now)
+        self._task = asyncio.get_event_loop().create_task(self._run_forever())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for job in self._jobs.values():
+            if job.task is not None:
+                job.task.cancel()
+
+    def run(self, name):
+        """ Starts `name` now. Returns False if it's already running """
+        job = self._jobs[name]
+        if job.running:
+            return False
+        self._start_job(job)
+        return True
+
+    def pause(self, name):
+        self._jobs[name].paused = True
+
+    def resume(self, name):
+        job = self._jobs[name]
+        job.paused = False
+        job.schedule(time.time())
+        self._wakeup.set()
+
+    async def _run_forever(self):
+        while True:
+            now = time.time()
+            waiting = [job for job in self._jobs.values() if not job.paused and not job.running]
+            for job in waiting:
+                if job.next_run <= now:
+                    self._start_job(job)
+
+            next_runs = [job.next_run for job in waiting if not job.running]
+            timeout = max(0.0, min(next_runs) - now) if next_runs else None
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start_job(self, job):
+        job.task = asyncio.get_event_loop().create_task(self._run_job(job))
+
+    async def _run_job(self, job):
+        started = time.time()
+        job.last_run = started
+        job.interrupted = False
+        await self._save_last_run(job, started=started)
+        try:
+            try:
+                with background():
+                    await asyncio.wait_for(job.func(), job.timeout)
+            except asyncio.TimeoutError:
+                job.failures += 1
+                LOGGER.warning("Job %s was cancelled after %ss", job.name, job.timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                job.failures += 1
+                LOGGER.exception("Job %s failed", job.name)
+            # Not reached when the run is cancelled by `stop()`, it's still interrupted
+            await self._save_last_run(job, started=None)
+        finally:
+            job.runs += 1
+            job.last_duration = time.time() - started
+            job.task = None
+            job.schedule(time.time())
+            self._wakeup.set()
+
+    @staticmethod
+    def _restore(job, last_runs):
+        job.last_run, started = last_runs.get(job.name, (None, None))
+        job.interrupted = started is not None
+
+    def _load_last_runs(self):
+        """ Returns name -> (last run, start of the interrupted run or None) """
+        if database.engine is None:
+            return {}
+        columns = jobs_tbl.columns
+        return {name: (last_run, started) for name, last_run, started in database.fetch_all(
+            db.select([columns.name, columns.last_run, columns.started]).where(
+                columns.account == self._client.account_name))}
+
+    async def _save_last_run(self, job, started):
+        """ Saves the start of the run in progress, or `job.last_run` once `started` is None """
+        if database.engine is None:
+            return
+        values = {"started": started} if started is not None else {"last_run": job.last_run, "started": None}
+        await database.aio.upsert(
+            jobs_tbl, {"account": self._client.account_name, "name": job.name}, **values)
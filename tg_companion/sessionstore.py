@@ -0,0 +1,203 @@
+import asyncio
+
+from sqlalchemy import and_
+from telethon import utils
+from telethon.tl.types import PeerChannel, PeerChat, PeerUser
+
+from tg_companion import (ENTITY_CACHE_SIZE, LOGGER, SESSION_FLUSH_INTERVAL,
+                          SESSION_FLUSH_SIZE, database)
+from tg_companion.cache import TTLCache
+
+# How many ids go in one `IN (...)` clause
+CHUNK_SIZE = 500
+
+
+class BufferedSession(object):
+    """
+    Keeps the entities and the update state Telethon saves after every update in memory and writes them in batches.
+
+    Changes are deduplicated by entity id and rows identical to the last written ones are skipped. The buffer is
+    written from the database thread pool `flush_interval` seconds after the first change, as soon as it holds
+    `flush_size` rows, when Telethon saves the session and, synchronously, when the client disconnects.
+    Lookups check the buffer first, so a buffered entity can be used right away.
+
+    Mixed into the core session class of the `AlchemySessionContainer` by `new_session()`.
+    """
+
+    def __init__(self, container, session_id, flush_interval=SESSION_FLUSH_INTERVAL, flush_size=SESSION_FLUSH_SIZE):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending_entities = {}
+        self._pending_states = {}
+        self._flushing_entities = {}
+        self._flushing_states = {}
+        self._written = TTLCache(ENTITY_CACHE_SIZE, 3600)
+        self._flush_handle = None
+        self._flush_task = None
+        self.received = 0
+        self.skipped = 0
+        self.flushes = 0
+        self.rows_written = 0
+        super().__init__(container, session_id)
+
+    def process_entities(self, tlo):
+        rows = self._entities_to_rows(tlo)
+        if not rows:
+            return
+
+        self.received += len(rows)
+        for row in rows:
+            if self._written.get(row[0]) == row and row[0] not in self._pending_entities:
+                self.skipped += 1
+                continue
+            self._pending_entities[row[0]] = row
+        self._schedule()
+
+    def set_update_state(self, entity_id, row):
+        if row:
+            self._pending_states[entity_id] = row
+            self._schedule()
+
+    def get_update_state(self, entity_id):
+        state = self._pending_states.get(entity_id) or self._flushing_states.get(entity_id)
+        if state is not None:
+            return state
+        return super().get_update_state(entity_id)
+
+    def _buffered(self, matches):
+        for rows in (self._pending_entities, self._flushing_entities):
+            for row in rows.values():
+                if matches(row):
+                    return row[0], row[1]
+        return None
+
+    def get_entity_rows_by_id(self, key, exact=True):
+        ids = (key,) if exact else (
+            utils.get_peer_id(PeerUser(key)), utils.get_peer_id(PeerChat(key)), utils.get_peer_id(PeerChannel(key)))
+        for rows in (self._pending_entities, self._flushing_entities):
+            for entity_id in ids:
+                row = rows.get(entity_id)
+                if row is not None:
+                    return row[0], row[1]
+        return super().get_entity_rows_by_id(key, exact)
+
+    def get_entity_rows_by_username(self, key):
+        return self._buffered(lambda row: row[2] == key) or super().get_entity_rows_by_username(key)
+
+    def get_entity_rows_by_phone(self, key):
+        return self._buffered(lambda row: row[3] == key) or super().get_entity_rows_by_phone(key)
+
+    def get_entity_rows_by_name(self, key):
+        return self._buffered(lambda row: row[4] == key) or super().get_entity_rows_by_name(key)
+
+    @property
+    def pending(self):
+        return len(self._pending_entities) + len(self._pending_states)
+
+    def _schedule(self):
+        if self.pending >= self.flush_size:
+            self._start_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.flush_interval, self._start_flush)
+
+    def _start_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        # A running flush schedules the next one when it ends
+        if self._flush_task is not None or not self.pending:
+            return
+
+        self._flushing_entities, self._pending_entities = self._pending_entities, {}
+        self._flushing_states, self._pending_states = self._pending_states, {}
+        self._flush_task = asyncio.get_event_loop().create_task(self._flush())
+
+    async def _flush(self):
+        try:
+            await database.aio.run(self._write, self._flushing_entities, self._flushing_states)
+            self._written_rows(self._flushing_entities, self._flushing_states)
+        except Exception:
+            LOGGER.exception("Failed to save the %s session, retrying later", self.session_id)
+            # The changes buffered since are newer
+            for entity_id, row in self._flushing_entities.items():
+                self._pending_entities.setdefault(entity_id, row)
+            for entity_id, state in self._flushing_states.items():
+                self._pending_states.setdefault(entity_id, state)
+        finally:
+            self._flushing_entities = {}
+            self._flushing_states = {}
+            self._flush_task = None
+            if self.pending:
+                self._schedule()
+
+    def _write(self, entities, states):
+        entity_tbl = self.Entity.__table__
+        state_tbl = self.UpdateState.__table__
+        with self.engine.begin() as connection:
+            if entities:
+                ids = list(entities)
+                for start in range(0, len(ids), CHUNK_SIZE):
+                    connection.execute(entity_tbl.delete().where(and_(
+                        entity_tbl.c.session_id == self.session_id,
+                        entity_tbl.c.id.in_(ids[start:start + CHUNK_SIZE]))))
+                connection.execute(entity_tbl.insert(), [
+                    dict(session_id=self.session_id, id=row[0], hash=row[1],
+                         username=row[2], phone=row[3], name=row[4])
+                    for row in entities.values()])
+
+            if states:
+                connection.execute(state_tbl.delete().where(and_(
+                    state_tbl.c.session_id == self.session_id,
+                    state_tbl.c.entity_id.in_(list(states)))))
+                connection.execute(state_tbl.insert(), [
+                    dict(session_id=self.session_id, entity_id=entity_id, pts=state.pts, qts=state.qts,
+                         date=state.date.timestamp(), seq=state.seq, unread_count=state.unread_count)
+                    for entity_id, state in states.items()])
+
+    def _written_rows(self, entities, states):
+        for entity_id, row in entities.items():
+            self._written.set(entity_id, row)
+        self.flushes += 1
+        self.rows_written += len(entities) + len(states)
+
+    def save(self):
+        self._start_flush()
+
+    def close(self):
+        """ Writes everything still buffered before the client disconnects """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        entities = {**self._flushing_entities, **self._pending_entities}
+        states = {**self._flushing_states, **self._pending_states}
+        self._pending_entities, self._pending_states = {}, {}
+        if entities or states:
+            try:
+                self._write(entities, states)
+                self._written_rows(entities, states)
+            except Exception:
+                LOGGER.exception("Failed to save the %s session", self.session_id)
+        super().close()
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "skipped": self.skipped,
+            "pending": self.pending,
+            "flushes": self.flushes,
+            "written": self.rows_written,
+        }
+
+
+_session_classes = {}
+
+
+def new_session(container, session_id):
+    """ Returns a `BufferedSession` for `session_id` stored by `container` """
+    # The core classes write with plain statements, the ORM one would keep its own copy of every row
+    container.core_mode = True
+    base = container.alchemy_session_class
+    session_class = _session_classes.get(base)
+    if session_class is None:
+        session_class = _session_classes[base] = type("Buffered" + base.__name__, (BufferedSession, base), {})
+    return session_class(container, session_id)
@@ -0,0 +1,227 @@
+"""
+Runs the companion accounts in several worker processes so they can use every core.
+
+    python3 -m tg_companion.supervisor --workers 4
+
+The sessions ( `SESSION_NAME` and `EXTRA_SESSIONS`, or every session stored in the database with `--all-sessions` )
+are spread between the workers. Each worker is a normal `python3 -m tg_companion` process running its share of
+the accounts, so a busy account only slows down the accounts of its own worker. Crashed workers are restarted.
+
+The output of every worker is printed and saved to LOG_DIR/workers.log, prefixed with the worker name, and each
+worker keeps its other logs in LOG_DIR/worker-<n>/. When `METRICS_PORT` is set the metrics of every worker are
+served on http://127.0.0.1:METRICS_PORT/metrics with a `worker` label.
+"""
+import asyncio
+import logging
+import os
+import signal
+import sys
+import time
+from argparse import ArgumentParser
+from collections import OrderedDict
+from logging.handlers import RotatingFileHandler
+
+from tg_companion import EXTRA_SESSIONS, LOG_DIR, LOGGER, METRICS_PORT, SESSION_NAME, web
+from tg_companion.accounts import NOT_SIGNED_IN
+
+# A worker running for this many seconds before crashing is restarted right away
+STABLE_AFTER = 60
+
+
+class Worker(object):
+    """ A worker process running the `sessions` accounts """
+
+    def __init__(self, index, sessions, metrics_port=0):
+        self.name = f"worker-{index}"
+        self.sessions = sessions
+        self.metrics_port = metrics_port
+        self.process = None
+        self.started = None
+        self.restarts = 0
+        self.stopped = False
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.returncode is None
+
+    def env(self):
+        env = dict(os.environ)
+        env.update(
+            SESSION_NAME=self.sessions[0],
+            EXTRA_SESSIONS=",".join(self.sessions[1:]),
+            LOG_DIR=os.path.join(LOG_DIR, self.name),
+            METRICS_PORT=str(self.metrics_port),
+            PYTHONUNBUFFERED="1")
+        return env
+
+
+def shard(sessions, workers):
+    """ Spreads `sessions` between at most `workers` lists """
+    workers = max(1, min(workers, len(sessions)))
+    return [sessions[index::workers] for index in range(workers)]
+
+
+class Supervisor(object):
+    """ Starts the workers, restarts the crashed ones and collects their output and metrics """
+
+    def __init__(self, sessions, workers, metrics_port=0, max_backoff=300):
+        self.workers = [
+            Worker(index, worker_sessions, metrics_port + 1 + index if metrics_port else 0)
+            for index, worker_sessions in enumerate(shard(sessions, workers))]
+        self.metrics_port = metrics_port
+        self.max_backoff = max_backoff
+        self._output = logging.getLogger("tg_companion.workers")
+        self._output.propagate = False
+        self._server = None
+
+    def _setup_output(self):
+        os.makedirs(LOG_DIR, exist_ok=True)
+        formatter = logging.Formatter("%(message)s")
+        for handler in (logging.StreamHandler(sys.stdout),
+                        RotatingFileHandler(os.path.join(LOG_DIR, "workers.log"),
+                                            maxBytes=5 * 1024 * 1024, backupCount=3)):
+            handler.setFormatter(formatter)
+            self._output.addHandler(handler)
+        self._output.setLevel(logging.INFO)
+
+    async def run(self):
+        self._setup_output()
+        for worker in self.workers:
+            LOGGER.info("%s runs %s", worker.name, ", ".join(worker.sessions))
+        if self.metrics_port:
+            await self._serve_metrics()
+        await asyncio.gather(*(self._supervise(worker) for worker in self.workers))
+
+    async def _supervise(self, worker):
+        backoff = 1
+        while not worker.stopped:
+            worker.started = time.monotonic()
+            worker.process = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", "tg_companion", "--worker", env=worker.env(),
+                stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+            await self._forward_output(worker)
+            code = await worker.process.wait()
+
+            if worker.stopped or code == 0:
+                LOGGER.info("%s stopped", worker.name)
+                return
+            if code == NOT_SIGNED_IN:
+                LOGGER.error("%s is not restarted until %s are signed in", worker.name, ", ".join(worker.sessions))
+                return
+
+            if time.monotonic() - worker.started > STABLE_AFTER:
+                backoff = 1
+            LOGGER.warning("%s exited with code %s, restarting it in %ss", worker.name, code, backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+            worker.restarts += 1
+
+    async def _forward_output(self, worker):
+        while True:
+            line = await worker.process.stdout.readline()
+            if not line:
+                return
+            self._output.info("[%s] %s", worker.name, line.decode(errors="replace").rstrip())
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stopped = True
+            if worker.running:
+                worker.process.terminate()
+
+    async def _serve_metrics(self):
+        from aiohttp import web as aioweb
+
+        async def handle(request):
+            return aioweb.Response(text=await self.render_metrics(), content_type="text/plain")
+
+        app = aioweb.Application()
+        app.router.add_get("/metrics", handle)
+        self._server = aioweb.AppRunner(app)
+        await self._server.setup()
+        await aioweb.TCPSite(self._server, "127.0.0.1", self.metrics_port).start()
+        LOGGER.info(f"Serving the metrics of every worker on http://127.0.0.1:{self.metrics_port}/metrics")
+
+    async def _scrape(self, worker):
+        if not worker.running:
+            return ""
+        try:
+            async with web.session().get(f"http://127.0.0.1:{worker.metrics_port}/metrics", timeout=5) as response:
+                return await response.text()
+        except Exception as exc:
+            LOGGER.debug("Failed to read the metrics of %s: %r", worker.name, exc)
+            return ""
+
+    async def render_metrics(self):
+        """ Returns the metrics of every worker with a `worker` label, followed by the supervisor ones """
+        texts = await asyncio.gather(*(self._scrape(worker) for worker in self.workers))
+
+        families = OrderedDict()
+        for worker, text in zip(self.workers, texts):
+            family = None
+            for line in text.splitlines():
+                if line.startswith("# "):
+                    family = families.setdefault(line.split()[2], {"meta": [], "samples": []})
+                    if line not in family["meta"]:
+                        family["meta"].append(line)
+                elif line and family is not None:
+                    family["samples"].append(_add_label(line, "worker", worker.name))
+
+        lines = []
+        for family in families.values():
+            lines.extend(family["meta"])
+            lines.extend(family["samples"])
+        for name, help, value in (
+                ("worker_up", "1 if the worker is running", lambda worker: int(worker.running)),
+                ("worker_restarts_total", "How many times the worker was restarted", lambda worker: worker.restarts)):
+            lines.append(f"# HELP tg_companion_{name} {help}")
+            lines.append(f"# TYPE tg_companion_{name} {'counter' if name.endswith('_total') else 'gauge'}")
+            for worker in self.workers:
+                lines.append(f'tg_companion_{name}{{worker="{worker.name}"}} {value(worker)}')
+        return "\n".join(lines) + "\n"
+
+
+def _add_label(sample, name, value):
+    metric, _, rest = sample.partition(" ")
+    label = f'{name}="{value}"'
+    if metric.endswith("}"):
+        return f"{metric[:-1]},{label}}} {rest}"
+    return f"{metric}{{{label}}} {rest}"
+
+
+def stored_sessions():
+    """ Returns the names of every session saved in the database """
+    from alchemysession import AlchemySessionContainer
+    from tg_companion import database
+
+    container = AlchemySessionContainer(engine=database.engine)
+    return sorted(row[0] for row in container.db.query(container.Session.session_id).distinct())
+
+
+def main():
+    parser = ArgumentParser(prog="tg_companion.supervisor", description="Run the companion accounts in several processes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="How many worker processes to start. Defaults to the number of cores")
+    parser.add_argument("--sessions", help="Comma separated session names. Defaults to SESSION_NAME and EXTRA_SESSIONS")
+    parser.add_argument("--all-sessions", action="store_true", help="Run every session stored in the database")
+    args = parser.parse_args()
+
+    if args.all_sessions:
+        sessions = stored_sessions()
+    elif args.sessions:
+        sessions = [name.strip() for name in args.sessions.split(",") if name.strip()]
+    else:
+        sessions = [SESSION_NAME] + EXTRA_SESSIONS
+    if not sessions:
+        LOGGER.error("There are no sessions to run")
+        quit(1)
+
+    supervisor = Supervisor(sessions, args.workers, METRICS_PORT)
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, supervisor.stop)
+    loop.run_until_complete(supervisor.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import asyncio
+import functools
+import itertools
+import time
+
+from tg_companion import LOGGER
+
+# What a limited handler does when all its slots are busy
+DROP = "drop"
+QUEUE = "queue"
+
+
+class HandlerTask(object):
+    """ A handler run tracked by the `TaskRegistry` so it can be listed and cancelled """
+    __slots__ = ("id", "name", "chat_id", "started", "task")
+
+    def __init__(self, id, name, chat_id, task):
+        self.id = id
+        self.name = name
+        self.chat_id = chat_id
+        self.started = time.monotonic()
+        self.task = task
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+
+class TaskRegistry(object):
+    """
+    Runs handlers in their own task so they can be limited, timed out and cancelled.
+
+    `wrap()` returns a handler which runs the original one with at most `max_concurrent` runs at the same
+    time. When every slot is busy the `DROP` policy ignores the new event and the `QUEUE` policy waits
+    for a free slot. Runs taking longer than `timeout` seconds are cancelled.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+        self._ids = itertools.count(1)
+        self.dropped = 0
+        self.timed_out = 0
+        self.cancelled = 0
+
+    def wrap(self, callback, max_concurrent=None, timeout=None, policy=QUEUE):
+        if policy not in (DROP, QUEUE):
+            raise ValueError(f"Unknown policy {policy!r}, use {DROP!r} or {QUEUE!r}")
+        semaphore = asyncio.Semaphore(max_concurrent) if max_concurrent else None
+        name = getattr(callback, "__name__", repr(callback))
+
+        @functools.wraps(callback)
+        async def handler(event):
+            if semaphore is None:
+                return await self._run(name, callback, event, timeout)
+
+            if policy == DROP and semaphore.locked():
+                self.dropped += 1
+                LOGGER.info("%s is already running, ignoring the new event", name)
+                return
+            async with semaphore:
+                return await self._run(name, callback, event, timeout)
+
+        return handler
+
+    async def _run(self, name, callback, event, timeout):
+        task_id = next(self._ids)
+        task = asyncio.get_event_loop().create_task(callback(event))
+        self._tasks[task_id] = HandlerTask(task_id, name, getattr(event, "chat_id", None), task)
+        try:
+            return await asyncio.wait_for(task, timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            LOGGER.warning("%s was cancelled after %ss", name, timeout)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            LOGGER.info("%s was cancelled", name)
+        finally:
+            del self._tasks[task_id]
+
+    def tasks(self):
+        return list(self._tasks.values())
+
+    def cancel(self, task_id):
+        """ Cancels the handler run `task_id`. Returns False if it's not running """
+        handler_task = self._tasks.get(task_id)
+        if handler_task is None:
+            return False
+        self.cancelled += 1
+        handler_task.task.cancel()
+        return True
+
+    def stats(self):
+        return {
+            "running": len(self._tasks),
+            "dropped": self.dropped,
+            "timed_out": self.timed_out,
+            "cancelled": self.cancelled,
+        }
@@ -1,28 +1,63 @@
 import asyncio
 import datetime
-import inspect
+import functools
 import io
 import os
-import sys
 import zipfile
 from getpass import getpass
 
 from alchemysession import AlchemySessionContainer
-from telethon import TelegramClient, events
+from telethon import TelegramClient, events, utils
+from telethon.events.common import EventBuilder
 from telethon.errors import FloodWaitError, SessionPasswordNeededError
 from telethon.errors.rpcerrorlist import PhoneCodeInvalidError
+from telethon.tl import types
 
-from tg_companion import (APP_HASH, APP_ID, CMD_HANDLER, DB_URI, DEBUG, LOGGER,
-                          SESSION_NAME, proxy)
+from tg_companion import (APP_HASH, APP_ID, CMD_HANDLER, DEBUG,
+                          EDIT_INTERVAL, ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL,
+                          EXTRA_SESSIONS, FLOOD_WAIT_THRESHOLD, LOGGER,
+                          RATE_LIMITS, SESSION_NAME, proxy, startup)
 from tg_companion._version import __version__
+from tg_companion import database, sessionstore
+from tg_companion.accounts import ClientProxy, current_client
+from tg_companion.cache import TTLCache
+from tg_companion.connection import ConnectionSupervisor, channel_of
+from tg_companion.dialogs import DialogIndex
+from tg_companion.permissions import ChatAdmins, ChatPermissions
+from tg_companion.pipeline import PassivePipeline
+from tg_companion.ratelimit import RequestScheduler, parse_limits
+from tg_companion.router import CommandRouter
+from tg_companion.scheduler import SKIP, JobScheduler
+from tg_companion.tasks import QUEUE, TaskRegistry
+from tg_companion.writer import MessageWriter
 from telethon.client.users import UserMethods
 
 loop = asyncio.get_event_loop()
 
+# Every account has its own buckets with these limits
+rate_limits = parse_limits(RATE_LIMITS)
+
 
 CMD_HELP = {}
 
 
+class AccountSelfId(object):
+    """
+    Replaces Telethon's `EventBuilder.self_id`, a class attribute set by the first account to resolve an event,
+    so the events built from short updates use the id of the account handling them.
+    """
+
+    def __get__(self, instance, owner):
+        account = current_client.get()
+        return getattr(getattr(account, "_self_input_peer", None), "user_id", None)
+
+    @classmethod
+    def install(cls):
+        # Telethon assigns the class attribute when it's falsy, which replaces the descriptor
+        if not isinstance(EventBuilder.__dict__.get("self_id"), cls):
+            EventBuilder.self_id = cls()
+
+
 class CustomDisconnect(UserMethods):
     async def _run_until_disconnected(self):
         try:
@@ -44,22 +79,66 @@ class CustomDisconnect(UserMethods):
 
 class CustomClient(TelegramClient):
 
-    def __init__(self, session_name, app_id, app_hash):
+    def __init__(self, session_name, app_id, app_hash, accounts):
         super().__init__(
             session_name,
             app_id,
             app_hash,
             proxy=proxy,
-            app_version=__version__.public())
-
+            app_version=__version__.public(),
+            flood_sleep_threshold=0)
+
+        self.account_name = None
+        self._scheduler = RequestScheduler(limits=rate_limits)
+        self.modules = accounts.modules
+        self.metrics = accounts.metrics
+        self._metered = {}
+
+        self._commands = CommandRouter()
+        self._edited_commands = CommandRouter()
+        self.add_event_handler(self._on_command, events.NewMessage())
+        self.add_event_handler(self._on_edited_command, events.MessageEdited())
+        self._passive = PassivePipeline()
+        self._edited_passive = PassivePipeline()
+        self.add_event_handler(self._on_message, events.NewMessage())
+        self.add_event_handler(self._on_edited_message, events.MessageEdited())
+
+        self._entity_cache = TTLCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+        self._username_cache = TTLCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+        self._reply_cache = TTLCache(ENTITY_CACHE_SIZE // 4, ENTITY_CACHE_TTL)
+        self._permissions_cache = TTLCache(ENTITY_CACHE_SIZE // 4, ENTITY_CACHE_TTL)
+        self._admins_cache = TTLCache(ENTITY_CACHE_SIZE // 4, ENTITY_CACHE_TTL)
+        self.add_event_handler(self._refresh_entity_cache, events.Raw())
+        self.add_event_handler(self._refresh_admins_cache, events.ChatAction())
+        self.dialog_index = DialogIndex(self)
+        self.add_event_handler(self.dialog_index.on_update, events.Raw())
+
+        self._writer = MessageWriter(self, EDIT_INTERVAL)
+        self._tasks = TaskRegistry()
+        self.jobs = JobScheduler(self)
+        self._error_log = accounts._error_log
+        self.loop_lag = accounts.loop_lag
+        self.connection = ConnectionSupervisor(self)
+
+    def login(self, interactive=True):
+        """
+        Connects to Telegram and signs in, asking for the phone and the code the first time.
+        Returns False if the account isn't signed in and `interactive` is False
+        """
         LOGGER.info("Connecting to Telegram servers")
-        try:
-            loop.run_until_complete(self.connect())
-        except ConnectionError:
-            LOGGER.info("Failed to connect to Telegram Server.. Retrying")
-            loop.run_until_complete(self.connect())
+        with startup.phase("connect"):
+            try:
+                loop.run_until_complete(self.connect())
+            except ConnectionError:
+                LOGGER.info("Failed to connect to Telegram Server.. Retrying")
+                loop.run_until_complete(self.connect())
 
-        if not loop.run_until_complete(self.is_user_authorized()):
+        with startup.phase("authorize"):
+            authorized = loop.run_until_complete(self.is_user_authorized())
+
+        if not authorized:
+            if not interactive:
+                return False
             LOGGER.info("Welcome to Telegram Companion!")
             LOGGER.info("Telegram Companion is a python app trying to bring new features to other official or unofficial Telegram clients")
             LOGGER.info("You can report a bug or a give a suggestion in our telegram group at https://t.me/tgcompanion")
@@ -93,7 +172,71 @@ class CustomClient(TelegramClient):
                         self_user = loop.run_until_complete(
                             self.sign_in(password=password))
 
+        # The events of this account are built with its id, see `AccountSelfId`
+        loop.run_until_complete(self.get_me(input_peer=True))
         LOGGER.info("Connected!!")
+        return True
+
+    async def __call__(self, request, ordered=False):
+        """
+        Sends `request` through the `RequestScheduler` so it's delayed instead of hitting a flood wait.
+        Flood waits shorter than `FLOOD_WAIT_THRESHOLD` block every request of the same kind and are retried,
+        longer ones are raised.
+        """
+        requests = request if utils.is_list_like(request) else (request,)
+        self.metrics.count_requests(len(requests))
+        while True:
+            for r in requests:
+                await self._scheduler.acquire(r)
+            try:
+                return await super().__call__(request, ordered=ordered)
+            except FloodWaitError as exc:
+                for r in requests:
+                    self._scheduler.flood_wait(r, exc.seconds)
+                if exc.seconds > FLOOD_WAIT_THRESHOLD:
+                    raise
+                LOGGER.info("Flood wait of %ss on %s, retrying", exc.seconds, type(requests[0]).__name__)
+
+    def disconnect(self):
+        self.connection.stop()
+        self.dialog_index.close()
+        return super().disconnect()
+
+    async def _handle_update(self, update):
+        # Telethon stores the pts of channel updates in the common state, which would make `getDifference` skip
+        # or repeat updates. Channels have their own pts, kept by the `ConnectionSupervisor`
+        common_pts = self._state.pts
+        await super()._handle_update(update)
+        if channel_of(update) is not None:
+            self._state.pts = common_pts
+            self.connection.seen(update)
+
+    async def _handle_auto_reconnect(self):
+        # Telethon reconnected by itself, the updates sent meanwhile are lost unless we ask for them
+        await self.connection.catch_up()
+
+    def request_stats(self):
+        """ Returns the counters of the `RequestScheduler` """
+        return self._scheduler.stats()
+
+    async def _dispatch_update(self, update):
+        AccountSelfId.install()
+        token = current_client.set(self)
+        try:
+            await super()._dispatch_update(update)
+        finally:
+            current_client.reset(token)
+
+    def add_event_handler(self, callback, event=None):
+        module = getattr(callback, "__module__", None)
+        self.modules.record_eager(module)
+        if module and module.startswith(("tg_companion.modules.", "tg_companion.plugins.")):
+            self._metered[callback] = self.metrics.wrap(callback)
+            callback = self._metered[callback]
+        super().add_event_handler(callback, event)
+
+    def remove_event_handler(self, callback, event=None):
+        return super().remove_event_handler(self._metered.pop(callback, callback), event)
 
     def CommandHandler(
             self,
@@ -101,6 +244,10 @@ class CustomClient(TelegramClient):
             command=None,
             allow_edited=False,
             help=None,
+            checks=None,
+            max_concurrent=None,
+            timeout=None,
+            policy=QUEUE,
             **kwargs):
         def decorator(f):
             """
@@ -111,6 +258,7 @@ class CustomClient(TelegramClient):
                     If set to any str instance the decorated function will only work if
                             the message matches the command handler symbol ( default "." ) + the word/regex in the command argument
                             if the command is not set or None it will execute the decorated function when a message event is triggered
+                            Commands are routed by their first word so `.cuname (.+)` is only matched against messages starting with `.cuname`
 
                 allow_edited (bool):
                     If set True the command will also work when the message is edited.
@@ -118,35 +266,286 @@ class CustomClient(TelegramClient):
                 help (str):
                     The help message used for displaying the command usage
 
+                checks (list):
+                    Cheap synchronous predicates that only use data already in the update ( `event.chat_id`, `event.sender_id`, ... )
+                            They are evaluated in order, before `func`, and the first one returning False skips the handler.
+                            Handlers without a command run in the passive pipeline which counts the hits and misses of every check.
+
+                max_concurrent (int):
+                    How many runs of the handler can happen at the same time. None for no limit.
+
+                timeout (int):
+                    Cancel the runs taking longer than this many seconds.
+
+                policy (str):
+                    "drop" to ignore the events arriving while every slot is busy or "queue" ( default ) to wait for a free slot.
+                            Command runs are listed by the `tasks` command, which can also cancel them.
+
             """
             global CMD_HELP
+            module = f.__module__
             pattern = None
+            handler = self.metrics.wrap(f)
+            if command or max_concurrent or timeout:
+                handler = self._tasks.wrap(handler, max_concurrent, timeout, policy)
+
+            def _checked(e):
+                return all(check(e) for check in checks) and (func is None or func(e))
+
+            route_func = _checked if checks else func
+
             if command:
                 CMD_SYMBOL = ""
                 for symbol in CMD_HANDLER:
                     CMD_SYMBOL += "\\" + symbol
                 pattern = CMD_SYMBOL + command
-            self.add_event_handler(
-                f, events.NewMessage(
-                    pattern=pattern, func=func, **kwargs))
+                self._commands.add(command, events.NewMessage(
+                    pattern=pattern, func=route_func, **kwargs), handler)
+                self.modules.record_command(module, self._commands.command_name(command), filters=kwargs)
+            elif set(kwargs) <= {"incoming", "outgoing"}:
+                self._passive.add(handler, self._passive.build_stages(
+                    checks=checks or (), func=func, **kwargs))
+                self.modules.record_eager(module)
+            else:
+                self.add_event_handler(
+                    handler, events.NewMessage(func=route_func, **kwargs))
 
             if help:
-                module_name = inspect.getmodule(f).__name__
-                cmd_name = module_name.rsplit(".", 1)[-1].replace(".py", "")
+                cmd_name = module.rsplit(".", 1)[-1].replace(".py", "")
                 if command:
                     cmd_name = command.split(None, 1)[0]
 
                 if cmd_name not in CMD_HELP:
 
                     CMD_HELP.update({f"{cmd_name}": help})
+                    self.modules.record_help(module, cmd_name, help)
 
             if allow_edited:
-                self.add_event_handler(
-                    f, events.MessageEdited(
-                        pattern=pattern, func=func, **kwargs))
+                if command:
+                    self._edited_commands.add(command, events.MessageEdited(
+                        pattern=pattern, func=route_func, **kwargs), handler)
+                    self.modules.record_command(
+                        module, self._edited_commands.command_name(command), edited=True, filters=kwargs)
+                elif set(kwargs) <= {"incoming", "outgoing"}:
+                    self._edited_passive.add(handler, self._edited_passive.build_stages(
+                        checks=checks or (), func=func, **kwargs))
+                else:
+                    self.add_event_handler(
+                        handler, events.MessageEdited(func=route_func, **kwargs))
             return f
         return decorator
 
+    def limit(self, max_concurrent=None, timeout=None, policy=QUEUE):
+        r"""
+        Limits a handler registered with `client.on()`. Uses the same arguments as `CommandHandler`
+
+            @client.on(events.NewMessage(pattern=r"\.enablegbans"))
+            @client.limit(max_concurrent=1, policy="drop")
+            async def handler(event):
+                ...
+        """
+        def decorator(f):
+            return self._tasks.wrap(f, max_concurrent, timeout, policy)
+        return decorator
+
+    def handler_tasks(self):
+        """ Returns the `HandlerTask` of every handler run in progress """
+        return self._tasks.tasks()
+
+    def cancel_task(self, task_id):
+        return self._tasks.cancel(task_id)
+
+    async def _on_command(self, event):
+        await self._commands.dispatch(self, event)
+
+    async def _on_edited_command(self, event):
+        await self._edited_commands.dispatch(self, event)
+
+    def passive_stats(self, edited=False):
+        """ Returns the hit/miss counters of the passive pipeline stages. See `PassivePipeline.stats()` """
+        if edited:
+            return self._edited_passive.stats()
+        return self._passive.stats()
+
+    async def _on_message(self, event):
+        await self._passive.dispatch(event)
+
+    async def _on_edited_message(self, event):
+        await self._edited_passive.dispatch(event)
+
+    async def get_me(self, input_peer=False):
+        """ Same as `TelegramClient.get_me()` but the self user is kept in the entity cache """
+        if input_peer:
+            return await super().get_me(input_peer=True)
+
+        me = self._entity_cache.get("me")
+        if me is None:
+            me = await super().get_me()
+            if me is not None:
+                self._entity_cache.set("me", me)
+        return me
+
+    async def get_entity(self, entity):
+        """
+        Same as `TelegramClient.get_entity()` but single entities are served from the entity cache.
+        Usernames are cached too, so resolving the same username twice costs only one `ResolveUsernameRequest`.
+        Username lookups are counted by the username cache only
+        """
+        if utils.is_list_like(entity):
+            return await super().get_entity(entity)
+
+        username = None
+        if isinstance(entity, str):
+            username = entity.lstrip("@").lower()
+            key = self._username_cache.peek(username)
+            cached = None if key is None else self._entity_cache.peek(key)
+            self._username_cache.count(cached is not None)
+            if cached is not None:
+                return cached
+        else:
+            try:
+                key = utils.get_peer_id(entity)
+            except TypeError:
+                key = None
+            if key is not None:
+                cached = self._entity_cache.get(key)
+                if cached is not None:
+                    return cached
+
+        result = await super().get_entity(entity)
+        self._cache_entity(result)
+        if username:
+            self._username_cache.set(username, utils.get_peer_id(result))
+        return result
+
+    async def get_reply_message(self, event):
+        """ Returns the message `event` is replying to. The message is shared between every handler of the same update """
+        if not event.reply_to_msg_id:
+            return None
+
+        key = (event.chat_id, event.reply_to_msg_id)
+        message = self._reply_cache.get(key)
+        if message is None:
+            message = await event.get_reply_message()
+            if message is not None:
+                self._reply_cache.set(key, message)
+        return message
+
+    async def get_permissions(self, chat):
+        """
+        Returns the `ChatPermissions` the companion account has in `chat`, a chat entity or anything `get_entity`
+        takes. A chat entity given is at least as recent as the cached rights, they're read again if it differs
+        """
+        key = utils.get_peer_id(chat)
+        is_entity = isinstance(chat, (types.Chat, types.Channel, types.ChatForbidden, types.ChannelForbidden))
+        permissions = self._permissions_cache.peek(key)
+        fresh = permissions is not None and (not is_entity or permissions.same_as(chat))
+        self._permissions_cache.count(fresh)
+        if not fresh:
+            if not is_entity:
+                chat = await self.get_entity(chat)
+            permissions = ChatPermissions.from_chat(chat)
+            self._permissions_cache.set(key, permissions)
+        return permissions
+
+    async def get_chat_admins(self, chat):
+        """ Returns the `ChatAdmins` of `chat`. The admin list is only downloaded when it's not cached """
+        key = utils.get_peer_id(chat)
+        admins = self._admins_cache.get(key)
+        if admins is None:
+            admins = ChatAdmins.from_participants(
+                await self.get_participants(chat, filter=types.ChannelParticipantsAdmins))
+            self._admins_cache.set(key, admins)
+        return admins
+
+    def cache_stats(self):
+        return {
+            "entities": self._entity_cache.stats(),
+            "usernames": self._username_cache.stats(),
+            "replies": self._reply_cache.stats(),
+            "permissions": self._permissions_cache.stats(),
+            "admins": self._admins_cache.stats(),
+        }
+
+    def _cache_entity(self, entity):
+        if getattr(entity, "min", False):
+            return
+        self._entity_cache.set(utils.get_peer_id(entity), entity)
+        if getattr(entity, "username", None):
+            self._username_cache.set(entity.username.lower(), utils.get_peer_id(entity))
+
+    def _invalidate_entity(self, peer):
+        peer_id = utils.get_peer_id(peer)
+        self._permissions_cache.pop(peer_id)
+        self._admins_cache.pop(peer_id)
+        entity = self._entity_cache.pop(peer_id)
+        if getattr(entity, "username", None):
+            self._username_cache.pop(entity.username.lower())
+        if getattr(entity, "is_self", False):
+            self._entity_cache.pop("me")
+
+    def _invalidate_replies(self, ids, chat_id=None):
+        ids = set(ids)
+        for key in self._reply_cache.keys():
+            if key[1] in ids and (chat_id is None or key[0] == chat_id):
+                self._reply_cache.pop(key)
+
+    async def _refresh_entity_cache(self, update):
+        for peer_id, entity in getattr(update, "_entities", {}).items():
+            permissions = self._permissions_cache.peek(peer_id)
+            if permissions is not None and not getattr(entity, "min", False) and not permissions.same_as(entity):
+                self._permissions_cache.pop(peer_id)
+            if peer_id in self._entity_cache and not getattr(entity, "min", False):
+                self._entity_cache.set(peer_id, entity)
+                if getattr(entity, "is_self", False) and "me" in self._entity_cache:
+                    self._entity_cache.set("me", entity)
+
+        if isinstance(update, (types.UpdateUserName, types.UpdateUserPhoto)):
+            self._invalidate_entity(types.PeerUser(update.user_id))
+        elif isinstance(update, types.UpdateChannel):
+            self._invalidate_entity(types.PeerChannel(update.channel_id))
+        elif isinstance(update, types.UpdateChatParticipantAdmin):
+            admins = self._admins_cache.peek(utils.get_peer_id(types.PeerChat(update.chat_id)))
+            if admins is not None:
+                if update.is_admin:
+                    admins.admin_ids.add(update.user_id)
+                else:
+                    admins.admin_ids.discard(update.user_id)
+            if update.user_id == getattr(self._self_input_peer, "user_id", None):
+                self._invalidate_entity(types.PeerChat(update.chat_id))
+        elif isinstance(update, types.UpdateChatParticipants):
+            self._invalidate_entity(types.PeerChat(update.participants.chat_id))
+        elif isinstance(update, types.UpdateDeleteMessages):
+            self._invalidate_replies(update.messages)
+        elif isinstance(update, types.UpdateDeleteChannelMessages):
+            self._invalidate_replies(
+                update.messages, utils.get_peer_id(types.PeerChannel(update.channel_id)))
+        elif isinstance(update, types.UpdateEditMessage):
+            self._invalidate_replies((update.message.id,))
+        elif isinstance(update, types.UpdateEditChannelMessage):
+            self._invalidate_replies(
+                (update.message.id,), utils.get_peer_id(update.message.to_id))
+
+    async def _refresh_admins_cache(self, event):
+        if not (event.user_left or event.user_kicked or event.user_joined or event.user_added):
+            return
+
+        user_ids = event.user_ids or ()
+        if getattr(self._self_input_peer, "user_id", None) in user_ids:
+            self._invalidate_entity(event._chat_peer)
+            return
+
+        if event.user_left or event.user_kicked:
+            admins = self._admins_cache.peek(event.chat_id)
+            if admins is not None and admins.creator_id in user_ids:
+                self._admins_cache.pop(event.chat_id)
+            elif admins is not None:
+                admins.admin_ids.difference_update(user_ids)
+
+    def progress_message(self, message):
+        """ Returns a `ProgressMessage` that coalesces the edits of `message`. See `MessageWriter` """
+        return self._writer.stream(message)
+
     async def update_message(self, entity, text):
         """ Alternative for `client.edit_message()` or `client.update_message(event, )`
             which edit a message and if the edit is not allowed is replying to the respective message.
@@ -164,15 +563,16 @@ class CustomClient(TelegramClient):
                 await self.update_message(event, "`File size too big. Max 1.5GB.`")
                 return
             f_name = os.path.basename(path)
-            f_size, unit = self.convert_file_size(os.path.getsize(f_name))
-            await client.update_message(event,
-                f"**Uploading**:\n\n"
-                f"  __File Name:__ `{f_name}`\n"
-                f"  __Size__: `{f_size}` {unit}\n"
-            )
-
-            await self.send_file(event.chat_id, path, file_name=f_name,
-                                 force_document=force_document, reply_to=reply_to, progress_callback=None)
+            f_size, unit = self.convert_file_size(os.path.getsize(path))
+            OUTPUT = (f"**Uploading**:\n\n"
+                      f"  __File Name:__ `{f_name}`\n"
+                      f"  __Size__: `{f_size}` {unit}\n")
+            await client.update_message(event, OUTPUT)
+
+            async with self.progress_message(event) as progress:
+                await self.send_file(event.chat_id, path, file_name=f_name,
+                                     force_document=force_document, reply_to=reply_to,
+                                     progress_callback=self._upload_progress(progress, OUTPUT))
             await event.delete()
 
         elif os.path.isdir(path):
@@ -197,13 +597,14 @@ class CustomClient(TelegramClient):
                     memzip.name = f"{d_name}.zip"
                     memzip.seek(0)
                     d_size, unit = self.convert_file_size(d_size)
-                    await client.update_message(event,
-                        f"**Uploading**:\n\n"
-                        f"  __Folder Name:__ `{d_name}`\n"
-                        f"  __Size__: `{d_size}` {unit}\n"
-                    )
-
-                    await client.send_file(event.chat_id, file=memzip, allow_cache=None, progress_callback=None)
+                    OUTPUT = (f"**Uploading**:\n\n"
+                              f"  __Folder Name:__ `{d_name}`\n"
+                              f"  __Size__: `{d_size}` {unit}\n")
+                    await client.update_message(event, OUTPUT)
+
+                    async with self.progress_message(event) as progress:
+                        await client.send_file(event.chat_id, file=memzip, allow_cache=None,
+                                               progress_callback=self._upload_progress(progress, OUTPUT))
                     await event.delete()
             except FileNotFoundError:
                 await client.update_message(event, f"`{path}` doesn't exist.")
@@ -212,6 +613,13 @@ class CustomClient(TelegramClient):
             await client.update_message(event, f"{path} doesn't exist.")
             return
 
+    @staticmethod
+    def _upload_progress(progress, text):
+        def callback(sent, total):
+            if total:
+                progress.update(f"{text}  __Progress__: `{round(sent / total * 100)}%`")
+        return callback
+
     def convert_file_size(self, size):
         power = 2**10
         n = 0
@@ -226,30 +634,41 @@ class CustomClient(TelegramClient):
             n += 1
         return round(size, 2), units[n]
 
-    def on_timer(self, seconds):
+    def job(self, interval, name=None, jitter=0, timeout=None, missed=SKIP):
         """
-        A decorator that runs a decorated function every x seconds.
+        A decorator that runs the decorated coroutine function every `interval` seconds in the background lane.
+        Jobs start with `client.jobs.start()` and a job never runs twice at the same time.
 
         Args:
+            interval (int): Seconds between two runs. 0 disables the job.
 
-        seconds (int): Updates the function every given second
+        Optional Args:
+            name (str): The job name used by the `jobs` command. Defaults to the function name.
+            jitter (int): Up to this many random seconds are added to every run.
+            timeout (int): Cancel the runs taking longer than this many seconds.
+            missed (str): `SKIP` to wait for the next slot after a missed run or `RUN_ONCE` to run it right away.
         """
         def decorator(fcn):
-            async def wrapper():
-                while not client.is_connected():
-                    await asyncio.sleep(1)
-                while True:
-                    if int(seconds) == 0:
-                        break
-                    await fcn()
-                    await asyncio.sleep(seconds)
-            loop.create_task(wrapper())
-
-            return wrapper
+            self.modules.record_eager(fcn.__module__)
+            if int(interval) > 0:
+                self.jobs.add(name or fcn.__name__, fcn, interval,
+                              jitter=jitter, timeout=timeout, missed=missed)
+            return fcn
         return decorator
 
+    def on_timer(self, seconds):
+        """
+        A decorator that runs a decorated function every x seconds. Same as `client.job(seconds)`
+
+        Args:
+
+        seconds (int): Updates the function every given second
+        """
+        return self.job(seconds)
+
     def log_exception(self, func):
 
+        @functools.wraps(func)
         async def wrapper(*args, **kwds):
             __lgw_marker_local__ = 0
 
@@ -259,37 +678,11 @@ class CustomClient(TelegramClient):
                 if isinstance(e, FloodWaitError):
                     LOGGER.info(
                         f"We have reached a flood limitation."
-                        f" You won't be able to edit your messages for {str(datetime.timedelta(seconds=e.seconds))}.")
+                        f" {func.__name__} was stopped, try again in {str(datetime.timedelta(seconds=e.seconds))}.")
                     return
 
-                exc_time = datetime.datetime.now().strftime("%m_%d_%H:%M:%S")
-
-                file_name = f"{exc_time}_{type(e).__name__}_{func.__name__}"
-
-                if not DEBUG:
-                    raise
-
-                if not os.path.exists('logs/'):
-                    os.mkdir('logs/')
-
-                with open(f"logs/{file_name}.log", "a") as log_file:
-                    log_file.write(f"Exception thrown, {type(e)}: {str(e)}\n")
-                    frames = inspect.getinnerframes(sys.exc_info()[2])
-                    for frame_info in reversed(frames):
-                        f_locals = frame_info[0].f_locals
-                        if "__lgw_marker_local__" in f_locals:
-                            continue
-
-                        log_file.write(f"File{frame_info[1]},"
-                                       f"line {frame_info[2]}"
-                                       f" in {frame_info[3]}\n"
-                                       f"{     frame_info[4][0]}\n")
-
-                        for k, v in f_locals.items():
-                            log_to_str = str(v).replace("\n", "\\n")
-                            log_file.write(f"    {k} = {log_to_str}\n")
-                    log_file.write("\n")
-
+                if DEBUG:
+                    self._error_log.log(e, func.__name__)
                 raise
 
         return wrapper
@@ -298,7 +691,11 @@ class CustomClient(TelegramClient):
 class CompanionClient(CustomClient, CustomDisconnect):
     pass
 
-container = AlchemySessionContainer(DB_URI)
-session = container.new_session(SESSION_NAME)
+with startup.phase("session"):
+    container = AlchemySessionContainer(engine=database.engine)
 
-client = CompanionClient(session, APP_ID, APP_HASH)
+client = ClientProxy(CMD_HELP)
+for session_name in [SESSION_NAME] + EXTRA_SESSIONS:
+    with startup.phase(f"client {session_name}"):
+        client.add(session_name, CompanionClient(
+            sessionstore.new_session(container, session_name), APP_ID, APP_HASH, client))
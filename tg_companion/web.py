@@ -0,0 +1,11 @@
+import aiohttp
+
+_session = None
+
+
+def session():
+    """ The aiohttp session shared by every module and account, so the connections to the same host are reused """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession()
+    return _session
@@ -0,0 +1,120 @@
+import asyncio
+import time
+
+from telethon.errors import (FloodWaitError, MessageAuthorRequiredError,
+                             MessageEditTimeExpiredError,
+                             MessageIdInvalidError, MessageNotModifiedError)
+
+from tg_companion import LOGGER
+
+# The message can't be edited anymore, the text is sent as a reply instead
+EDIT_NOT_ALLOWED = (MessageIdInvalidError, MessageAuthorRequiredError, MessageEditTimeExpiredError)
+
+
+class MessageWriter(object):
+    """
+    Coalesces the edits of messages that are updated progressively ( terminal output, upload progress, ... )
+
+    Only the newest pending text of a message is kept, identical texts are dropped and the edits
+    sent to the same chat are spaced by at least `interval` seconds.
+    """
+
+    def __init__(self, client, interval):
+        self._client = client
+        self.interval = interval
+        self._next_edit = {}
+        self.edits = 0
+        self.coalesced = 0
+        self.duplicates = 0
+
+    def delay(self, chat_id):
+        """ Seconds to wait before the next edit in `chat_id` is allowed """
+        return max(0.0, self._next_edit.get(chat_id, 0.0) - time.monotonic())
+
+    def postpone(self, chat_id, seconds):
+        self._next_edit[chat_id] = max(self._next_edit.get(chat_id, 0.0), time.monotonic() + seconds)
+
+    async def edit(self, chat_id, message, text):
+        """
+        Edits `message` and returns it, or replies to it when it can't be edited and returns the reply.
+        Flood waits and the other errors are raised
+        """
+        await asyncio.sleep(self.delay(chat_id))
+        self.postpone(chat_id, self.interval)
+        self.edits += 1
+        chat = await message.get_input_chat()
+        try:
+            await self._client.edit_message(chat, message, text)
+        except EDIT_NOT_ALLOWED:
+            return await self._client.send_message(chat, text, reply_to=message)
+        return message
+
+    def stream(self, message):
+        return ProgressMessage(self, message)
+
+    def stats(self):
+        return {"edits": self.edits, "coalesced": self.coalesced, "duplicates": self.duplicates}
+
+
+class ProgressMessage(object):
+    """
+    A message edited through a `MessageWriter`. Use `update()` as often as needed, the message is edited
+    at most once per writer interval and always ends up showing the last text.
+
+        async with client.progress_message(event) as progress:
+            for line in lines:
+                progress.update(line)
+    """
+
+    def __init__(self, writer, message):
+        self._writer = writer
+        self._message = message
+        self._chat_id = message.chat_id
+        self._pending = None
+        self._task = None
+        self.text = None
+
+    def update(self, text):
+        if text == self.text or text == self._pending:
+            self._writer.duplicates += 1
+            return
+
+        if self._pending is not None:
+            self._writer.coalesced += 1
+        self._pending = text
+
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._flush_later())
+
+    async def flush(self):
+        """ Waits until the pending text, if any, is shown """
+        if self._task is not None:
+            await self._task
+
+    async def _flush_later(self):
+        try:
+            while self._pending is not None:
+                await asyncio.sleep(self._writer.delay(self._chat_id))
+                text, self._pending = self._pending, None
+                if text == self.text:
+                    continue
+                try:
+                    # The next edits go to the reply sent when the message couldn't be edited
+                    self._message = await self._writer.edit(self._chat_id, self._message, text)
+                    self.text = text
+                except MessageNotModifiedError:
+                    self.text = text
+                except FloodWaitError as exc:
+                    self._writer.postpone(self._chat_id, exc.seconds)
+                    if self._pending is None:
+                        self._pending = text
+                except Exception:
+                    LOGGER.exception("Failed to edit progress message in %s", self._chat_id)
+        finally:
+            self._task = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.flush()